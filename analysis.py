@@ -0,0 +1,392 @@
+from collections import Counter
+
+import pandas as pd
+import numpy as np
+from pandas.tseries.api import guess_datetime_format
+
+from tracing import span
+
+# Terms in a column name that suggest it holds dates
+DATE_NAME_TERMS = ['date', 'time', 'day', 'month', 'year']
+
+# Terms in a column name that suggest it holds values worth aggregating
+VALUE_NAME_TERMS = ['amount', 'price', 'revenue', 'sales', 'cost', 'profit', 'qty', 'quantity', 'value']
+
+# Rows sampled when testing whether a text column holds dates
+DATE_SAMPLE_SIZE = 10_000
+
+# Columns with fewer distinct values than this are treated as categories
+CATEGORY_MAX_UNIQUE = 20
+
+# Dtypes that hold text: plain objects, pandas/Arrow strings and categoricals
+TEXT_DTYPES = ['object', 'string', 'category']
+
+# Distinct values looked at when guessing a date column's format
+DATE_FORMAT_SAMPLE = 20
+
+# Values that are already JSON serializable and need no conversion
+NATIVE_SCALAR_TYPES = {str, int, float, bool, type(None)}
+
+# Function to convert NumPy types to Python native types for JSON serialization.
+# Native scalars are passed through inline rather than visited one call each, since the
+# aggregation records of a wide upload hold millions of them.
+def convert_to_native_types(obj):
+    if type(obj) in NATIVE_SCALAR_TYPES:
+        return obj
+    elif isinstance(obj, (np.integer, np.int64)):
+        return int(obj)
+    elif isinstance(obj, (np.floating, np.float64)):
+        return float(obj)
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, dict):
+        return {k: v if type(v) in NATIVE_SCALAR_TYPES else convert_to_native_types(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [i if type(i) in NATIVE_SCALAR_TYPES else convert_to_native_types(i) for i in obj]
+    else:
+        return obj
+
+# Function to guess the strftime format of a text column from a few of its distinct values.
+# Returns the most common guess, or None when no value looks like a date.
+def guess_date_format(series):
+    values = series.dropna().head(DATE_FORMAT_SAMPLE * 10).unique()[:DATE_FORMAT_SAMPLE]
+    guesses = Counter(guess_datetime_format(value) for value in values if isinstance(value, str))
+    guesses.pop(None, None)
+    return guesses.most_common(1)[0][0] if guesses else None
+
+# Function to parse a column into datetimes (NaT where a value does not parse). The format is
+# guessed from the values unless given, so the fast fixed-format parser is used; only columns
+# with no recognizable format fall back to pandas inference (dateutil, value by value).
+# Categorical columns parse each distinct value once.
+def parse_dates(series, date_format=None):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    if date_format is None:
+        date_format = guess_date_format(series)
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = pd.to_datetime(pd.Series(series.cat.categories), format=date_format, errors='coerce')
+        codes = series.cat.codes.to_numpy()
+        values = categories.to_numpy()[codes]
+        values[codes < 0] = np.datetime64("NaT")
+        return pd.Series(values, index=series.index, name=series.name)
+    return pd.to_datetime(series, format=date_format, errors='coerce')
+
+# Function to label parsed dates with their 'YYYY-MM' month (None for missing dates).
+# Formats each distinct month once instead of calling strftime on every row.
+def month_labels(parsed):
+    keys = parsed.dt.year * 100 + parsed.dt.month
+    codes, uniques = pd.factorize(keys)
+    labels = np.array([f"{int(key) // 100:04d}-{int(key) % 100:02d}" for key in uniques] + [None], dtype=object)
+    return pd.Series(labels[codes], index=parsed.index)
+
+# Function to find date columns by name, then by trial-parsing a sample of each text column.
+# Text columns whose values do not look like any date format are skipped without parsing.
+def detect_date_columns(transaction_data, sample_size=DATE_SAMPLE_SIZE):
+    # Columns whose name suggests a date
+    date_columns = [col for col in transaction_data.columns
+                    if any(date_term in col.lower() for date_term in DATE_NAME_TERMS)]
+
+    # Explicitly detect date columns by trying to convert a sample of their rows
+    for col in transaction_data.select_dtypes(include=TEXT_DTYPES).columns:
+        if col in date_columns:
+            continue
+        date_format = guess_date_format(transaction_data[col])
+        if date_format is None:
+            continue
+        sample = transaction_data[col]
+        if len(sample) > sample_size:
+            sample = sample.sample(sample_size, random_state=0)
+        try:
+            parsed = parse_dates(sample, date_format)
+        except (TypeError, ValueError):
+            continue
+        # If >50% of sampled values converted successfully, consider it a date
+        if parsed.notna().sum() > len(sample) * 0.5:
+            date_columns.append(col)
+    return date_columns
+
+# Function to build the derived (side-car) columns for date columns.
+# The raw frame is never modified; parsed dates and month buckets live in a separate
+# DataFrame that shares the raw frame's index and is built once per upload.
+def build_derived_columns(transaction_data, date_columns=None):
+    if date_columns is None:
+        date_columns = detect_date_columns(transaction_data)
+    derived = pd.DataFrame(index=transaction_data.index)
+
+    parsed_columns = []
+    for col in date_columns:
+        try:
+            derived[col] = parse_dates(transaction_data[col])
+            parsed_columns.append(col)
+        except (TypeError, ValueError, OverflowError):
+            pass
+
+    # Month-year buckets for readable grouping, stored as categoricals to keep them compact
+    for date_col in parsed_columns:
+        derived[f'month_year_{date_col}'] = month_labels(derived[date_col]).astype('category')
+
+    derived.attrs["date_columns"] = parsed_columns
+    return derived
+
+# Question-independent facts about one column, computed once per upload.
+# role is one of: date, value, id, category, text.
+class ColumnProfile:
+    FIELDS = ["name", "dtype", "role", "unique_count", "null_count", "null_percentage",
+              "min", "max", "top_values", "value_percentages", "summary"]
+
+    def __init__(self, name, dtype, role, unique_count=None, null_count=0, null_percentage=0.0,
+                 min=None, max=None, top_values=None, value_percentages=None, summary=None):
+        self.name = name
+        self.dtype = dtype
+        self.role = role
+        self.unique_count = unique_count
+        self.null_count = null_count
+        self.null_percentage = null_percentage
+        self.min = min
+        self.max = max
+        self.top_values = top_values
+        self.value_percentages = value_percentages
+        self.summary = summary
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{field: data.get(field) for field in cls.FIELDS})
+
+# Function to decide whether a column looks like an identifier rather than a measure or label
+def _looks_like_id(col, series, unique_count):
+    name = col.strip()
+    lowered = name.lower()
+    if lowered == 'id' or lowered.endswith(('_id', ' id', '-id')) or name.endswith('Id') or name.endswith('ID'):
+        return True
+    # Integer columns where every value is distinct are usually keys
+    non_null = len(series) - int(series.isna().sum())
+    return pd.api.types.is_integer_dtype(series) and non_null > 100 and unique_count == non_null
+
+# Function to profile every column of an upload. Returns an ordered {column: ColumnProfile} index.
+def build_column_profiles(transaction_data, derived_data):
+    date_columns = derived_data.attrs.get("date_columns", [])
+    row_count = len(transaction_data)
+    numeric_cols = set(transaction_data.select_dtypes(include=['number']).columns)
+    object_cols = set(transaction_data.select_dtypes(include=TEXT_DTYPES).columns)
+
+    profiles = {}
+    for col in transaction_data.columns:
+        series = derived_data[col] if col in date_columns else transaction_data[col]
+        null_count = int(series.isna().sum())
+        profile = ColumnProfile(
+            name=col,
+            dtype=str(series.dtype),
+            role="text",
+            null_count=null_count,
+            null_percentage=float(null_count / row_count * 100) if row_count else 0.0
+        )
+
+        if col in date_columns:
+            profile.role = "date"
+            if series.notna().any():
+                profile.min = series.min().strftime('%Y-%m-%d')
+                profile.max = series.max().strftime('%Y-%m-%d')
+        elif col in numeric_cols:
+            profile.unique_count = int(series.nunique())
+            profile.role = "id" if _looks_like_id(col, series, profile.unique_count) else "value"
+            profile.min = float(series.min())
+            profile.max = float(series.max())
+            profile.summary = {
+                "sum": float(series.sum()),
+                "mean": float(series.mean()),
+                "median": float(series.median()),
+                "std": float(series.std())
+            }
+        elif col in object_cols:
+            # One value_counts pass gives cardinality, top values and percentages
+            value_counts = series.value_counts()
+            profile.unique_count = int(len(value_counts))
+            profile.top_values = {str(k): int(v) for k, v in value_counts.head(10).items()}
+            if profile.unique_count < CATEGORY_MAX_UNIQUE:
+                profile.role = "category"
+                profile.value_percentages = {
+                    str(k): float(v / row_count * 100) for k, v in value_counts.items()
+                }
+            elif _looks_like_id(col, series, profile.unique_count):
+                profile.role = "id"
+        profiles[col] = profile
+    return profiles
+
+# Function to parse dates and profile columns for a new upload in one step
+def profile_upload(transaction_data):
+    derived_data = build_derived_columns(transaction_data)
+    return derived_data, build_column_profiles(transaction_data, derived_data)
+
+# Function to widen numeric columns narrower than 64 bits, since grouped sums keep the input
+# dtype and would overflow (or lose precision) on downcast columns
+def widen_numeric(frame):
+    narrow = {col: np.float64 if pd.api.types.is_float_dtype(dtype) else np.int64
+              for col, dtype in frame.dtypes.items()
+              if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype) and dtype.itemsize < 8}
+    return frame.astype(narrow) if narrow else frame
+
+# Function to aggregate every value column by one grouping key in a single pass.
+# Returns {value_col: [records]} with the same record layout the per-pair groupbys produced.
+def aggregate_by_key(transaction_data, key, key_name, value_cols):
+    if not value_cols:
+        return {}
+    # Factorize the key once and reuse it for every reduction
+    grouped = widen_numeric(transaction_data[value_cols]).groupby(key, observed=True)
+    sums, counts = grouped.sum(), grouped.count()
+    # group_mean divides the same compensated sum by the count, so this matches grouped.mean()
+    means = sums / counts.where(counts > 0)
+    key_values = sums.index.tolist()
+    sum_lists, mean_lists, count_lists = _column_lists(sums), _column_lists(means), _column_lists(counts)
+
+    results = {}
+    for value_col in value_cols:
+        record_keys = (key_name, f'sum_{value_col}', f'avg_{value_col}', f'count_{value_col}')
+        columns = zip(key_values, sum_lists[value_col], mean_lists[value_col], count_lists[value_col])
+        results[value_col] = [dict(zip(record_keys, values)) for values in columns]
+    return results
+
+# Function to pull every column of a frame out as a native Python list, converting one 2-D
+# block per dtype rather than selecting columns one by one (a per-column lookup dominates on
+# frames with hundreds of columns). Columns keep their own dtype, so integer sums stay integers.
+def _column_lists(frame):
+    lists = {}
+    for _, dtype_cols in frame.columns.to_series().groupby(frame.dtypes.astype(str), sort=False):
+        block = frame[dtype_cols.tolist()].to_numpy()
+        lists.update(zip(dtype_cols.tolist(), block.T.tolist()))
+    return lists
+
+# Function to split columns into numeric and categorical, excluding anything treated as a date
+def classify_columns(transaction_data, date_columns):
+    numeric_cols = [col for col in transaction_data.select_dtypes(include=['number']).columns
+                    if col not in date_columns]
+    object_cols = [col for col in transaction_data.select_dtypes(include=TEXT_DTYPES).columns
+                   if col not in date_columns]
+    return numeric_cols, object_cols
+
+# Function to pick the numeric columns to aggregate: value-like names, else every numeric column
+def pick_value_columns(numeric_cols):
+    value_cols = [col for col in numeric_cols if any(term in col.lower() for term in VALUE_NAME_TERMS)]
+    return value_cols or numeric_cols
+
+# Function to add the question-independent sections that come straight from the column profiles.
+# null_counts overrides the profile null counts when the caller computed them itself.
+def add_profile_sections(data_stats, all_columns, row_count, numeric_cols, object_cols, date_columns,
+                         column_profiles, null_counts=None):
+    def nulls(col):
+        if null_counts is None:
+            return column_profiles[col].null_count, column_profiles[col].null_percentage
+        return null_counts[col], float(null_counts[col] / row_count * 100) if row_count else 0.0
+
+    # Process all columns, not just a subset
+    data_stats["all_columns"] = all_columns
+    data_stats["row_count"] = row_count
+
+    # Basic column type information (date columns report their parsed type)
+    data_stats["column_types"] = {col: column_profiles[col].dtype for col in all_columns}
+    for col in date_columns:
+        data_stats[f"{col}_is_date"] = True
+
+    # Get column summaries for numeric columns
+    for col in numeric_cols:
+        profile = column_profiles[col]
+        null_count, null_percentage = nulls(col)
+        data_stats[col] = {
+            "sum": profile.summary["sum"],
+            "mean": profile.summary["mean"],
+            "median": profile.summary["median"],
+            "max": profile.max,
+            "min": profile.min,
+            "std": profile.summary["std"],
+            "null_count": null_count,
+            "null_percentage": null_percentage
+        }
+
+    # Get basic info about categorical columns
+    for col in object_cols:
+        profile = column_profiles[col]
+        null_count, null_percentage = nulls(col)
+        data_stats[col] = {
+            "unique_values": profile.unique_count,
+            "top_values": dict(profile.top_values),
+            "null_count": null_count,
+            "null_percentage": null_percentage
+        }
+
+        # For columns with few unique values (<20), include percentage distribution
+        if profile.value_percentages is not None:
+            data_stats[col]["value_percentages"] = dict(profile.value_percentages)
+
+    # Basic date statistics, keyed by the date columns that have any parsed rows
+    date_stats = {}
+    for date_col in date_columns:
+        profile = column_profiles[date_col]
+        if profile.min is not None:
+            null_count, null_percentage = nulls(date_col)
+            date_stats[date_col] = {
+                "min_date": profile.min,
+                "max_date": profile.max,
+                "null_count": null_count,
+                "null_percentage": null_percentage
+            }
+    return date_stats
+
+# Function to perform detailed data analysis
+def analyze_data_for_question(question, transaction_data, dictionary_data=None, derived_data=None, column_profiles=None):
+    # Build the side-car and profiles here only if the caller did not precompute them at upload time
+    if derived_data is None:
+        with span("derive date columns"):
+            derived_data = build_derived_columns(transaction_data)
+    if column_profiles is None:
+        with span("profile columns"):
+            column_profiles = build_column_profiles(transaction_data, derived_data)
+    date_columns = derived_data.attrs.get("date_columns", [])
+
+    # Prepare data summary
+    data_stats = {}
+    with span("column summaries"):
+        numeric_cols, object_cols = classify_columns(transaction_data, date_columns)
+        date_stats = add_profile_sections(data_stats, transaction_data.columns.tolist(), len(transaction_data),
+                                          numeric_cols, object_cols, date_columns, column_profiles)
+
+    # Find numeric columns that might represent values to aggregate
+    value_cols = pick_value_columns(numeric_cols)
+
+    # Process date columns
+    for date_col, stats in date_stats.items():
+        with span("monthly aggregations", column=date_col, value_columns=len(value_cols)):
+            data_stats[date_col] = stats
+            month_year = derived_data[f'month_year_{date_col}']
+
+            # Monthly distribution
+            monthly_counts = month_year.value_counts().sort_index().to_dict()
+            data_stats[f"{date_col}_monthly_distribution"] = {str(k): int(v) for k, v in monthly_counts.items() if v > 0}
+
+            # Monthly aggregations for every value column at once, keyed on the side-car bucket
+            monthly_results = aggregate_by_key(transaction_data, month_year, f'month_year_{date_col}', value_cols)
+            for value_col, monthly_data in monthly_results.items():
+                data_stats[f"monthly_{date_col}_{value_col}"] = monthly_data
+
+    # Category cross analysis does not depend on the date column, so run it once rather than per date column
+    if date_stats:
+        # Look for potential category columns to do cross analysis
+        categorical_cols = [col for col in object_cols if column_profiles[col].unique_count < CATEGORY_MAX_UNIQUE]
+
+        # One groupby per category column covers all value columns
+        with span("category aggregations", columns=len(categorical_cols), value_columns=len(value_cols)):
+            for cat_col in categorical_cols:
+                category_results = aggregate_by_key(transaction_data, transaction_data[cat_col], cat_col, value_cols)
+                for value_col, category_data in category_results.items():
+                    data_stats[f"{cat_col}_{value_col}_analysis"] = category_data
+
+    # Add correlation matrix for numeric columns
+    if len(numeric_cols) > 1:
+        with span("correlation", columns=len(numeric_cols)):
+            # The matrix is symmetric, so column-oriented to_dict gives {col1: {col2: value}}
+            data_stats["correlation_matrix"] = transaction_data[numeric_cols].corr().round(2).to_dict()
+
+    # Make sure all values are JSON serializable
+    with span("convert to native types"):
+        return convert_to_native_types(data_stats)
@@ -2,6 +2,30 @@ import streamlit as st
 import pandas as pd
 import google.generativeai as genai
 import json
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import nullcontext
+from analysis import analyze_data_for_question, profile_upload
+from ingest import (align_appended_rows, append_rows, build_append_stats, load_cached_upload, optimize_dtypes,
+                    store_cached_upload, stream_csv_statistics)
+from prompts import (COLUMN_INFO_SHARE, DICTIONARY_SHARE, PROMPT_TEMPLATE_TOKENS, PROMPT_TOKEN_BUDGET, DictionaryIndex,
+                     build_analysis_payload, build_dictionary_context, estimate_tokens, score_columns, select_lines)
+from store import analyze_store, open_store
+from sampling import SAMPLE_TARGET_SECONDS, SamplingPlan, analyze_approximately
+from query import QUERY_MAX_ROWS, QueryEngine, QueryError, extract_sql
+from llm import FakeModel, LLMClient, ResponseCache, ResponseStream
+from registry import DatasetRegistry
+from jobs import JobCancelled, JobRunner
+from tracing import Trace, activate, span, traces_to_chrome, traces_to_json
+from dictionary import ColumnMatcher, lookup_description, pick_table, process_data_dictionary
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 # Set up the Streamlit app layout
 st.title("! My Chatbot and Data Analysis App")
@@ -10,17 +34,47 @@ st.subheader("Conversation and Data Analysis")
 # Capture Gemini API Key
 gemini_api_key = st.secrets['gemini_api_key']
 
+# Configure Gemini and build the model once per process instead of on every rerun and session
+@st.cache_resource
+def get_gemini_model(api_key):
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel("gemini-2.0-flash-lite")
+
 # Initialize the Gemini Model
 model = None
 if gemini_api_key:
     try:
-        genai.configure(api_key=gemini_api_key)
-        model = genai.GenerativeModel("gemini-2.0-flash-lite")
+        model = get_gemini_model(gemini_api_key)
         st.success("Gemini API Key successfully configured.")
     except Exception as e:
         st.error(f"An error occurred while setting up the Gemini model: {e}")
 
+# Local fake model for development and latency testing without calling Gemini
+if os.environ.get("USE_FAKE_MODEL"):
+    model = FakeModel(
+        first_delay=float(os.environ.get("FAKE_MODEL_FIRST_DELAY", "0.5")),
+        chunk_delay=float(os.environ.get("FAKE_MODEL_CHUNK_DELAY", "0.05")),
+        error_rate=float(os.environ.get("FAKE_MODEL_ERROR_RATE", "0"))
+    )
+    st.info("Using the local fake model.")
+
+# One client per model for the whole process, so the concurrency limit and queue are global
+@st.cache_resource
+def get_llm_client(model_name, _model):
+    return LLMClient(_model)
+
+llm_client = get_llm_client(getattr(model, "model_name", "unknown"), model) if model else None
+
+# Uploaded datasets are shared across sessions by content hash
+@st.cache_resource
+def get_dataset_registry():
+    return DatasetRegistry()
+
+dataset_registry = get_dataset_registry()
+
 # Initialize session state
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
 if "transaction_data" not in st.session_state:
@@ -31,11 +85,116 @@ if "column_descriptions" not in st.session_state:
     st.session_state.column_descriptions = {}
 if "dictionary_formatted_text" not in st.session_state:
     st.session_state.dictionary_formatted_text = ""
+if "table_descriptions" not in st.session_state:
+    st.session_state.table_descriptions = {}
+if "dictionary_fingerprint" not in st.session_state:
+    st.session_state.dictionary_fingerprint = None
+    st.session_state.dictionary_file_id = None
+if "transaction_fingerprint" not in st.session_state:
+    st.session_state.transaction_fingerprint = None
+if "derived_data" not in st.session_state:
+    st.session_state.derived_data = None
+if "column_profiles" not in st.session_state:
+    st.session_state.column_profiles = None
+if "streaming_analysis" not in st.session_state:
+    st.session_state.streaming_analysis = None
+if "transaction_file_id" not in st.session_state:
+    st.session_state.transaction_file_id = None
+    st.session_state.upload_fingerprint = None
+if "append_stats" not in st.session_state:
+    st.session_state.append_stats = None
+    st.session_state.streaming_stats = None
+    st.session_state.appended_rows = 0
+    st.session_state.append_generation = 0
+    st.session_state.append_file_id = None
+if "column_matcher" not in st.session_state:
+    st.session_state.column_matcher = None
+    st.session_state.column_matcher_key = None
+if "column_mapping" not in st.session_state:
+    st.session_state.column_mapping = {}
+    st.session_state.column_mapping_key = None
+if "traces" not in st.session_state:
+    st.session_state.traces = []
+if "memory_report" not in st.session_state:
+    # Before/after footprint of the dtype optimization for the upload parsed in this session
+    st.session_state.memory_report = None
+if "refinement" not in st.session_state:
+    # The latest answer given from sampled estimates: its question, analysis key and history position
+    st.session_state.refinement = None
+if "precompute_keys" not in st.session_state:
+    # Background jobs this session holds for the current upload and dictionary
+    st.session_state.precompute_keys = []
+    # Analysis key whose precomputation failed, so it is not retried on every rerun
+    st.session_state.precompute_failed_key = None
+
+# Per-request timing; spans cost almost nothing while this is off
+MAX_TRACES = 20
+trace_requests_checkbox = st.sidebar.checkbox(
+    "Show timing breakdown",
+    help="Times each stage of uploads and chat turns (wall time, CPU time) and shows the breakdown below the chat."
+)
+track_memory_checkbox = st.sidebar.checkbox(
+    "Include memory deltas (slower)",
+    disabled=not trace_requests_checkbox,
+    help="Tracks Python allocations with tracemalloc while a request runs."
+)
+
+# Function to trace one request (an upload or a chat turn) when the timing breakdown is enabled
+def request_trace(name):
+    if not trace_requests_checkbox:
+        return nullcontext()
+    trace = Trace(name, track_memory=track_memory_checkbox)
+    st.session_state.traces = (st.session_state.traces + [trace])[-MAX_TRACES:]
+    return activate(trace)
 
 # Display chat history
 for role, message in st.session_state.chat_history:
     st.chat_message(role).markdown(message)
 
+# Function to forget appended rows when a new base file is loaded (also clears the append uploader)
+def reset_append_state():
+    st.session_state.append_stats = None
+    st.session_state.appended_rows = 0
+    st.session_state.append_generation += 1
+
+# Function to merge a file of new rows into the held dataset. Only the new rows are parsed and
+# folded into mergeable statistics; the analysis is then rendered from those statistics
+# instead of rescanning the whole history.
+def append_transaction_rows(append_file):
+    delta = pd.read_csv(append_file)
+    delta_fingerprint = hashlib.sha256(append_file.getvalue()).hexdigest()
+    previous_fingerprint = st.session_state.transaction_fingerprint
+    # The appended dataset gets its own identity, chained from the data it extends
+    fingerprint = hashlib.sha256(f"{previous_fingerprint}+{delta_fingerprint}".encode("utf-8")).hexdigest()
+    
+    if st.session_state.streaming_analysis is not None:
+        # Streamed uploads only hold statistics, so the new rows go straight into them
+        stats = st.session_state.streaming_stats
+        stats.update(align_appended_rows(delta, st.session_state.streaming_preview))
+        st.session_state.streaming_analysis = stats.to_analysis()
+    else:
+        if st.session_state.append_stats is None:
+            # Built once per held dataset; every later append only touches its own rows
+            st.session_state.append_stats = build_append_stats(
+                st.session_state.transaction_data, st.session_state.derived_data
+            )
+        data, derived_data, column_profiles = append_rows(
+            st.session_state.transaction_data,
+            st.session_state.derived_data,
+            st.session_state.column_profiles,
+            st.session_state.append_stats,
+            delta
+        )
+        dataset_registry.release(previous_fingerprint, st.session_state.session_id)
+        data, derived_data, column_profiles = dataset_registry.acquire(
+            fingerprint, st.session_state.session_id, lambda: (data, derived_data, column_profiles)
+        )
+        st.session_state.transaction_data = data
+        st.session_state.derived_data = derived_data
+        st.session_state.column_profiles = column_profiles
+    st.session_state.transaction_fingerprint = fingerprint
+    st.session_state.appended_rows += len(delta)
+
 # Create two columns for file uploaders
 col1, col2 = st.columns(2)
 
@@ -43,138 +202,137 @@ col1, col2 = st.columns(2)
 with col1:
     st.subheader("Upload Transaction Data")
     transaction_file = st.file_uploader("Choose a CSV file", type=["csv"], key="transaction_uploader")
+    stream_upload = st.checkbox(
+        "Stream large file in chunks (approximate statistics)",
+        key="stream_upload",
+        help="Reads the file in chunks and keeps only summary statistics, so memory stays bounded by the chunk size."
+    )
     if transaction_file is not None:
         try:
-            data = pd.read_csv(transaction_file)
-            st.session_state.transaction_data = data
-            st.success("Transaction data successfully uploaded and read.")
-            st.write("### Transaction Data Preview")
-            st.dataframe(data.head())
+            # Fingerprint the uploaded content so analysis results can be reused across chat turns.
+            # Reruns see the same upload id, so the hash is only computed once per upload.
+            file_id = getattr(transaction_file, "file_id", None)
+            if file_id is not None and file_id == st.session_state.transaction_file_id:
+                fingerprint = st.session_state.upload_fingerprint
+            else:
+                fingerprint = hashlib.sha256(transaction_file.getvalue()).hexdigest()
+            upload_changed = fingerprint != st.session_state.upload_fingerprint
+            st.session_state.transaction_file_id = file_id
+            st.session_state.upload_fingerprint = fingerprint
+            # Let go of the previous shared dataset when a different file is uploaded
+            if upload_changed and st.session_state.transaction_fingerprint is not None:
+                dataset_registry.release(st.session_state.transaction_fingerprint, st.session_state.session_id)
+            if stream_upload:
+                # Only the mergeable statistics and a preview are kept, never the full frame
+                if upload_changed or st.session_state.streaming_analysis is None:
+                    progress_text = st.empty()
+                    with request_trace("upload"), span("stream CSV statistics"):
+                        stats, preview = stream_csv_statistics(
+                            transaction_file,
+                            on_chunk=lambda rows: progress_text.caption(f"Streamed {rows:,} rows...")
+                        )
+                    progress_text.empty()
+                    st.session_state.streaming_stats = stats
+                    st.session_state.streaming_analysis = stats.to_analysis()
+                    st.session_state.streaming_preview = preview
+                    st.session_state.transaction_fingerprint = fingerprint
+                    reset_append_state()
+                st.session_state.transaction_data = None
+                st.session_state.derived_data = None
+                st.session_state.column_profiles = None
+                st.success(f"Transaction data streamed: {st.session_state.streaming_analysis['row_count']:,} rows summarized.")
+                st.write("### Transaction Data Preview")
+                st.dataframe(st.session_state.streaming_preview)
+            else:
+                # Function to load an upload no session holds yet: columnar cache first, then parse
+                def load_upload():
+                    with span("load columnar cache"):
+                        cached_upload = load_cached_upload(fingerprint)
+                    if cached_upload is not None:
+                        # Same file seen before: reload the parsed columns from disk
+                        st.caption("Loaded from the local columnar cache")
+                        return cached_upload
+                    with span("parse CSV"):
+                        data = pd.read_csv(transaction_file)
+                    # Compact dtypes before profiling, so every later scan and groupby runs on them
+                    with span("optimize dtypes", columns=len(data.columns)):
+                        data, st.session_state.memory_report = optimize_dtypes(data)
+                    # Parse dates into a side-car and profile every column once per upload
+                    with span("profile upload", rows=len(data), columns=len(data.columns)):
+                        derived_data, column_profiles = profile_upload(data)
+                    try:
+                        with span("write columnar cache"):
+                            store_cached_upload(fingerprint, data, derived_data, column_profiles)
+                    except Exception as e:
+                        st.warning(f"Could not write the columnar cache: {e}")
+                    return data, derived_data, column_profiles
+                
+                # Parse only when the upload changes; reruns reuse the shared dataset
+                if upload_changed or st.session_state.transaction_data is None or st.session_state.column_profiles is None:
+                    # Only a parse in this session reports a footprint; cached and shared loads do not
+                    st.session_state.memory_report = None
+                    with request_trace("upload"):
+                        data, derived_data, column_profiles = dataset_registry.acquire(
+                            fingerprint, st.session_state.session_id, load_upload
+                        )
+                    st.session_state.transaction_data = data
+                    st.session_state.derived_data = derived_data
+                    st.session_state.column_profiles = column_profiles
+                    st.session_state.streaming_analysis = None
+                    st.session_state.transaction_fingerprint = fingerprint
+                    reset_append_state()
+                elif not dataset_registry.touch(st.session_state.transaction_fingerprint, st.session_state.session_id):
+                    # The registry evicted this dataset while idle; share this session's copy again
+                    dataset_registry.acquire(
+                        st.session_state.transaction_fingerprint,
+                        st.session_state.session_id,
+                        lambda: (st.session_state.transaction_data, st.session_state.derived_data, st.session_state.column_profiles)
+                    )
+                st.success("Transaction data successfully uploaded and read.")
+                memory_report = st.session_state.memory_report
+                if memory_report is not None:
+                    with st.expander(
+                        f"Memory: {memory_report['before_bytes'] / 1e6:,.1f} MB as parsed, "
+                        f"{memory_report['after_bytes'] / 1e6:,.1f} MB after dtype optimization "
+                        f"({memory_report['before_bytes'] / max(memory_report['after_bytes'], 1):.1f}x smaller)"
+                    ):
+                        st.dataframe(pd.DataFrame(
+                            [(col, before, after) for col, (before, after) in memory_report["changes"].items()],
+                            columns=["column", "parsed dtype", "optimized dtype"]
+                        ), hide_index=True)
+                st.write("### Transaction Data Preview")
+                st.dataframe(st.session_state.transaction_data.head())
+            
+            # Append mode: new rows with the same columns are merged into the data held above
+            append_file = st.file_uploader(
+                "Append new rows (same columns)",
+                type=["csv"],
+                key=f"append_uploader_{st.session_state.append_generation}",
+                help="Adds a CSV of new rows, e.g. a day of transactions, and updates the statistics from those rows only."
+            )
+            if append_file is not None and getattr(append_file, "file_id", None) != st.session_state.append_file_id:
+                try:
+                    with request_trace("append"), span("append rows"):
+                        append_transaction_rows(append_file)
+                    st.session_state.append_file_id = getattr(append_file, "file_id", None)
+                except Exception as e:
+                    st.error(f"Could not append the new rows: {e}")
+            if st.session_state.appended_rows:
+                st.caption(f"{st.session_state.appended_rows:,} appended rows merged into the statistics")
         except Exception as e:
             st.error(f"An error occurred while reading the transaction file: {e}")
 
-# Function to process the data dictionary into a usable format
-def process_data_dictionary(dict_data):
-    column_descriptions = {}
-    formatted_text = ""
-    
-    # First, print the actual column names from the dictionary file for debugging
-    actual_columns = dict_data.columns.tolist()
-    print(f"Actual dictionary columns: {actual_columns}")
-    
-    # Try to intelligently identify which columns contain what information
-    # based on column names and content patterns
-    
-    # Identify column name column
-    name_cols = [col for col in actual_columns if any(term in col.lower() for term in 
-                ['field', 'column', 'variable', 'name', 'attribute', 'feature'])]
-    
-    # Identify data type column
-    type_cols = [col for col in actual_columns if any(term in col.lower() for term in 
-                ['type', 'datatype', 'data_type', 'format', 'dtype'])]
-    
-    # Identify description column
-    desc_cols = [col for col in actual_columns if any(term in col.lower() for term in 
-                ['desc', 'definition', 'meaning', 'explanation', 'info', 'comment', 'documentation'])]
-    
-    # If common naming patterns weren't found, try to identify columns by content analysis
-    if not name_cols and len(actual_columns) >= 1:
-        # Check first few rows to see if any column looks like it contains field names
-        # Field names typically have no spaces and follow naming conventions
-        for col in actual_columns:
-            sample_values = dict_data[col].head(5).astype(str)
-            # Check if values look like field names (no spaces, consistent format)
-            if all(not ' ' in val for val in sample_values if not pd.isna(val)):
-                name_cols.append(col)
-                break
-    
-    if not type_cols and len(actual_columns) >= 2:
-        # Data types are usually short strings like "int", "varchar", "text", etc.
-        for col in actual_columns:
-            if col in name_cols:
-                continue
-            sample_values = dict_data[col].head(5).astype(str)
-            # Check if values look like data types (short, consistent format)
-            if all(len(val) < 20 for val in sample_values if not pd.isna(val)):
-                type_cols.append(col)
-                break
-    
-    if not desc_cols and len(actual_columns) >= 3:
-        # Descriptions are usually longer text
-        for col in actual_columns:
-            if col in name_cols or col in type_cols:
-                continue
-            sample_values = dict_data[col].head(5).astype(str)
-            # Check if values look like descriptions (longer text)
-            if any(len(val) > 20 for val in sample_values if not pd.isna(val)):
-                desc_cols.append(col)
-                break
-    
-    # Default to positional fallbacks if we still couldn't identify columns
-    if not name_cols and len(actual_columns) >= 1:
-        name_cols = [actual_columns[0]]
-    
-    if not type_cols and len(actual_columns) >= 2:
-        type_cols = [actual_columns[1]]
-    
-    if not desc_cols and len(actual_columns) >= 3:
-        desc_cols = [actual_columns[2]]
-    
-    # Print what we identified for debugging
-    print(f"Identified name column: {name_cols[0] if name_cols else 'None'}")
-    print(f"Identified type column: {type_cols[0] if type_cols else 'None'}")
-    print(f"Identified description column: {desc_cols[0] if desc_cols else 'None'}")
-    
-    # Use the identified columns
-    name_col = name_cols[0] if name_cols else None
-    type_col = type_cols[0] if type_cols else None
-    desc_col = desc_cols[0] if desc_cols else None
-    
-    # Create a dictionary mapping field names to descriptions
-    if name_col:
-        for _, row in dict_data.iterrows():
-            field_name = str(row[name_col]).strip()
-            
-            # Skip empty field names
-            if not field_name or pd.isna(field_name):
-                continue
-            
-            # Get data type (if available)
-            data_type = ""
-            if type_col:
-                data_type = str(row[type_col]).strip() if not pd.isna(row[type_col]) else ""
-            
-            # Get description
-            description = ""
-            if desc_col:
-                description = str(row[desc_col]).strip() if not pd.isna(row[desc_col]) else ""
-            
-            # Store in dictionary
-            column_descriptions[field_name] = {
-                'data_type': data_type,
-                'description': description
-            }
-    
-    # Create formatted text as requested
-    formatted_lines = []
-    for field_name, details in column_descriptions.items():
-        data_type = details['data_type']
-        description = details['description']
-        
-        line = f"- {field_name}"
-        if data_type:
-            line += f": {data_type}"
-        if description:
-            if data_type:
-                line += f". {description}"
-            else:
-                line += f": {description}"
-        
-        formatted_lines.append(line)
-    
-    formatted_text = '\n'.join(formatted_lines)
-    
-    return column_descriptions, formatted_text
+# Read and process a dictionary file once per content hash, shared across reruns and sessions
+@st.cache_data(max_entries=16, show_spinner=False)
+def load_data_dictionary(fingerprint, _dictionary_file):
+    dict_data = pd.read_csv(_dictionary_file)
+    column_descriptions, formatted_text, table_descriptions = process_data_dictionary(dict_data)
+    return dict_data, column_descriptions, formatted_text, table_descriptions
+
+# Build the word index used to pick relevant dictionary entries, once per dictionary
+@st.cache_resource(max_entries=4, show_spinner=False)
+def get_dictionary_index(fingerprint, _column_descriptions):
+    return DictionaryIndex(_column_descriptions)
 
 # Upload Data Dictionary
 with col2:
@@ -182,363 +340,765 @@ with col2:
     dictionary_file = st.file_uploader("Choose a dictionary file", type=["csv"], key="dictionary_uploader")
     if dictionary_file is not None:
         try:
-            dict_data = pd.read_csv(dictionary_file)
+            file_id = getattr(dictionary_file, "file_id", None)
+            if file_id is not None and file_id == st.session_state.dictionary_file_id:
+                dictionary_fingerprint = st.session_state.dictionary_fingerprint
+            else:
+                dictionary_fingerprint = hashlib.sha256(dictionary_file.getvalue()).hexdigest()
+            
+            # Process dictionary into a more usable format (cached by file hash)
+            dict_data, column_descriptions, formatted_text, table_descriptions = load_data_dictionary(
+                dictionary_fingerprint, dictionary_file
+            )
             st.session_state.dictionary_data = dict_data
+            st.session_state.column_descriptions = column_descriptions
+            st.session_state.dictionary_formatted_text = formatted_text
+            st.session_state.table_descriptions = table_descriptions
+            st.session_state.dictionary_fingerprint = dictionary_fingerprint
+            st.session_state.dictionary_file_id = file_id
+            get_dictionary_index(dictionary_fingerprint, column_descriptions)
             st.success("Data dictionary successfully uploaded and read.")
+            if table_descriptions:
+                st.caption(f"{len(column_descriptions)} fields across {len(table_descriptions)} tables")
             st.write("### Data Dictionary Preview")
             st.dataframe(dict_data.head())
-            
-            # Process dictionary into a more usable format
-            st.session_state.column_descriptions, st.session_state.dictionary_formatted_text = process_data_dictionary(dict_data)
         except Exception as e:
             st.error(f"An error occurred while reading the dictionary file: {e}")
-def process_data_dictionary(dict_data):
-    column_descriptions = {}
-    
-    # Try to identify field name and description columns
-    field_cols = [col for col in dict_data.columns if any(term in col.lower() for term in ['field', 'column', 'variable', 'name'])]
-    desc_cols = [col for col in dict_data.columns if any(term in col.lower() for term in ['desc', 'definition', 'meaning', 'explanation', 'info'])]
-    
-    # If we found at least one field column and one description column
-    if field_cols and desc_cols:
-        field_col = field_cols[0]
-        desc_col = desc_cols[0]
-        
-        # Create a dictionary mapping field names to descriptions
-        for _, row in dict_data.iterrows():
-            field_name = str(row[field_col]).strip()
-            description = str(row[desc_col]).strip()
-            if field_name and description:
-                column_descriptions[field_name] = description
-    
-    return column_descriptions
 
 # Checkbox to analyze data
 analyze_data_checkbox = st.checkbox("Analyze CSV Data with AI")
+use_store_checkbox = st.checkbox(
+    "Compute analysis in the embedded SQL store",
+    help="Loads the upload into a local SQLite file with indexes and runs the analysis as SQL. "
+         "Slower than in-memory pandas for full scans, but the store persists across restarts."
+)
+approximate_checkbox = st.checkbox(
+    "Approximate answers on large data (sampled estimates)",
+    help="Computes breakdowns on a stratified sample sized to answer in about "
+         f"{SAMPLE_TARGET_SECONDS:g} seconds and reports 95% confidence intervals. "
+         "You can refine an answer to exact figures in the background afterwards."
+)
+precompute_checkbox = st.checkbox(
+    "Precompute the analysis in the background after upload",
+    value=True,
+    help="Starts the analysis and the dictionary mapping as soon as files are uploaded, "
+         "so the first question does not wait for them."
+)
+local_query_checkbox = st.checkbox(
+    "Answer with local queries (exact results)",
+    help="The model writes a read-only SQL query that runs locally on your data; only the small result is sent back to it."
+)
+stream_responses_checkbox = st.checkbox("Stream responses as they are generated", value=True)
+use_response_cache_checkbox = st.checkbox(
+    "Reuse cached answers for identical questions",
+    value=True,
+    help="Untick to force a fresh answer from the model for the next message."
+)
 
-# Function to convert NumPy types to Python native types for JSON serialization
-def convert_to_native_types(obj):
-    import numpy as np
-    if isinstance(obj, (np.integer, np.int64)):
-        return int(obj)
-    elif isinstance(obj, (np.floating, np.float64)):
-        return float(obj)
-    elif isinstance(obj, np.ndarray):
-        return obj.tolist()
-    elif isinstance(obj, dict):
-        return {k: convert_to_native_types(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_to_native_types(i) for i in obj]
-    else:
-        return obj
+# Memory-bounded LRU cache for analysis results, keyed on data and dictionary fingerprints.
+# Shared by every session's script thread, so access goes through a lock.
+class AnalysisCache:
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
 
-# Function to perform detailed data analysis
-def analyze_data_for_question(question, transaction_data, dictionary_data=None):
-    # Prepare data summary
-    data_stats = {}
-    
-    # Process all columns, not just a subset
-    all_columns = transaction_data.columns.tolist()
-    data_stats["all_columns"] = all_columns
-    data_stats["row_count"] = len(transaction_data)
-    
-    # Basic column type information
-    data_stats["column_types"] = {col: str(transaction_data[col].dtype) for col in all_columns}
-    
-    # Identify and process date columns
-    date_columns = []
-    for col in all_columns:
-        # Check if column name suggests a date
-        if any(date_term in col.lower() for date_term in ['date', 'time', 'day', 'month', 'year']):
-            try:
-                transaction_data[col] = pd.to_datetime(transaction_data[col], errors='coerce')
-                date_columns.append(col)
-                data_stats[f"{col}_is_date"] = True
-            except:
-                pass
-    
-    # Explicitly detect date columns by trying to convert them
-    for col in transaction_data.select_dtypes(include=['object']).columns:
-        if col not in date_columns:
-            # Try to convert to datetime
-            try:
-                temp_series = pd.to_datetime(transaction_data[col], errors='coerce')
-                # If >50% of values converted successfully, consider it a date
-                if temp_series.notna().sum() > len(transaction_data) * 0.5:
-                    transaction_data[col] = temp_series
-                    date_columns.append(col)
-                    data_stats[f"{col}_is_date"] = True
-            except:
-                pass
-    
-    # Get column summaries for numeric columns
-    for col in transaction_data.select_dtypes(include=['number']).columns:
-        data_stats[col] = {
-            "sum": float(transaction_data[col].sum()),
-            "mean": float(transaction_data[col].mean()),
-            "median": float(transaction_data[col].median()),
-            "max": float(transaction_data[col].max()),
-            "min": float(transaction_data[col].min()),
-            "std": float(transaction_data[col].std()),
-            "null_count": int(transaction_data[col].isna().sum()),
-            "null_percentage": float(transaction_data[col].isna().mean() * 100)
-        }
+    # Function to return the result under the first of keys that is cached. The whole lookup
+    # counts as one hit or one miss, however many keys it tries.
+    def get(self, *keys):
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.entries[key][0]
+            self.misses += 1
+            return None
+
+    # Function to check for a result without counting a hit or miss
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, value):
+        # Approximate the footprint of a result by its serialized size (outside the lock, it is the slow part)
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            # Evict least recently used results until we are back under the memory budget
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+# Share one cache across reruns and sessions
+@st.cache_resource
+def get_analysis_cache():
+    return AnalysisCache()
+
+# Fingerprint of the current dictionary (its file hash), so a new dictionary invalidates cached results
+def fingerprint_dictionary():
+    return st.session_state.dictionary_fingerprint or "no-dictionary"
+
+# Return cached analysis for the current upload, computing it on a miss
+def get_cached_analysis(question, transaction_data, dictionary_data=None):
+    cache = get_analysis_cache()
+    data_fingerprint = st.session_state.transaction_fingerprint
+    derived_data = st.session_state.derived_data
+    column_profiles = st.session_state.column_profiles
+    if data_fingerprint is None:
+        return analyze_data_for_question(question, transaction_data, dictionary_data, derived_data, column_profiles), False
     
-    # Get basic info about categorical columns
-    for col in transaction_data.select_dtypes(include=['object', 'category']).columns:
-        if col not in date_columns:
-            # Convert value_counts to regular Python dict with native types
-            value_counts = transaction_data[col].value_counts()
-            top_values = value_counts.head(10).to_dict()
-            top_values_native = {str(k): int(v) for k, v in top_values.items()}
-            
-            data_stats[col] = {
-                "unique_values": int(transaction_data[col].nunique()),
-                "top_values": top_values_native,
-                "null_count": int(transaction_data[col].isna().sum()),
-                "null_percentage": float(transaction_data[col].isna().mean() * 100)
-            }
-            
-            # For columns with few unique values (<20), include percentage distribution
-            if transaction_data[col].nunique() < 20:
-                percentage_dict = (value_counts / len(transaction_data) * 100).to_dict()
-                data_stats[col]["value_percentages"] = {str(k): float(v) for k, v in percentage_dict.items()}
+    key = analysis_cache_key()
+    # A background job that has finished moves its result into the cache first
+    try:
+        collect_background_analysis(key)
+    except Exception as e:
+        logger.warning("Background analysis failed, computing it again: %s", e)
+    # Estimates are cached apart from exact results, which take over once they exist
+    sample_key = key + ("sample",)
+    use_sample = st.session_state.append_stats is None and approximate_checkbox
+    cached = cache.get(key, sample_key) if use_sample else cache.get(key)
+    if cached is not None:
+        return cached, True
     
-    # Process date columns
-    for date_col in date_columns:
-        if transaction_data[date_col].notna().any():
-            # Basic date statistics
-            data_stats[date_col] = {
-                "min_date": transaction_data[date_col].min().strftime('%Y-%m-%d'),
-                "max_date": transaction_data[date_col].max().strftime('%Y-%m-%d'),
-                "null_count": int(transaction_data[date_col].isna().sum()),
-                "null_percentage": float(transaction_data[date_col].isna().mean() * 100)
-            }
-            
-            # Extract time components
-            transaction_data[f'year_{date_col}'] = transaction_data[date_col].dt.year
-            transaction_data[f'month_{date_col}'] = transaction_data[date_col].dt.month
-            transaction_data[f'day_{date_col}'] = transaction_data[date_col].dt.day
-            
-            # Create month-year string for readable grouping
-            transaction_data[f'month_year_{date_col}'] = transaction_data[date_col].dt.strftime('%Y-%m')
-            
-            # Monthly distribution
-            monthly_counts = transaction_data[f'month_year_{date_col}'].value_counts().sort_index().to_dict()
-            data_stats[f"{date_col}_monthly_distribution"] = {str(k): int(v) for k, v in monthly_counts.items()}
-            
-            # Find numeric columns that might represent values to aggregate
-            numeric_cols = transaction_data.select_dtypes(include=['number']).columns
-            value_cols = [col for col in numeric_cols if any(term in col.lower() for term in 
-                         ['amount', 'price', 'revenue', 'sales', 'cost', 'profit', 'qty', 'quantity', 'value'])]
-            
-            # If no obvious value columns, use all numeric columns
-            if not value_cols:
-                value_cols = numeric_cols
-            
-            # For each value column, create monthly aggregations
-            for value_col in value_cols:
-                # Monthly aggregation by sum
-                monthly_agg = transaction_data.groupby(f'month_year_{date_col}')[value_col].agg(['sum', 'mean', 'count']).reset_index()
-                monthly_agg.columns = [f'month_year_{date_col}', f'sum_{value_col}', f'avg_{value_col}', f'count_{value_col}']
-                
-                # Convert to list of dictionaries for easier JSON conversion
-                monthly_data = []
-                for _, row in monthly_agg.iterrows():
-                    entry = {}
-                    for col_name in monthly_agg.columns:
-                        entry[col_name] = convert_to_native_types(row[col_name])
-                    monthly_data.append(entry)
-                
-                data_stats[f"monthly_{date_col}_{value_col}"] = monthly_data
+    if st.session_state.append_stats is not None:
+        # Appended data: render the sections from the merged statistics instead of rescanning every row
+        with span("analysis from appended statistics"):
+            analysis = st.session_state.append_stats.to_analysis()
+            analysis["column_types"] = {col: column_profiles[col].dtype for col in analysis["all_columns"]}
+    elif use_sample:
+        with span("sampling plan"):
+            plan = get_sampling_plan(data_fingerprint, transaction_data, derived_data, column_profiles)
+        with span("analysis (sampled)"):
+            analysis, sampled = analyze_approximately(
+                question, transaction_data, derived_data, column_profiles, plan,
+                lambda: compute_exact_analysis(question, transaction_data, dictionary_data, derived_data,
+                                               column_profiles, get_exact_store())
+            )
+        cache.put(sample_key if sampled else key, analysis)
+        return analysis, False
+    else:
+        # Join the analysis the background worker is still precomputing instead of starting over
+        analysis = None
+        try:
+            analysis = collect_background_analysis(key, wait=True)
+        except Exception as e:
+            logger.warning("Background analysis failed, computing it again: %s", e)
+        if analysis is not None:
+            return analysis, False
+        analysis = compute_exact_analysis(question, transaction_data, dictionary_data, derived_data,
+                                          column_profiles, get_exact_store())
+    cache.put(key, analysis)
+    return analysis, False
+
+# Function to compute the exact analysis, as SQL aggregations when a store is given.
+# Reads no session state, so it can also run on the background worker.
+def compute_exact_analysis(question, transaction_data, dictionary_data, derived_data, column_profiles, store=None):
+    if store is not None:
+        # Same sections, computed as SQL aggregations over the indexed store
+        with span("analysis (SQL store)"):
+            return analyze_store(question, store, column_profiles)
+    with span("analysis (pandas)"):
+        return analyze_data_for_question(question, transaction_data, dictionary_data, derived_data, column_profiles)
+
+# Function to open the SQL store when exact analysis should run there, else None
+def get_exact_store():
+    if not use_store_checkbox:
+        return None
+    with span("open SQL store"):
+        return get_analytical_store(st.session_state.transaction_fingerprint, st.session_state.transaction_data,
+                                    st.session_state.derived_data, st.session_state.column_profiles)
+
+# Cache key of the exact analysis for the current upload, dictionary and backend, so a result
+# precomputed with pandas never stands in for one the user asked the SQL store to compute
+def analysis_cache_key():
+    backend = "sql store" if use_store_checkbox else "pandas"
+    return (st.session_state.transaction_fingerprint, fingerprint_dictionary(), backend)
+
+# Strata for sampled analysis, built once per upload and shared across reruns and sessions
+@st.cache_resource(max_entries=4)
+def get_sampling_plan(fingerprint, _data, _derived_data, _column_profiles):
+    return SamplingPlan(_data, _derived_data, _column_profiles)
+
+# Background jobs (precomputation after upload, "refine to exact"), shared across sessions.
+# Exact analyses are keyed by analysis cache key, so sessions asking for the same upload share one job.
+@st.cache_resource
+def get_background_jobs():
+    return JobRunner()
+
+# Function to take the result of the background job for key once it has finished, or to wait
+# for it when asked and it is already running. A job still queued behind other sessions' work
+# is let go instead, so the caller computes inline rather than waiting out the queue.
+# Returns None when there is no job, it is queued or it was cancelled; errors are raised.
+def collect_background_job(key, wait=False):
+    runner = get_background_jobs()
+    job = runner.get(key)
+    if job is None or not (wait or job.done()):
+        return None
+    if not job.done() and job.started is None:
+        # Cancelled unless another session still waits on it
+        runner.release(key, st.session_state.session_id)
+        return None
+    try:
+        if job.done():
+            return job.result()
+        with span("await background job", job=job.label), \
+                st.spinner(f"Finishing the {job.label} already running in the background ({job.describe()})..."):
+            return job.result()
+    except JobCancelled:
+        return None
+    finally:
+        runner.discard(job)
+
+# Function to move a finished background analysis into the analysis cache
+def collect_background_analysis(key, wait=False):
+    analysis = collect_background_job(key, wait)
+    if analysis is not None:
+        get_analysis_cache().put(key, analysis)
+    return analysis
+
+# Function to start computing the exact analysis for the pending refinement in the background.
+# Joins the precomputation for the same upload when that is still running.
+def start_refinement():
+    refinement = st.session_state.refinement
+    get_background_jobs().submit(
+        refinement["key"], st.session_state.session_id, "exact analysis", compute_exact_analysis,
+        refinement["question"], st.session_state.transaction_data, st.session_state.dictionary_data,
+        st.session_state.derived_data, st.session_state.column_profiles, get_exact_store()
+    )
+
+# Function to check whether the exact analysis for the pending refinement is ready. A finished
+# job's result moves into the analysis cache, where later questions pick it up too.
+def refinement_ready():
+    refinement = st.session_state.refinement
+    if refinement is None:
+        return False
+    if refinement["key"] != analysis_cache_key():
+        # The data or dictionary changed since the estimate was given
+        get_background_jobs().release(refinement["key"], st.session_state.session_id)
+        st.session_state.refinement = None
+        return False
+    try:
+        collect_background_analysis(refinement["key"])
+    except Exception as e:
+        st.session_state.refinement = None
+        st.error(f"Could not compute the exact figures: {e}")
+        return False
+    return refinement["key"] in get_analysis_cache()
+
+# Share one on-disk response cache across reruns and sessions
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache()
+
+# Function to map transaction columns to dictionary fields. The name index is rebuilt only when
+# the dictionary changes and the mapping only when the data or dictionary changes; a mapping
+# precomputed in the background after upload is used when there is one.
+def get_column_mapping(columns):
+    dictionary_fingerprint = fingerprint_dictionary()
+    mapping_key = (st.session_state.transaction_fingerprint, dictionary_fingerprint, tuple(columns))
+    if st.session_state.column_mapping_key == mapping_key:
+        return st.session_state.column_mapping
     
-            # Look for potential category columns to do cross analysis
-            categorical_cols = [col for col in transaction_data.select_dtypes(include=['object', 'category']).columns 
-                               if col not in date_columns and transaction_data[col].nunique() < 20]
-            
-            # For each categorical column, create aggregations
-            for cat_col in categorical_cols:
-                # For each value column, aggregate by category
-                for value_col in value_cols:
-                    category_agg = transaction_data.groupby(cat_col)[value_col].agg(['sum', 'mean', 'count']).reset_index()
-                    category_agg.columns = [cat_col, f'sum_{value_col}', f'avg_{value_col}', f'count_{value_col}']
-                    
-                    # Convert to list of dictionaries for easier JSON conversion
-                    category_data = []
-                    for _, row in category_agg.iterrows():
-                        entry = {}
-                        for col_name in category_agg.columns:
-                            entry[col_name] = convert_to_native_types(row[col_name])
-                        category_data.append(entry)
-                    
-                    data_stats[f"{cat_col}_{value_col}_analysis"] = category_data
+    precomputed = None
+    try:
+        precomputed = collect_background_job(("column mapping",) + mapping_key, wait=True)
+    except Exception as e:
+        logger.warning("Background column mapping failed, matching again: %s", e)
+    if precomputed is not None:
+        st.session_state.column_matcher, st.session_state.column_mapping = precomputed
+        st.session_state.column_matcher_key = dictionary_fingerprint
+    else:
+        if st.session_state.column_matcher_key != dictionary_fingerprint:
+            st.session_state.column_matcher = ColumnMatcher(st.session_state.column_descriptions.keys())
+            st.session_state.column_matcher_key = dictionary_fingerprint
+        st.session_state.column_mapping = st.session_state.column_matcher.match(columns)
+    st.session_state.column_mapping_key = mapping_key
+    return st.session_state.column_mapping
+
+# Function to build the dictionary name index and map columns to it. Reads no session state,
+# so it can run on the background worker.
+def match_columns(dictionary_fields, columns):
+    matcher = ColumnMatcher(dictionary_fields)
+    return matcher, matcher.match(columns)
+
+# Open the embedded SQL store for an upload (built on first use), shared across reruns and sessions
+@st.cache_resource(max_entries=4, show_spinner="Loading the data into the embedded SQL store...")
+def get_analytical_store(fingerprint, _data, _derived_data, _column_profiles):
+    return open_store(fingerprint, _data, _derived_data, _column_profiles)
+
+# Function to get the model's reply as plain text without rendering it (used for intermediate steps)
+def request_model_text(prompt):
+    response_cache = get_response_cache()
+    model_name = getattr(model, "model_name", "unknown")
+    if use_response_cache_checkbox:
+        with span("response cache lookup"):
+            cached_response = response_cache.get(model_name, prompt)
+        if cached_response is not None:
+            return cached_response
+    with span("model call", prompt_tokens=estimate_tokens(prompt)):
+        text = llm_client.generate_content(prompt).text
+    if text:
+        response_cache.put(model_name, prompt, text)
+    return text
+
+# Function to get the model's answer and render it, token by token when streaming is enabled.
+# Identical prompts are answered from the local response cache unless the user opts out.
+# Returns the full text and the time to first token.
+def generate_response(prompt):
+    response_cache = get_response_cache()
+    model_name = getattr(model, "model_name", "unknown")
+    request_start = time.perf_counter()
+    if use_response_cache_checkbox:
+        with span("response cache lookup"):
+            cached_response = response_cache.get(model_name, prompt)
+        if cached_response is not None:
+            with st.chat_message("assistant"):
+                st.markdown(cached_response)
+                st.caption("Answered from the local response cache")
+            return cached_response, time.perf_counter() - request_start
     
-    # Add correlation matrix for numeric columns
-    if len(transaction_data.select_dtypes(include=['number']).columns) > 1:
-        corr_matrix = transaction_data.select_dtypes(include=['number']).corr().round(2)
-        corr_data = {}
-        for col1 in corr_matrix.columns:
-            corr_data[col1] = {}
-            for col2 in corr_matrix.columns:
-                corr_data[col1][col2] = float(corr_matrix.loc[col1, col2])
-        data_stats["correlation_matrix"] = corr_data
+    # Calls go through the shared client for timeouts, retries and the global concurrency limit
+    if stream_responses_checkbox:
+        stream = ResponseStream(llm_client, prompt)
+        with span("model call (streamed and rendered)", prompt_tokens=estimate_tokens(prompt)) as model_span:
+            with st.chat_message("assistant"):
+                st.write_stream(stream)
+            if model_span is not None:
+                model_span.attrs["first_token_seconds"] = stream.first_token_seconds
+        bot_response, first_token_seconds = stream.text, stream.first_token_seconds
+    else:
+        with span("model call", prompt_tokens=estimate_tokens(prompt)):
+            response = llm_client.generate_content(prompt)
+        first_token_seconds = time.perf_counter() - request_start
+        bot_response = response.text
+        with span("render response"):
+            st.chat_message("assistant").markdown(bot_response)
     
-    # Make sure all values are JSON serializable
-    return convert_to_native_types(data_stats)
+    if bot_response:
+        with span("response cache store"):
+            response_cache.put(model_name, prompt, bot_response)
+    return bot_response, first_token_seconds
+
+# Function to start precomputing the exact analysis and the dictionary mapping for the current
+# upload, so the first question finds them ready or joins the jobs already running. Jobs for an
+# upload or dictionary this session has replaced are released, which cancels them unless
+# another session is waiting on the same result.
+def schedule_precompute():
+    runner = get_background_jobs()
+    wanted = {}
+    if (precompute_checkbox and st.session_state.transaction_data is not None
+            and st.session_state.append_stats is None):
+        columns = st.session_state.transaction_data.columns.tolist()
+        mapping_key = (st.session_state.transaction_fingerprint, fingerprint_dictionary(), tuple(columns))
+        # The mapping is queued first since it takes a fraction of the analysis time
+        if st.session_state.column_descriptions and st.session_state.column_mapping_key != mapping_key:
+            wanted[("column mapping",) + mapping_key] = (
+                "dictionary mapping", match_columns, list(st.session_state.column_descriptions.keys()), columns
+            )
+        key = analysis_cache_key()
+        try:
+            collect_background_analysis(key)
+        except Exception as e:
+            st.session_state.precompute_failed_key = key
+            st.warning(f"The background analysis failed; it runs when you ask a question instead: {e}")
+        if key not in get_analysis_cache() and key != st.session_state.precompute_failed_key:
+            wanted[key] = (
+                "analysis", compute_exact_analysis, None, st.session_state.transaction_data,
+                st.session_state.dictionary_data, st.session_state.derived_data, st.session_state.column_profiles,
+                get_exact_store()
+            )
+    for key in st.session_state.precompute_keys:
+        if key not in wanted:
+            runner.release(key, st.session_state.session_id)
+    for key, (label, fn, *args) in wanted.items():
+        runner.submit(key, st.session_state.session_id, label, fn, *args)
+    st.session_state.precompute_keys = list(wanted)
+
+# Function to show a background job's progress, rerunning the app once it has finished
+@st.fragment(run_every=1.0)
+def background_job_status(job, message):
+    if job.done():
+        st.rerun(scope="app")
+    st.caption(f"{message}: {job.describe()}")
 
-# Capture input and generate response
-if user_input := st.chat_input("Type your message here..."):
-    st.session_state.chat_history.append(("user", user_input))
-    st.chat_message("user").markdown(user_input)
+try:
+    schedule_precompute()
+except Exception as e:
+    st.warning(f"Could not start the background precomputation: {e}")
+precompute_job = (get_background_jobs().get(analysis_cache_key())
+                  if analysis_cache_key() in st.session_state.precompute_keys else None)
+if precompute_job is not None:
+    background_job_status(precompute_job, "Precomputing the analysis in the background")
+
+# Show model client load and shared dataset usage in the sidebar
+if llm_client is not None:
+    with st.sidebar.expander("Model client metrics"):
+        st.json(llm_client.metrics.snapshot())
+with st.sidebar.expander("Shared datasets"):
+    st.json(dataset_registry.stats())
+
+# Capture input and generate response. Once a "refine to exact" job has finished, its question
+# is answered again from the exact analysis and that answer replaces the estimated one.
+user_input = st.chat_input("Type your message here...")
+refining = None
+if not user_input and refinement_ready():
+    refining = st.session_state.refinement
+    st.session_state.refinement = None
+    user_input = refining["question"]
+if user_input:
+    if refining is None:
+        st.session_state.chat_history.append(("user", user_input))
+        st.chat_message("user").markdown(user_input)
+    else:
+        st.caption(f"Exact figures are ready. Answering again: {user_input}")
     
     if model:
-        try:
-            if st.session_state.transaction_data is not None and analyze_data_checkbox:
-                # Perform data analysis
-                detailed_analysis = analyze_data_for_question(
-                    user_input, 
-                    st.session_state.transaction_data,
-                    st.session_state.dictionary_data
-                )
-                
-                # Get column mappings between transaction data and dictionary
-                transaction_columns = set(st.session_state.transaction_data.columns.tolist())
-                dictionary_columns = set(st.session_state.column_descriptions.keys())
-                
-                # Find exact matches
-                exact_matches = transaction_columns.intersection(dictionary_columns)
-                
-                # Find potential fuzzy matches for remaining columns
-                unmatched_transaction_cols = transaction_columns - exact_matches
-                unmatched_dictionary_cols = dictionary_columns - exact_matches
-                
-                fuzzy_matches = {}
-                for t_col in unmatched_transaction_cols:
-                    # Try simple normalization (lowercase, remove spaces, underscores)
-                    normalized_t_col = t_col.lower().replace(' ', '').replace('_', '')
+        with request_trace("chat turn"):
+            try:
+                has_transaction_data = (st.session_state.transaction_data is not None
+                                        or st.session_state.streaming_analysis is not None)
+                if (has_transaction_data and analyze_data_checkbox and local_query_checkbox
+                        and st.session_state.transaction_data is not None):
+                    # Step 1: the model writes a query from the schema alone; no data leaves the machine
+                    query_engine = QueryEngine(get_analytical_store(
+                        st.session_state.transaction_fingerprint,
+                        st.session_state.transaction_data,
+                        st.session_state.derived_data,
+                        st.session_state.column_profiles
+                    ))
+                    # Keep the schema and dictionary within the prompt budget, most relevant columns first
+                    columns = st.session_state.transaction_data.columns.tolist()
+                    column_scores = score_columns(user_input, columns, st.session_state.column_descriptions)
+                    context_budget = PROMPT_TOKEN_BUDGET - PROMPT_TEMPLATE_TOKENS - estimate_tokens(user_input)
+                    with span("describe schema"):
+                        schema_info = query_engine.describe_schema(
+                            st.session_state.column_profiles, column_scores,
+                            token_budget=context_budget - int(context_budget * DICTIONARY_SHARE)
+                        )
+                    dictionary_info = "No data dictionary provided."
+                    if st.session_state.column_descriptions:
+                        dictionary_info = build_dictionary_context(
+                            user_input,
+                            get_dictionary_index(fingerprint_dictionary(), st.session_state.column_descriptions),
+                            column_scores, get_column_mapping(columns), int(context_budget * DICTIONARY_SHARE)
+                        )
+                    query_prompt = f"""
+                    You translate questions about a dataset into one SQLite query.
                     
-                    for d_col in unmatched_dictionary_cols:
-                        normalized_d_col = d_col.lower().replace(' ', '').replace('_', '')
-                        
-                        # Check for containment in either direction
-                        if normalized_t_col in normalized_d_col or normalized_d_col in normalized_t_col:
-                            fuzzy_matches[t_col] = d_col
-                            break
-                
-                # Prepare transaction data column info with dictionary linkage
-                transaction_info = "Transaction Data Information:\n"
-                transaction_info += f"- Total Records: {len(st.session_state.transaction_data)}\n\n"
-                
-                # Add column information with mappings to dictionary
-                transaction_info += "Column Information (with dictionary mappings):\n"
-                for col in st.session_state.transaction_data.columns:
-                    col_type = str(st.session_state.transaction_data[col].dtype)
+                    User Question: {user_input}
+                    
+                    {schema_info}
                     
-                    # Check for dictionary mapping (exact or fuzzy)
-                    dict_col = None
-                    mapping_type = ""
+                    Data Dictionary Information:
+                    {dictionary_info}
                     
-                    if col in exact_matches:
-                        dict_col = col
-                        mapping_type = "(exact match)"
-                    elif col in fuzzy_matches:
-                        dict_col = fuzzy_matches[col]
-                        mapping_type = "(fuzzy match)"
+                    Reply with a single read-only SQLite SELECT statement and nothing else.
+                    Aggregate in SQL and return at most {QUERY_MAX_ROWS} rows, using ORDER BY and LIMIT for rankings.
+                    Quote column names with double quotes. Use strftime for date bucketing.
+                    """
+                    query_sql = None
+                    query_result = None
+                    try:
+                        with span("query generation"):
+                            query_sql = extract_sql(request_model_text(query_prompt))
+                        # Step 2: run it locally inside the sandbox (read-only, row and time limits)
+                        with span("query execution"):
+                            query_result = query_engine.execute(query_sql)
+                    except QueryError as e:
+                        query_error = str(e)
                     
-                    if dict_col:
-                        col_info = st.session_state.column_descriptions.get(dict_col, {})
-                        col_description = col_info.get('description', "No description available") if isinstance(col_info, dict) else "No description available"
-                        col_data_type = col_info.get('data_type', "") if isinstance(col_info, dict) else ""
+                    with st.expander("Local query", expanded=query_result is None):
+                        if query_sql:
+                            st.code(query_sql, language="sql")
+                        if query_result is not None:
+                            st.caption(
+                                f"{len(query_result.frame)} rows{' (truncated)' if query_result.truncated else ''} "
+                                f"in {query_result.seconds:.3f}s"
+                            )
+                            st.dataframe(query_result.frame)
+                        else:
+                            st.error(query_error)
+                    
+                    if query_result is not None:
+                        # Step 3: the model answers from the exact query result
+                        prompt = f"""
+                        You are an intelligent data analyst assistant. Answer the user's question using the result of a query that was run on their full dataset.
+                        
+                        User Question: {user_input}
                         
-                        # Use the dictionary data type if available, otherwise use the pandas dtype
-                        display_type = col_data_type if col_data_type else col_type
-                        transaction_info += f"- {col} {mapping_type} (Type: {display_type}): {col_description}\n"
+                        Query:
+                        ```sql
+                        {query_sql}
+                        ```
+                        
+                        Query Result:
+                        ```json
+                        {query_result.to_prompt_json()}
+                        ```
+                        
+                        Important Instructions:
+                        1. Answer directly and concisely from the query result; its figures are exact
+                        2. If the result is marked truncated, say that only part of it is shown
+                        3. If the query does not fully answer the question, explain what is missing
+                        4. Format currency values with appropriate symbols if applicable
+                        """
+                        bot_response, first_token_seconds = generate_response(prompt)
+                        logger.info(
+                            "Local query prompt: %d est. tokens, %d result rows, query time %.3fs, time to first token %.2fs",
+                            estimate_tokens(prompt), len(query_result.frame), query_result.seconds, first_token_seconds or 0.0
+                        )
                     else:
-                        transaction_info += f"- {col} (Type: {col_type}): No dictionary mapping available\n"
-                
-                # Add dictionary context using the formatted text
-                dictionary_info = "Data Dictionary Information:\n"
-                if st.session_state.dictionary_formatted_text:
-                    dictionary_info += st.session_state.dictionary_formatted_text
-                else:
-                    dictionary_info += "No data dictionary provided.\n"
-                
-                # Identify important metrics and insights from the analysis
-                insights = "Key Insights from Data Analysis:\n"
-                
-                # Check for date columns with time series data
-                time_series_data = [key for key in detailed_analysis.keys() if key.startswith("monthly_")]
-                if time_series_data:
-                    insights += "- Time series data is available for temporal analysis.\n"
-                
-                # Check for correlations
-                if "correlation_matrix" in detailed_analysis:
-                    # Find strongest correlations
-                    corr_matrix = detailed_analysis["correlation_matrix"]
-                    strong_correlations = []
-                    for col1 in corr_matrix:
-                        for col2 in corr_matrix[col1]:
-                            if col1 != col2 and abs(corr_matrix[col1][col2]) > 0.7:
-                                strong_correlations.append((col1, col2, corr_matrix[col1][col2]))
+                        bot_response = f"I could not answer this with a local query: {query_error}"
+                        st.chat_message("assistant").markdown(bot_response)
+                    st.session_state.chat_history.append(("assistant", bot_response))
+                elif has_transaction_data and analyze_data_checkbox:
+                    if st.session_state.streaming_analysis is not None:
+                        # Statistics were already accumulated while streaming the upload
+                        detailed_analysis = st.session_state.streaming_analysis
+                        st.caption("Using streamed statistics (medians and high-cardinality counts are approximate)")
+                    else:
+                        # Perform data analysis (reused from cache when the data has not changed)
+                        with span("analysis"):
+                            detailed_analysis, cache_hit = get_cached_analysis(
+                                user_input, 
+                                st.session_state.transaction_data,
+                                st.session_state.dictionary_data
+                            )
+                        analysis_cache = get_analysis_cache()
+                        st.caption(
+                            f"Analysis cache {'hit' if cache_hit else 'miss'} "
+                            f"(hits: {analysis_cache.hits}, misses: {analysis_cache.misses})"
+                        )
+                        if "sampling_notes" in detailed_analysis:
+                            sampling_notes = detailed_analysis["sampling_notes"]
+                            st.caption(
+                                f"Estimated from a stratified sample of {sampling_notes['sampled_rows']:,} of "
+                                f"{sampling_notes['population_rows']:,} rows (95% confidence intervals)"
+                            )
                     
-                    if strong_correlations:
-                        insights += "- Strong correlations detected between:\n"
-                        for col1, col2, corr in strong_correlations[:3]:  # Show top 3
-                            insights += f"  * {col1} and {col2}: {corr:.2f}\n"
-                
-                # Generate AI response based on user input and data
-                prompt = f"""
-                You are an intelligent data analyst assistant. Answer the following question using the provided data:
-                
-                User Question: {user_input}
-                
-                {transaction_info}
-                
-                {dictionary_info}
-                
-                {insights}
-                
-                Detailed Analysis Data:
-                ```json
-                {json.dumps(detailed_analysis, indent=2)}
-                ```
-                
-                Important Instructions:
-                1. Provide a direct and concise answer based solely on the data provided
-                2. Reference specific data points, trends, or patterns from the analysis to support your answer
-                3. If you see time series data, discuss any trends over time
-                4. Use the data dictionary definitions to correctly interpret columns
-                5. If there are apparent relationships between variables, mention them
-                6. If you cannot answer the question with the available data, explain exactly what data is missing
-                7. Present any interesting insights you find, even if not directly asked
-                8. If appropriate, suggest a visualization that would help illustrate your answer
-                9. Format currency values with appropriate symbols if applicable
-                10. Be precise with numbers - use exact figures from the data
-                
-                Your answer should be thorough yet concise, focusing on the most important insights related to the user's question.
-                """
-                
-                # Generate response with the comprehensive prompt
-                response = model.generate_content(prompt)
-                bot_response = response.text
-                
-                st.session_state.chat_history.append(("assistant", bot_response))
-                st.chat_message("assistant").markdown(bot_response)
-            elif not analyze_data_checkbox:
-                bot_response = "Data analysis is disabled. Please select the 'Analyze CSV Data with AI' checkbox to enable analysis."
-                st.session_state.chat_history.append(("assistant", bot_response))
-                st.chat_message("assistant").markdown(bot_response)
-            elif st.session_state.transaction_data is None:
-                bot_response = "Please upload a transaction CSV file first, then ask me to analyze it."
-                st.session_state.chat_history.append(("assistant", bot_response))
-                st.chat_message("assistant").markdown(bot_response)
-            else:
-                response = model.generate_content(user_input)
-                bot_response = response.text
-                st.session_state.chat_history.append(("assistant", bot_response))
-                st.chat_message("assistant").markdown(bot_response)
-        except Exception as e:
-            st.error(f"An error occurred while generating the response: {e}")
-            st.error(f"Error details: {type(e).__name__}")
+                    # Get column mappings between transaction data and dictionary (cached per data/dictionary pair)
+                    with span("column mapping"):
+                        column_mapping = get_column_mapping(detailed_analysis["all_columns"])
+                        # In multi-table dictionaries, prefer entries from the table that matches this upload
+                        dictionary_table = pick_table(st.session_state.table_descriptions, detailed_analysis["all_columns"])
+                    
+                    with span("prompt assembly"):
+                        # Everything below shares one token budget, so every part is ranked by
+                        # the same column relevance scores
+                        column_scores = score_columns(
+                            user_input, detailed_analysis["all_columns"], st.session_state.column_descriptions
+                        )
+                        
+                        # Identify important metrics and insights from the analysis
+                        insights = "Key Insights from Data Analysis:\n"
+                        
+                        # Tell the model which figures are sampled estimates
+                        sampling_notes = detailed_analysis.get("sampling_notes")
+                        if sampling_notes:
+                            insights += (
+                                f"- Breakdown figures are estimates from a stratified sample of {sampling_notes['sampled_rows']} "
+                                f"of {sampling_notes['population_rows']} rows; the *_ci95 fields hold 95% confidence intervals. "
+                                "Say that these figures are estimates and give the interval for key numbers.\n"
+                            )
+                        
+                        # Check for date columns with time series data
+                        time_series_data = [key for key in detailed_analysis.keys() if key.startswith("monthly_")]
+                        if time_series_data:
+                            insights += "- Time series data is available for temporal analysis.\n"
+                        
+                        # Check for correlations
+                        if "correlation_matrix" in detailed_analysis:
+                            # Find strongest correlations
+                            corr_matrix = detailed_analysis["correlation_matrix"]
+                            strong_correlations = []
+                            for col1 in corr_matrix:
+                                for col2 in corr_matrix[col1]:
+                                    if col1 != col2 and abs(corr_matrix[col1][col2]) > 0.7:
+                                        strong_correlations.append((col1, col2, corr_matrix[col1][col2]))
+                            
+                            if strong_correlations:
+                                insights += "- Strong correlations detected between:\n"
+                                for col1, col2, corr in strong_correlations[:3]:  # Show top 3
+                                    insights += f"  * {col1} and {col2}: {corr:.2f}\n"
+                        
+                        context_budget = PROMPT_TOKEN_BUDGET - PROMPT_TEMPLATE_TOKENS - estimate_tokens(user_input + insights)
+                        
+                        # Prepare transaction data column info with dictionary linkage
+                        transaction_info = "Transaction Data Information:\n"
+                        transaction_info += f"- Total Records: {detailed_analysis['row_count']}\n\n"
+                        
+                        # Add column information with mappings to dictionary
+                        transaction_info += "Column Information (with dictionary mappings):\n"
+                        column_lines = []
+                        for col in detailed_analysis["all_columns"]:
+                            col_type = detailed_analysis["column_types"][col]
+                            
+                            # Role and cardinality from the upload-time column profile
+                            role_info = ""
+                            column_profiles = st.session_state.column_profiles
+                            if column_profiles and col in column_profiles:
+                                profile = column_profiles[col]
+                                role_info = f", Role: {profile.role}"
+                                if profile.unique_count is not None:
+                                    role_info += f", {profile.unique_count} distinct"
+                            
+                            # Check for dictionary mapping (exact or fuzzy)
+                            dict_col = None
+                            mapping_type = ""
+                            
+                            if col in column_mapping:
+                                dict_col, match_kind = column_mapping[col]
+                                mapping_type = f"({match_kind} match)"
+                            
+                            if dict_col:
+                                col_info = lookup_description(
+                                    st.session_state.column_descriptions,
+                                    st.session_state.table_descriptions,
+                                    dict_col,
+                                    dictionary_table
+                                ) or {}
+                                col_description = col_info.get('description', "No description available") if isinstance(col_info, dict) else "No description available"
+                                col_data_type = col_info.get('data_type', "") if isinstance(col_info, dict) else ""
+                                
+                                # Use the dictionary data type if available, otherwise use the pandas dtype
+                                display_type = col_data_type if col_data_type else col_type
+                                column_lines.append((col, f"- {col} {mapping_type} (Type: {display_type}{role_info}): {col_description}"))
+                            else:
+                                column_lines.append((col, f"- {col} (Type: {col_type}{role_info}): No dictionary mapping available"))
+                        kept_lines, omitted_columns = select_lines(
+                            column_lines, column_scores, int(context_budget * COLUMN_INFO_SHARE) - 40
+                        )
+                        if omitted_columns:
+                            kept_lines.append(f"- {omitted_columns} more columns not related to this question are omitted")
+                        transaction_info += "\n".join(kept_lines) + "\n"
+                        
+                        # Add the dictionary entries mapped to columns or related to the question
+                        dictionary_info = "Data Dictionary Information:\n"
+                        if st.session_state.column_descriptions:
+                            dictionary_info += build_dictionary_context(
+                                user_input,
+                                get_dictionary_index(fingerprint_dictionary(), st.session_state.column_descriptions),
+                                column_scores, column_mapping, int(context_budget * DICTIONARY_SHARE)
+                            )
+                        else:
+                            dictionary_info += "No data dictionary provided.\n"
+                        
+                        # Send only the analysis sections relevant to the question, in whatever budget is left
+                        context_tokens = PROMPT_TEMPLATE_TOKENS + estimate_tokens(
+                            user_input + transaction_info + dictionary_info + insights
+                        )
+                        with span("payload selection", sections=len(detailed_analysis)):
+                            analysis_json, payload_report = build_analysis_payload(
+                                user_input,
+                                detailed_analysis,
+                                st.session_state.column_descriptions,
+                                token_budget=max(PROMPT_TOKEN_BUDGET - context_tokens, 0),
+                                column_scores=column_scores
+                            )
+                        
+                        # Generate AI response based on user input and data
+                        prompt = f"""
+                        You are an intelligent data analyst assistant. Answer the following question using the provided data:
+                        
+                        User Question: {user_input}
+                        
+                        {transaction_info}
+                        
+                        {dictionary_info}
+                        
+                        {insights}
+                        
+                        Detailed Analysis Data:
+                        ```json
+                        {analysis_json}
+                        ```
+                        
+                        Important Instructions:
+                        1. Provide a direct and concise answer based solely on the data provided
+                        2. Reference specific data points, trends, or patterns from the analysis to support your answer
+                        3. If you see time series data, discuss any trends over time
+                        4. Use the data dictionary definitions to correctly interpret columns
+                        5. If there are apparent relationships between variables, mention them
+                        6. If you cannot answer the question with the available data, explain exactly what data is missing
+                        7. Present any interesting insights you find, even if not directly asked
+                        8. If appropriate, suggest a visualization that would help illustrate your answer
+                        9. Format currency values with appropriate symbols if applicable
+                        10. Be precise with numbers - use exact figures from the data
+                        
+                        Your answer should be thorough yet concise, focusing on the most important insights related to the user's question.
+                        """
+                    
+                    # Generate response with the comprehensive prompt
+                    bot_response, first_token_seconds = generate_response(prompt)
+                    logger.info(
+                        "Analysis prompt: %d est. tokens sent (full analysis would be %d), %d sections sent, "
+                        "%d omitted, time to first token %.2fs",
+                        estimate_tokens(prompt), payload_report["full_tokens"] + context_tokens,
+                        payload_report["sections_sent"], payload_report["sections_omitted"],
+                        first_token_seconds or 0.0
+                    )
+                    
+                    if refining is not None:
+                        # The exact answer replaces the estimated one in place
+                        st.session_state.chat_history[refining["history_index"]] = ("assistant", bot_response)
+                        st.rerun()
+                    else:
+                        st.session_state.chat_history.append(("assistant", bot_response))
+                        if "sampling_notes" in detailed_analysis:
+                            st.session_state.refinement = {
+                                "question": user_input,
+                                "key": analysis_cache_key(),
+                                "history_index": len(st.session_state.chat_history) - 1,
+                            }
+                elif not analyze_data_checkbox:
+                    bot_response = "Data analysis is disabled. Please select the 'Analyze CSV Data with AI' checkbox to enable analysis."
+                    st.session_state.chat_history.append(("assistant", bot_response))
+                    st.chat_message("assistant").markdown(bot_response)
+                elif not has_transaction_data:
+                    bot_response = "Please upload a transaction CSV file first, then ask me to analyze it."
+                    st.session_state.chat_history.append(("assistant", bot_response))
+                    st.chat_message("assistant").markdown(bot_response)
+                else:
+                    bot_response, first_token_seconds = generate_response(user_input)
+                    logger.info("Chat prompt: time to first token %.2fs", first_token_seconds or 0.0)
+                    st.session_state.chat_history.append(("assistant", bot_response))
+            except Exception as e:
+                st.error(f"An error occurred while generating the response: {e}")
+                st.error(f"Error details: {type(e).__name__}")
     else:
         st.warning("Please configure the Gemini API Key to enable chat responses.")
+
+# Offer to refine the latest estimated answer, then poll the background job until it finishes
+if st.session_state.refinement is not None:
+    refinement_job = get_background_jobs().get(st.session_state.refinement["key"])
+    if refinement_job is None:
+        if st.button("Refine to exact", help="Computes the exact figures in the background; "
+                                             "the answer above is replaced when they are ready."):
+            start_refinement()
+            st.rerun()
+    elif refinement_job is not precompute_job:
+        background_job_status(refinement_job, "Computing exact figures in the background")
+    else:
+        st.caption("The answer above is replaced once the precomputed exact figures are ready.")
+
+# Timing breakdown of the latest traced request, plus exports of the recent ones
+if trace_requests_checkbox and st.session_state.traces:
+    last_trace = st.session_state.traces[-1]
+    with st.expander(f"Timing breakdown: {last_trace.name} ({last_trace.total_seconds() * 1000:.0f} ms)"):
+        st.dataframe(pd.DataFrame(last_trace.rows()), hide_index=True)
+    with st.sidebar.expander("Export traces"):
+        st.caption(f"{len(st.session_state.traces)} recent requests")
+        st.download_button("Download JSON", traces_to_json(st.session_state.traces),
+                           file_name="traces.json", mime="application/json")
+        st.download_button("Download Chrome trace", traces_to_chrome(st.session_state.traces),
+                           file_name="traces.chrome.json", mime="application/json",
+                           help="Open in chrome://tracing or https://ui.perfetto.dev")
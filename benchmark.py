@@ -0,0 +1,503 @@
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from dictionary import ColumnMatcher, process_data_dictionary
+from analysis import aggregate_by_key, analyze_data_for_question, convert_to_native_types, profile_upload
+from ingest import append_rows, build_append_stats, optimize_dtypes
+from llm import FakeModel, LLMClient
+from prompts import DICTIONARY_SHARE, PROMPT_TOKEN_BUDGET, DictionaryIndex, build_analysis_payload, build_dictionary_context, score_columns
+from sampling import SamplingPlan, analyze_approximately, analyze_sample
+from store import STORE_TABLE, analyze_store, open_store
+from synthetic import make_data_dictionary, make_transaction_data
+
+# Function to build a synthetic transaction frame for benchmarking
+def make_transactions(rows=200_000, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp("2023-01-01") + pd.to_timedelta(rng.integers(0, 730, rows), unit="D")
+    return pd.DataFrame({
+        "order_date": dates.strftime("%Y-%m-%d"),
+        "region": rng.choice(["North", "South", "East", "West"], rows),
+        "product_category": rng.choice(["A", "B", "C", "D", "E", "F"], rows),
+        "sales_amount": rng.gamma(2.0, 50.0, rows).round(2),
+        "quantity": rng.integers(1, 20, rows),
+        "customer_id": rng.integers(1, 50_000, rows),
+    })
+
+# Regression check: repeated questions must not grow the session frame
+def bench_repeated_questions(rows=200_000, questions=20):
+    data = make_transactions(rows)
+    derived, profiles = profile_upload(data)
+    columns_before = data.columns.tolist()
+    memory_before = int(data.memory_usage(deep=True).sum())
+
+    timings = []
+    for i in range(questions):
+        start = time.perf_counter()
+        analyze_data_for_question(f"question {i}", data, None, derived, profiles)
+        timings.append(time.perf_counter() - start)
+
+    memory_after = int(data.memory_usage(deep=True).sum())
+    assert data.columns.tolist() == columns_before, "analysis added or changed columns on the session frame"
+    assert memory_after == memory_before, f"frame memory grew from {memory_before} to {memory_after} bytes"
+
+    print(f"repeated_questions: {questions} questions on {rows} rows, "
+          f"mean {np.mean(timings):.3f}s, frame memory constant at {memory_before / 1e6:.1f} MB, "
+          f"{len(columns_before)} columns")
+
+# Function to build a wide frame with many value and low-cardinality columns
+def make_wide_transactions(rows=100_000, numeric=30, categorical=15, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = {f"value_{i}": rng.normal(100.0, 25.0, rows) for i in range(numeric)}
+    for i in range(categorical):
+        columns[f"segment_{i}"] = rng.choice([f"s{j}" for j in range(8)], rows)
+    return pd.DataFrame(columns)
+
+# The per-(category, value) groupby with row iteration that aggregate_by_key replaced
+def legacy_category_aggregations(data, categorical_cols, value_cols):
+    results = {}
+    for cat_col in categorical_cols:
+        for value_col in value_cols:
+            category_agg = data.groupby(cat_col)[value_col].agg(['sum', 'mean', 'count']).reset_index()
+            category_agg.columns = [cat_col, f'sum_{value_col}', f'avg_{value_col}', f'count_{value_col}']
+            category_data = []
+            for _, row in category_agg.iterrows():
+                entry = {}
+                for col_name in category_agg.columns:
+                    entry[col_name] = convert_to_native_types(row[col_name])
+                category_data.append(entry)
+            results[f"{cat_col}_{value_col}_analysis"] = category_data
+    return results
+
+# Compare the single-pass aggregation engine against the per-pair loop on a wide frame
+def bench_category_aggregations(rows=100_000):
+    data = make_wide_transactions(rows)
+    value_cols = [col for col in data.columns if col.startswith("value_")]
+    categorical_cols = [col for col in data.columns if col.startswith("segment_")]
+
+    start = time.perf_counter()
+    legacy_category_aggregations(data, categorical_cols, value_cols)
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for cat_col in categorical_cols:
+        aggregate_by_key(data, data[cat_col], cat_col, value_cols)
+    engine_seconds = time.perf_counter() - start
+
+    print(f"category_aggregations: {len(categorical_cols)} x {len(value_cols)} on {rows} rows, "
+          f"per-pair {legacy_seconds:.3f}s, single-pass {engine_seconds:.3f}s, "
+          f"speed-up {legacy_seconds / engine_seconds:.1f}x")
+
+# Function to build warehouse-style column names and a larger dictionary that covers them loosely
+def make_column_names(columns=1000, fields=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    words = ["customer", "order", "product", "store", "region", "total", "net", "gross", "amount",
+             "date", "code", "status", "channel", "discount", "tax", "price", "qty", "category",
+             "segment", "account", "invoice", "payment", "shipping", "return", "margin"]
+    def make_name(i):
+        return "_".join(rng.choice(words, 3)) + f"_{i}"
+    dictionary_names = [make_name(i) for i in range(fields)]
+    column_names = []
+    for i in range(columns):
+        source = dictionary_names[rng.integers(0, fields)]
+        variant = i % 4
+        if variant == 0:
+            column_names.append(source)
+        elif variant == 1:
+            column_names.append(source.upper().replace("_", " "))
+        elif variant == 2:
+            column_names.append(f"src_{source}")
+        else:
+            column_names.append(make_name(fields + i))
+    return column_names, dictionary_names
+
+# The nested normalized-containment loop that ColumnMatcher replaced
+def legacy_column_mapping(column_names, dictionary_names):
+    transaction_columns = set(column_names)
+    dictionary_columns = set(dictionary_names)
+    exact_matches = transaction_columns.intersection(dictionary_columns)
+    fuzzy_matches = {}
+    for t_col in transaction_columns - exact_matches:
+        normalized_t_col = t_col.lower().replace(' ', '').replace('_', '')
+        for d_col in dictionary_columns - exact_matches:
+            normalized_d_col = d_col.lower().replace(' ', '').replace('_', '')
+            if normalized_t_col in normalized_d_col or normalized_d_col in normalized_t_col:
+                fuzzy_matches[t_col] = d_col
+                break
+    return exact_matches, fuzzy_matches
+
+# Compare the indexed matcher against the nested loop on a 1k column x 5k field case
+def bench_column_matching(columns=1000, fields=5000):
+    column_names, dictionary_names = make_column_names(columns, fields)
+
+    start = time.perf_counter()
+    exact_matches, fuzzy_matches = legacy_column_mapping(column_names, dictionary_names)
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matcher = ColumnMatcher(dictionary_names)
+    index_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    mapping = matcher.match(column_names)
+    match_seconds = time.perf_counter() - start
+
+    # Matching must not depend on input order
+    assert matcher.match(list(reversed(column_names))) == mapping, "column mapping depends on input order"
+
+    print(f"column_matching: {columns} columns x {fields} fields, nested loop {legacy_seconds:.3f}s "
+          f"({len(exact_matches) + len(fuzzy_matches)} mapped), index build {index_seconds:.3f}s + "
+          f"match {match_seconds:.3f}s ({len(mapping)} mapped)")
+
+# Compare the pandas analysis path against the embedded SQL store, plus indexed filtered queries
+def bench_analytical_store(rows=1_000_000, questions=5, filters=50):
+    data = make_transactions(rows)
+    derived, profiles = profile_upload(data)
+    store_dir = tempfile.mkdtemp(prefix="store-bench-")
+    try:
+        start = time.perf_counter()
+        store = open_store("bench", data, derived, profiles, store_dir=store_dir)
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(questions):
+            expected = analyze_data_for_question(f"question {i}", data, None, derived, profiles)
+        pandas_seconds = (time.perf_counter() - start) / questions
+
+        start = time.perf_counter()
+        for i in range(questions):
+            actual = analyze_store(f"question {i}", store, profiles)
+        store_seconds = (time.perf_counter() - start) / questions
+        assert list(actual) == list(expected), "store analysis has different sections"
+        assert actual["region_sales_amount_analysis"][0]["count_sales_amount"] == \
+            expected["region_sales_amount_analysis"][0]["count_sales_amount"], "store aggregates differ"
+
+        # Repeated filtered queries on a one-week date range and a category: boolean masks vs indexes
+        weeks = pd.date_range("2023-01-02", periods=filters, freq="7D")
+        order_dates = derived["order_date"]
+        start = time.perf_counter()
+        pandas_totals = []
+        for week in weeks:
+            mask = (order_dates >= week) & (order_dates < week + pd.Timedelta(days=7)) & (data["region"] == "East")
+            pandas_totals.append(data.loc[mask, "sales_amount"].sum())
+        pandas_filter_seconds = (time.perf_counter() - start) / filters
+
+        start = time.perf_counter()
+        store_totals = []
+        for week in weeks:
+            store_totals.append(store.fetch(
+                f"SELECT TOTAL(sales_amount) FROM {STORE_TABLE} WHERE order_date >= ? AND order_date < ? AND region = ?",
+                (str(week), str(week + pd.Timedelta(days=7)), "East")
+            )[0][0])
+        store_filter_seconds = (time.perf_counter() - start) / filters
+        assert np.allclose(pandas_totals, store_totals), "store filtered totals differ"
+
+        print(f"analytical_store: {rows} rows, store build {build_seconds:.1f}s, "
+              f"analysis pandas {pandas_seconds:.3f}s vs SQL {store_seconds:.3f}s, "
+              f"filtered query pandas {pandas_filter_seconds * 1000:.1f}ms vs indexed SQL {store_filter_seconds * 1000:.1f}ms")
+    finally:
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+# Appending a day of rows to a year of history should cost about a day's worth of work
+def bench_append(history_rows=2_000_000, day_rows=5_500):
+    data = make_transactions(history_rows + day_rows)
+    history, day = data.iloc[:history_rows].reset_index(drop=True), data.iloc[history_rows:].reset_index(drop=True)
+    derived, profiles = profile_upload(history)
+
+    start = time.perf_counter()
+    stats = build_append_stats(history, derived)
+    stats_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    appended, appended_derived, appended_profiles = append_rows(history, derived, profiles, stats, day)
+    incremental = stats.to_analysis()
+    append_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    full_derived, full_profiles = profile_upload(data)
+    expected = analyze_data_for_question("question", data, None, full_derived, full_profiles)
+    full_seconds = time.perf_counter() - start
+
+    assert incremental["row_count"] == expected["row_count"], "appended row count differs"
+    assert incremental["correlation_matrix"] == expected["correlation_matrix"], "appended correlations differ"
+    assert incremental["order_date_monthly_distribution"] == expected["order_date_monthly_distribution"], \
+        "appended monthly buckets differ"
+
+    print(f"append: {day_rows} rows onto {history_rows}, one-off statistics build {stats_seconds:.2f}s, "
+          f"append + analysis {append_seconds:.3f}s vs full recompute {full_seconds:.2f}s")
+
+# Sampled analysis should be much faster than exact on large data, and its 95% intervals should
+# cover the exact figures about 95% of the time
+def bench_sampled_analysis(rows=2_000_000, sample_rows=100_000):
+    data = make_transaction_data(rows, numeric=4, categorical=3, dates=1, cardinality=12, null_rate=0.02)
+    derived, profiles = profile_upload(data)
+
+    start = time.perf_counter()
+    expected = analyze_data_for_question("question", data, None, derived, profiles)
+    exact_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plan = SamplingPlan(data, derived, profiles)
+    plan_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    estimated = analyze_sample("question", data, derived, profiles, plan, sample_rows)
+    sample_seconds = time.perf_counter() - start
+
+    covered = total = 0
+    for key, records in expected.items():
+        if not (key.startswith("monthly_") or key.endswith("_analysis")):
+            continue
+        for exact_record, estimate in zip(records, estimated[key]):
+            for field, value in exact_record.items():
+                if field.startswith(("sum_", "avg_", "count_")):
+                    low, high = estimate[f"{field}_ci95"]
+                    covered += low <= value <= high
+                    total += 1
+    assert [key for key in estimated if key != "sampling_notes"] == list(expected), "sampled analysis has different sections"
+    assert covered >= 0.9 * total, f"95% intervals covered only {covered} of {total} exact figures"
+
+    print(f"sampled_analysis: {sample_rows} of {rows} rows, exact {exact_seconds:.2f}s vs sampled {sample_seconds:.2f}s "
+          f"(one-off plan {plan_seconds:.2f}s), intervals cover {covered}/{total} exact figures")
+
+    # Opting in must not slow answers down: where the exact analysis fits the latency target,
+    # approximate mode falls back to it after the pilot
+    start = time.perf_counter()
+    _, sampled = analyze_approximately("question", data, derived, profiles, plan,
+                                       lambda: analyze_data_for_question("question", data, None, derived, profiles),
+                                       target_seconds=max(2 * exact_seconds, 0.5))
+    approximate_seconds = time.perf_counter() - start
+    assert not sampled, "approximate mode sampled although the exact analysis fits the target"
+    print(f"sampled_analysis: with a {max(2 * exact_seconds, 0.5):.2f}s target approximate mode ran exact "
+          f"in {approximate_seconds:.2f}s including the pilot (exact step {plan.exact_seconds:.2f}s)")
+
+# Compact dtypes should shrink an upload several times and speed up grouping by its categories
+def bench_dtype_optimizer(rows=1_000_000, repeat=5):
+    data = make_transactions(rows)
+    start = time.perf_counter()
+    optimized, report = optimize_dtypes(data)
+    optimize_seconds = time.perf_counter() - start
+
+    def groupby_seconds(frame):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for cat_col in ["region", "product_category"]:
+                aggregate_by_key(frame, frame[cat_col], cat_col, ["sales_amount", "quantity"])
+        return (time.perf_counter() - start) / repeat
+
+    parsed_groupby, optimized_groupby = groupby_seconds(data), groupby_seconds(optimized)
+    assert aggregate_by_key(data, data["region"], "region", ["quantity"]) == \
+        aggregate_by_key(optimized, optimized["region"], "region", ["quantity"]), "optimized aggregates differ"
+
+    print(f"dtype_optimizer: {rows} rows, {report['before_bytes'] / 1e6:.1f} MB -> {report['after_bytes'] / 1e6:.1f} MB "
+          f"({report['before_bytes'] / report['after_bytes']:.1f}x) in {optimize_seconds:.2f}s, "
+          f"category groupbys {parsed_groupby * 1000:.0f}ms -> {optimized_groupby * 1000:.0f}ms "
+          f"({parsed_groupby / optimized_groupby:.1f}x)")
+
+# Size tiers for the benchmark suite: every combination of 10k, 1M and 10M rows with 10, 100
+# and 1000 columns, as name -> (rows, numeric, categorical, date columns). The default set runs
+# in under a minute; the other tiers only run when named with --tiers. 10k-1000 spends about 35s
+# per pass in analyze_data_for_question (350 category groupbys over 300 value columns and a
+# 600-column correlation), and the wider 1M and all 10M tiers need several GB of memory.
+SUITE_ROWS = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+SUITE_WIDTHS = {"10": (6, 3, 1), "100": (60, 35, 5), "1000": (600, 350, 50)}
+SUITE_TIERS = {
+    f"{rows_name}-{width_name}": (rows, *width)
+    for rows_name, rows in SUITE_ROWS.items()
+    for width_name, width in SUITE_WIDTHS.items()
+}
+DEFAULT_SUITE_TIERS = ["10k-10", "10k-100", "1m-10"]
+
+# Question asked in every suite run; it touches the time, breakdown and value sections
+SUITE_QUESTION = "How did sales amount change by month for each segment?"
+
+# Stage timings below this are mostly noise and are never reported as regressions
+MIN_COMPARABLE_SECONDS = 0.01
+
+# Function to time fn over several runs, then run it once more under tracemalloc for peak memory.
+# Peak memory is the most Python-allocated memory (numpy and pandas buffers included) above what
+# was allocated when the stage started.
+def measure(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+    return result, {
+        "median_seconds": round(statistics.median(timings), 6),
+        "min_seconds": round(min(timings), 6),
+        "runs": repeat,
+        "peak_memory_bytes": peak,
+    }
+
+# Function to run the pipeline stages on one synthetic tier: upload profiling, dictionary
+# processing, column matching and indexing, analysis, prompt payload and dictionary selection,
+# and a model round trip against the local fake model (no delays), so only this repo's code is timed.
+def bench_suite_tier(rows, numeric, categorical, dates, cardinality, null_rate, dirty_dates, repeat, seed=0):
+    start = time.perf_counter()
+    data = make_transaction_data(rows, numeric, categorical, dates, cardinality=cardinality,
+                                 null_rate=null_rate, dirty_dates=dirty_dates, seed=seed)
+    dict_data = make_data_dictionary(data.columns, extra_fields=len(data.columns), seed=seed)
+    generate_seconds = time.perf_counter() - start
+
+    stages = {}
+    # Same order as an upload: compact the dtypes, then profile the compacted frame
+    (data, memory_report), stages["optimize_dtypes"] = measure(lambda: optimize_dtypes(data), repeat)
+    (derived, profiles), stages["profile_upload"] = measure(lambda: profile_upload(data), repeat)
+    (column_descriptions, _, _), stages["process_data_dictionary"] = measure(
+        lambda: process_data_dictionary(dict_data), repeat)
+    column_mapping, stages["column_matching"] = measure(
+        lambda: ColumnMatcher(column_descriptions.keys()).match(data.columns.tolist()), repeat)
+    dictionary_index, stages["dictionary_index"] = measure(lambda: DictionaryIndex(column_descriptions), repeat)
+    analysis, stages["analyze_data_for_question"] = measure(
+        lambda: analyze_data_for_question(SUITE_QUESTION, data, dict_data, derived, profiles), repeat)
+    (analysis_json, _), stages["build_analysis_payload"] = measure(
+        lambda: build_analysis_payload(SUITE_QUESTION, analysis, column_descriptions), repeat)
+    column_scores = score_columns(SUITE_QUESTION, data.columns.tolist(), column_descriptions)
+    dictionary_info, stages["dictionary_context"] = measure(
+        lambda: build_dictionary_context(SUITE_QUESTION, dictionary_index, column_scores, column_mapping,
+                                         int(PROMPT_TOKEN_BUDGET * DICTIONARY_SHARE)), repeat)
+
+    prompt = f"User Question: {SUITE_QUESTION}\n\n{dictionary_info}\n\n```json\n{analysis_json}\n```"
+    client = LLMClient(FakeModel(first_delay=0, chunk_delay=0))
+    try:
+        _, stages["model_round_trip_stub"] = measure(
+            lambda: "".join(chunk.text for chunk in client.generate_content(prompt, stream=True)), repeat)
+    finally:
+        client.executor.shutdown(wait=False)
+
+    return {
+        "rows": rows,
+        "columns": len(data.columns),
+        "numeric_columns": numeric,
+        "categorical_columns": categorical,
+        "date_columns": dates,
+        "detected_date_columns": len(derived.attrs.get("date_columns", [])),
+        "analysis_sections": len(analysis),
+        "generate_seconds": round(generate_seconds, 3),
+        "parsed_bytes": memory_report["before_bytes"],
+        "optimized_bytes": memory_report["after_bytes"],
+        "stages": stages,
+    }
+
+# Function to describe where the results came from, so runs from different commits can be compared
+def suite_environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+    }
+
+# Function to list (tier, stage, baseline seconds, current seconds, ratio) for every stage that
+# got more than max_slowdown times slower than the baseline. Stages missing from either side and
+# stages under MIN_COMPARABLE_SECONDS in both runs are skipped.
+def compare_results(current, baseline, max_slowdown):
+    regressions = []
+    for tier, tier_results in current["tiers"].items():
+        baseline_tier = baseline.get("tiers", {}).get(tier)
+        if baseline_tier is None:
+            continue
+        for stage, result in tier_results["stages"].items():
+            baseline_stage = baseline_tier["stages"].get(stage)
+            if baseline_stage is None:
+                continue
+            before, after = baseline_stage["median_seconds"], result["median_seconds"]
+            if max(before, after) < MIN_COMPARABLE_SECONDS:
+                continue
+            ratio = after / before if before else float("inf")
+            if ratio > max_slowdown:
+                regressions.append((tier, stage, before, after, ratio))
+    return regressions
+
+# Run the suite on the chosen tiers, write JSON results and compare them against a baseline file.
+# Returns the process exit code: 1 when any stage regressed past max_slowdown, else 0.
+def run_suite(tiers, repeat=3, cardinality=12, null_rate=0.02, dirty_dates=0.01, output=None,
+              baseline=None, max_slowdown=1.5):
+    results = {
+        "environment": suite_environment(),
+        "settings": {"repeat": repeat, "cardinality": cardinality, "null_rate": null_rate,
+                     "dirty_dates": dirty_dates, "question": SUITE_QUESTION},
+        "tiers": {},
+    }
+    # Date detection tries every text column; the per-column "could not infer format" warnings are noise here
+    warnings.filterwarnings("ignore", message="Could not infer format", category=UserWarning)
+    for tier in tiers:
+        rows, numeric, categorical, dates = SUITE_TIERS[tier]
+        tier_results = bench_suite_tier(rows, numeric, categorical, dates, cardinality, null_rate, dirty_dates, repeat)
+        results["tiers"][tier] = tier_results
+        for stage, result in tier_results["stages"].items():
+            print(f"suite {tier}: {stage} median {result['median_seconds']:.4f}s, "
+                  f"min {result['min_seconds']:.4f}s, peak {result['peak_memory_bytes'] / 1e6:.1f} MB")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"suite results written to {output}")
+
+    if baseline:
+        with open(baseline) as f:
+            baseline_results = json.load(f)
+        regressions = compare_results(results, baseline_results, max_slowdown)
+        for tier, stage, before, after, ratio in regressions:
+            print(f"REGRESSION {tier}: {stage} {before:.4f}s -> {after:.4f}s ({ratio:.2f}x, limit {max_slowdown:.2f}x)")
+        if regressions:
+            return 1
+        print(f"no stage slowed down more than {max_slowdown:.2f}x against "
+              f"{baseline_results.get('environment', {}).get('commit') or baseline}")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Performance checks for the analysis pipeline")
+    parser.add_argument("--store-rows", type=int, nargs="+", default=[1_000_000],
+                        help="row counts for the embedded store comparison, e.g. 1000000 10000000")
+    parser.add_argument("--suite", action="store_true",
+                        help="run the synthetic benchmark suite instead of the performance checks")
+    parser.add_argument("--tiers", nargs="+", choices=list(SUITE_TIERS), default=DEFAULT_SUITE_TIERS,
+                        help="suite size tiers as rows-columns (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage; the median is reported")
+    parser.add_argument("--cardinality", type=int, default=12, help="distinct values per categorical column")
+    parser.add_argument("--null-rate", type=float, default=0.02, help="fraction of missing values per column")
+    parser.add_argument("--dirty-dates", type=float, default=0.01,
+                        help="fraction of date values in other formats or unparseable")
+    parser.add_argument("--output", help="write suite results to this JSON file")
+    parser.add_argument("--baseline", help="suite results JSON from an earlier commit to compare against")
+    parser.add_argument("--max-slowdown", type=float, default=1.5,
+                        help="fail when a stage's median is more than this many times the baseline's")
+    args = parser.parse_args()
+    if args.suite:
+        sys.exit(run_suite(args.tiers, args.repeat, args.cardinality, args.null_rate, args.dirty_dates,
+                           args.output, args.baseline, args.max_slowdown))
+    bench_repeated_questions()
+    bench_category_aggregations()
+    bench_column_matching()
+    bench_append()
+    bench_sampled_analysis()
+    bench_dtype_optimizer()
+    for rows in args.store_rows:
+        bench_analytical_store(rows)
@@ -0,0 +1,231 @@
+import math
+import re
+
+import numpy as np
+import pandas as pd
+
+# Minimum trigram similarity for a match that is not a plain containment
+FUZZY_MIN_SIMILARITY = 0.75
+
+# Terms in dictionary headers that identify what each dictionary column holds
+TABLE_TERMS = ['table', 'schema', 'entity', 'dataset']
+NAME_TERMS = ['field', 'column', 'variable', 'name', 'attribute', 'feature']
+TYPE_TERMS = ['type', 'datatype', 'data_type', 'format', 'dtype']
+DESC_TERMS = ['desc', 'definition', 'meaning', 'explanation', 'info', 'comment', 'documentation']
+
+# Function to identify the table, name, type and description columns of a dictionary file
+def identify_dictionary_columns(dict_data):
+    actual_columns = dict_data.columns.tolist()
+
+    def matching(terms, exclude=()):
+        return [col for col in actual_columns
+                if col not in exclude and any(term in str(col).lower() for term in terms)]
+
+    # Table/schema column for multi-table dictionaries ("table_name" is a table, not a field name)
+    table_cols = matching(TABLE_TERMS)
+    name_cols = matching(NAME_TERMS, exclude=table_cols) or matching(NAME_TERMS)
+    table_cols = [col for col in table_cols if col not in name_cols[:1]]
+    type_cols = matching(TYPE_TERMS, exclude=table_cols)
+    desc_cols = matching(DESC_TERMS, exclude=table_cols)
+
+    def sample(col):
+        return dict_data[col].dropna().head(5).astype(str)
+
+    # If common naming patterns weren't found, identify columns by content:
+    # field names have no spaces, data types are short, descriptions are long
+    if not name_cols:
+        for col in actual_columns:
+            if col not in table_cols and not sample(col).str.contains(' ', regex=False).any():
+                name_cols.append(col)
+                break
+
+    if not type_cols and len(actual_columns) >= 2:
+        for col in actual_columns:
+            if col in name_cols or col in table_cols:
+                continue
+            if (sample(col).str.len() < 20).all():
+                type_cols.append(col)
+                break
+
+    if not desc_cols and len(actual_columns) >= 3:
+        for col in actual_columns:
+            if col in name_cols or col in type_cols or col in table_cols:
+                continue
+            if (sample(col).str.len() > 20).any():
+                desc_cols.append(col)
+                break
+
+    # Default to positional fallbacks if we still couldn't identify columns
+    if not name_cols and len(actual_columns) >= 1:
+        name_cols = [actual_columns[0]]
+    if not type_cols and len(actual_columns) >= 2:
+        type_cols = [actual_columns[1]]
+    if not desc_cols and len(actual_columns) >= 3:
+        desc_cols = [actual_columns[2]]
+
+    return (table_cols[0] if table_cols else None, name_cols[0] if name_cols else None,
+            type_cols[0] if type_cols else None, desc_cols[0] if desc_cols else None)
+
+# Function to clean a dictionary column into stripped strings, with missing values as ""
+def _clean_text(dict_data, col):
+    if col is None:
+        return pd.Series("", index=dict_data.index, dtype=object)
+    values = dict_data[col]
+    return values.astype(str).str.strip().where(values.notna(), "")
+
+# Function to process the data dictionary into a usable format.
+# Returns (column_descriptions, formatted_text, table_descriptions):
+#   column_descriptions maps field -> {'data_type', 'description'} (plus 'table' when known);
+#   formatted_text is one "- field: type. description" line per field, grouped by table;
+#   table_descriptions maps table -> {field: entry} for per-table lookups ({} for single-table files).
+def process_data_dictionary(dict_data):
+    table_col, name_col, type_col, desc_col = identify_dictionary_columns(dict_data)
+    if name_col is None:
+        return {}, "", {}
+
+    entries = pd.DataFrame({
+        "table": _clean_text(dict_data, table_col),
+        "field": _clean_text(dict_data, name_col),
+        "data_type": _clean_text(dict_data, type_col),
+        "description": _clean_text(dict_data, desc_col),
+    })
+    # Skip empty field names
+    entries = entries[entries["field"] != ""]
+    # Later rows win for repeated fields, but fields keep the position of their first appearance
+    first_position = entries.groupby(["table", "field"], sort=False).ngroup()
+    entries = (entries.assign(position=first_position)
+               .drop_duplicates(["table", "field"], keep="last")
+               .sort_values("position", kind="stable")
+               .reset_index(drop=True))
+
+    # Build "- field: type. description" lines with column operations
+    has_type = entries["data_type"] != ""
+    has_desc = entries["description"] != ""
+    lines = ("- " + entries["field"]
+             + np.where(has_type, ": " + entries["data_type"], "")
+             + np.where(has_desc, np.where(has_type, ". ", ": ") + entries["description"], ""))
+
+    records = entries[["data_type", "description"]].to_dict("records")
+    if table_col is not None:
+        for record, table in zip(records, entries["table"].tolist()):
+            record["table"] = table
+
+    column_descriptions = dict(zip(entries["field"].tolist(), records))
+    table_descriptions = {}
+    if table_col is None:
+        formatted_text = "\n".join(lines.tolist())
+    else:
+        sections = []
+        for table, table_lines in lines.groupby(entries["table"], sort=False):
+            positions = table_lines.index.tolist()
+            table_descriptions[table] = {entries.at[i, "field"]: records[i] for i in positions}
+            sections.append(f"Table {table or '(unnamed)'}:\n" + "\n".join(table_lines.tolist()))
+        formatted_text = "\n\n".join(sections)
+
+    return column_descriptions, formatted_text, table_descriptions
+
+# Function to pick the dictionary table whose fields best cover the transaction columns
+def pick_table(table_descriptions, columns):
+    best_table, best_overlap = None, 0
+    columns = set(columns)
+    for table in sorted(table_descriptions):
+        overlap = len(columns.intersection(table_descriptions[table]))
+        if overlap > best_overlap:
+            best_table, best_overlap = table, overlap
+    return best_table
+
+# Function to look up a field's dictionary entry, preferring the given table in multi-table dictionaries
+def lookup_description(column_descriptions, table_descriptions, field, table=None):
+    if table is not None and field in table_descriptions.get(table, {}):
+        return table_descriptions[table][field]
+    return column_descriptions.get(field)
+
+# Function to normalize a column or field name for matching (case, spaces and separators ignored)
+def normalize_name(name):
+    return re.sub(r"[\s_\-.]+", "", str(name).lower())
+
+def _trigrams(normalized):
+    return {normalized[i:i + 3] for i in range(len(normalized) - 2)}
+
+# Index over data dictionary field names, built once per dictionary, that maps transaction
+# columns to dictionary fields. A column matches a field exactly, or fuzzily when one
+# normalized name contains the other or their trigram sets are similar enough. Candidates
+# are ranked and ties broken by name, so results do not depend on set iteration order.
+class ColumnMatcher:
+    def __init__(self, dictionary_names):
+        self.names = sorted({str(name) for name in dictionary_names})
+        self.name_set = set(self.names)
+        self.normalized = {}
+        self.by_normalized = {}
+        self.trigram_index = {}
+        self.trigram_sets = {}
+        for name in self.names:
+            normalized = normalize_name(name)
+            self.normalized[name] = normalized
+            self.by_normalized.setdefault(normalized, []).append(name)
+            trigrams = _trigrams(normalized)
+            self.trigram_sets[name] = trigrams
+            for trigram in trigrams:
+                self.trigram_index.setdefault(trigram, set()).add(name)
+
+    # Function to collect dictionary names related to a normalized column name
+    def _candidates(self, normalized, trigrams):
+        contained = set()
+        # Dictionary names that are a substring of the column: look up every substring directly
+        for start in range(len(normalized)):
+            for end in range(start + 2, len(normalized) + 1):
+                contained.update(self.by_normalized.get(normalized[start:end], ()))
+
+        # Dictionary names that contain the column must hold all of its trigrams
+        postings = sorted((self.trigram_index.get(trigram, set()) for trigram in trigrams), key=len)
+        if postings and postings[0]:
+            containing = set(postings[0]).intersection(*postings[1:])
+            contained.update(name for name in containing if normalized in self.normalized[name])
+        elif len(normalized) >= 2 and not trigrams:
+            contained.update(name for name in self.names if normalized in self.normalized[name])
+
+        # A name at least FUZZY_MIN_SIMILARITY similar shares that fraction of the column's k trigrams,
+        # so it must hold one of the rarest k - ceil(FUZZY_MIN_SIMILARITY * k) + 1 (prefix filtering)
+        prefix = len(postings) - math.ceil(FUZZY_MIN_SIMILARITY * len(postings)) + 1
+        similar = set()
+        for posting in postings[:prefix]:
+            similar.update(posting)
+        return contained, similar - contained
+
+    def rank(self, column, exclude=()):
+        normalized = normalize_name(column)
+        if not normalized:
+            return []
+        trigrams = _trigrams(normalized)
+        contained, similar = self._candidates(normalized, trigrams)
+
+        ranked = []
+        for name in contained | similar:
+            if name in exclude:
+                continue
+            other = self.trigram_sets[name]
+            union = len(trigrams | other)
+            similarity = len(trigrams & other) / union if union else 0.0
+            is_contained = name in contained
+            if not is_contained and similarity < FUZZY_MIN_SIMILARITY:
+                continue
+            ranked.append((not is_contained, -similarity, abs(len(self.normalized[name]) - len(normalized)), name))
+        ranked.sort()
+        return [(name, -negative_similarity) for _, negative_similarity, _, name in ranked]
+
+    # Function to map transaction columns to dictionary fields: {column: (field, "exact" | "fuzzy")}
+    def match(self, columns):
+        mapping = {}
+        exact = [col for col in columns if col in self.name_set]
+        for col in exact:
+            mapping[col] = (col, "exact")
+
+        # Fields already claimed by an exact match are not offered to other columns
+        exact_fields = set(exact)
+        for col in columns:
+            if col in mapping:
+                continue
+            ranked = self.rank(col, exclude=exact_fields)
+            if ranked:
+                mapping[col] = (ranked[0][0], "fuzzy")
+        return mapping
@@ -0,0 +1,687 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from analysis import (CATEGORY_MAX_UNIQUE, TEXT_DTYPES, VALUE_NAME_TERMS, ColumnProfile, build_derived_columns,
+                      detect_date_columns, month_labels, parse_dates, widen_numeric)
+
+# Rows per chunk when streaming an upload; peak memory scales with this, not the file size
+DEFAULT_CHUNK_SIZE = 250_000
+
+# Where parsed uploads are cached as Arrow IPC files, and how much disk the cache may use
+UPLOAD_CACHE_DIR = os.environ.get("UPLOAD_CACHE_DIR", os.path.join(".cache", "uploads"))
+UPLOAD_CACHE_MAX_BYTES = int(os.environ.get("UPLOAD_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+# Text columns with at most this share of distinct values (among non-missing rows) become categoricals
+CATEGORY_MAX_RATIO = 0.5
+
+# Arrow-backed strings with NaN for missing values, the pandas 3 default "str" dtype. Older pandas
+# only has the variant with pd.NA semantics, which behaves differently in comparisons, so there
+# high-cardinality text stays as Python objects.
+try:
+    ARROW_STRING_DTYPE = pd.StringDtype("pyarrow", na_value=np.nan)
+except TypeError:
+    ARROW_STRING_DTYPE = None
+
+# Mergeable quantile sketch (a compact t-digest variant using the arcsine scale function).
+# Centroids near the tails stay small and centroids near the median grow, so the
+# sketch stays a few hundred entries no matter how many rows it has seen.
+class QuantileSketch:
+    def __init__(self, compression=500):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        self._absorb(values, np.ones(len(values)))
+
+    def merge(self, other):
+        self._absorb(other.means, other.weights)
+
+    def _absorb(self, means, weights):
+        means = np.concatenate([self.means, means])
+        weights = np.concatenate([self.weights, weights])
+        if len(means) == 0:
+            return
+        order = np.argsort(means, kind="mergesort")
+        means, weights = means[order], weights[order]
+
+        # Assign each point to a bucket on the arcsine scale, then collapse each bucket to one centroid
+        quantiles = (np.cumsum(weights) - weights / 2) / weights.sum()
+        scale = self.compression / (2 * np.pi) * np.arcsin(2 * quantiles - 1)
+        buckets = np.floor(scale - scale.min()).astype(np.int64)
+        bucket_weights = np.bincount(buckets, weights=weights)
+        bucket_sums = np.bincount(buckets, weights=means * weights)
+        keep = bucket_weights > 0
+        self.means = bucket_sums[keep] / bucket_weights[keep]
+        self.weights = bucket_weights[keep]
+
+    def quantile(self, q):
+        if len(self.means) == 0:
+            return float("nan")
+        centers = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(q * self.weights.sum(), centers, self.means))
+
+# Mergeable heavy-hitters counter. Counts are exact while the number of distinct values
+# stays under capacity; past that only the largest counts are kept and the largest
+# discarded count is tracked as the error bound.
+class TopValuesSketch:
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype="int64")
+        self.error = 0
+
+    def update(self, series):
+        counts = series.value_counts()
+        # Categorical columns also report categories that do not occur in this chunk
+        self._absorb(counts[counts > 0], 0)
+
+    def merge(self, other):
+        self._absorb(other.counts, other.error)
+
+    def _absorb(self, counts, error):
+        merged = self.counts.add(counts, fill_value=0).astype("int64")
+        self.error = max(self.error, error)
+        if len(merged) > self.capacity:
+            merged = merged.sort_values(ascending=False)
+            self.error = max(self.error, int(merged.iloc[self.capacity]))
+            merged = merged.iloc[:self.capacity]
+        self.counts = merged
+
+    @property
+    def exact(self):
+        return self.error == 0
+
+    def top(self, n=10):
+        return self.counts.sort_values(ascending=False, kind="mergesort").head(n)
+
+# Mergeable distinct-count estimator (k minimum values over 64-bit hashes)
+class DistinctSketch:
+    def __init__(self, k=4096):
+        self.k = k
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def update(self, series):
+        hashes = pd.util.hash_array(series.dropna().to_numpy(dtype=object))
+        self._absorb(hashes)
+
+    def merge(self, other):
+        self._absorb(other.hashes)
+
+    def _absorb(self, hashes):
+        self.hashes = np.unique(np.concatenate([self.hashes, hashes]))[:self.k]
+
+    def estimate(self):
+        if len(self.hashes) < self.k:
+            return len(self.hashes)
+        # The k-th smallest hash tells us how densely the hash space is populated
+        return int((self.k - 1) / (float(self.hashes[-1]) / 2.0 ** 64))
+
+# Running count/mean/M2 so standard deviations merge exactly across chunks (Chan et al.)
+class MomentStats:
+    def __init__(self):
+        self.count = 0
+        self.nulls = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def update(self, series):
+        values = series.to_numpy(dtype=float, na_value=np.nan)
+        valid = values[~np.isnan(values)]
+        self.nulls += len(values) - len(valid)
+        if len(valid):
+            other = MomentStats()
+            other.count = len(valid)
+            other.total = float(valid.sum())
+            other.mean = float(valid.mean())
+            other.m2 = float(((valid - other.mean) ** 2).sum())
+            other.min = float(valid.min())
+            other.max = float(valid.max())
+            self.merge(other)
+
+    def merge(self, other):
+        count = self.count + other.count
+        if other.count:
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.nulls += other.nulls
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def std(self):
+        return float(np.sqrt(self.m2 / (self.count - 1))) if self.count > 1 else float("nan")
+
+# Pairwise co-moments for numeric columns, so correlations merge exactly across chunks and
+# appended rows. For each column pair (i, j) it keeps, over the rows where both are present:
+# the row count, the mean and M2 of column i, and the co-moment sum. Row j of a matrix holds
+# the same figures for the other column of the pair.
+class CoMoments:
+    def __init__(self, columns):
+        self.columns = list(columns)
+        size = len(self.columns)
+        self.count = np.zeros((size, size))
+        self.mean = np.zeros((size, size))
+        self.m2 = np.zeros((size, size))
+        self.comoment = np.zeros((size, size))
+
+    # values is a rows x columns float array with NaN for missing values
+    def update(self, values):
+        present = ~np.isnan(values)
+        if not present.any():
+            return
+        mask = present.astype(float)
+        # Center on the chunk's column means so the sums of squares stay well conditioned
+        with np.errstate(invalid="ignore", divide="ignore"):
+            center = np.nan_to_num(np.nanmean(np.where(present, values, np.nan), axis=0))
+        centered = np.where(present, values - center, 0.0)
+        count = mask.T @ mask
+        sums = centered.T @ mask
+        safe_count = np.where(count > 0, count, 1)
+        other = CoMoments(self.columns)
+        other.count = count
+        other.mean = sums / safe_count + center[:, None]
+        other.m2 = (centered ** 2).T @ mask - sums ** 2 / safe_count
+        other.comoment = centered.T @ centered - sums * sums.T / safe_count
+        self.merge(other)
+
+    def merge(self, other):
+        count = self.count + other.count
+        safe_count = np.where(count > 0, count, 1)
+        delta = other.mean - self.mean
+        weight = self.count * other.count / safe_count
+        self.comoment += other.comoment + delta * delta.T * weight
+        self.m2 += other.m2 + delta ** 2 * weight
+        self.mean += delta * other.count / safe_count
+        self.count = count
+
+    # Function to render the Pearson correlation matrix in the DataFrame.corr().round(2) layout
+    def correlation(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            denominator = np.sqrt(self.m2 * self.m2.T)
+            matrix = np.where((self.count > 1) & (denominator > 0), self.comoment / denominator, np.nan)
+        matrix = np.clip(matrix, -1.0, 1.0).round(2)
+        return {a: {b: float(matrix[i, j]) for j, b in enumerate(self.columns)}
+                for i, a in enumerate(self.columns)}
+
+# Exact per-key sum/count tables, mergeable by addition. Used for monthly and category
+# breakdowns whose key space is small.
+class GroupedSums:
+    def __init__(self, max_keys=None):
+        self.max_keys = max_keys
+        self.sums = None
+        self.counts = None
+        self.overflowed = False
+
+    def update(self, values, key):
+        if self.overflowed:
+            return
+        grouped = values.groupby(key, observed=True)
+        self._absorb(grouped.sum(), grouped.count())
+
+    def merge(self, other):
+        if other.overflowed:
+            self.overflowed = True
+        if self.overflowed or other.sums is None:
+            return
+        self._absorb(other.sums, other.counts)
+
+    def _absorb(self, sums, counts):
+        if self.sums is None:
+            self.sums, self.counts = sums, counts
+        else:
+            self.sums = self.sums.add(sums, fill_value=0)
+            self.counts = self.counts.add(counts, fill_value=0)
+        if self.max_keys is not None and len(self.sums) > self.max_keys:
+            # Too many distinct keys to be a category breakdown; stop tracking
+            self.overflowed = True
+            self.sums = self.counts = None
+
+    def records(self, key_name, value_col):
+        sums = self.sums.sort_index()
+        counts = self.counts.reindex(sums.index).astype("int64")
+        means = sums / counts.where(counts > 0)
+        record_keys = (key_name, f'sum_{value_col}', f'avg_{value_col}', f'count_{value_col}')
+        columns = zip(sums.index.tolist(), sums.to_numpy().tolist(), means.to_numpy().tolist(), counts.to_numpy().tolist())
+        return [dict(zip(record_keys, values)) for values in columns]
+
+# Accumulates analyze_data_for_question-style statistics one chunk at a time.
+# Every piece of state is a mergeable partial aggregate, so two accumulators built
+# from different parts of a file can be combined with merge(), and appended rows only
+# cost an update() on the new rows. Pass date_columns to reuse an existing date detection.
+class StreamingStats:
+    def __init__(self, date_columns=None):
+        self.fixed_date_columns = date_columns
+        self.row_count = 0
+        self.columns = None
+        self.column_types = {}
+        self.date_columns = []
+        self.numeric_cols = []
+        self.object_cols = []
+        self.value_cols = []
+        self.numeric = {}
+        self.medians = {}
+        self.top_values = {}
+        self.distinct = {}
+        self.object_nulls = {}
+        self.dates = {}
+        self.monthly_counts = {}
+        self.monthly_sums = {}
+        self.category_sums = {}
+        self.comoments = None
+
+    def _init_schema(self, chunk):
+        self.columns = chunk.columns.tolist()
+        if self.fixed_date_columns is not None:
+            self.date_columns = list(self.fixed_date_columns)
+        else:
+            self.date_columns = detect_date_columns(chunk)
+        self.numeric_cols = [col for col in chunk.select_dtypes(include=['number']).columns
+                             if col not in self.date_columns]
+        self.object_cols = [col for col in chunk.select_dtypes(include=TEXT_DTYPES).columns
+                            if col not in self.date_columns]
+        self.value_cols = [col for col in self.numeric_cols if any(term in col.lower() for term in VALUE_NAME_TERMS)]
+        if not self.value_cols:
+            self.value_cols = list(self.numeric_cols)
+
+        self.column_types = {col: str(chunk[col].dtype) for col in self.columns}
+        for col in self.date_columns:
+            self.column_types[col] = "datetime64[ns]"
+        self._init_schema_state()
+
+    def update(self, chunk):
+        if self.columns is None:
+            self._init_schema(chunk)
+        self.row_count += len(chunk)
+
+        # Later chunks may infer different dtypes; coerce to the schema fixed by the first chunk.
+        # Downcast columns are widened so grouped sums cannot overflow.
+        numeric = widen_numeric(pd.DataFrame(
+            {col: pd.to_numeric(chunk[col], errors='coerce') for col in self.numeric_cols}, index=chunk.index
+        ))
+
+        for col in self.numeric_cols:
+            self.numeric[col].update(numeric[col])
+            self.medians[col].update(numeric[col].to_numpy(dtype=float, na_value=np.nan))
+        if self.numeric_cols:
+            self.comoments.update(np.column_stack([
+                numeric[col].to_numpy(dtype=float, na_value=np.nan) for col in self.numeric_cols
+            ]))
+
+        for col in self.object_cols:
+            series = chunk[col]
+            self.object_nulls[col] += int(series.isna().sum())
+            self.top_values[col].update(series)
+            self.distinct[col].update(series)
+            for value_col in self.value_cols:
+                self.category_sums[col][value_col].update(numeric[value_col], series)
+
+        for col in self.date_columns:
+            parsed = parse_dates(chunk[col])
+            stats = self.dates[col]
+            stats["nulls"] += int(parsed.isna().sum())
+            if parsed.notna().any():
+                chunk_min, chunk_max = parsed.min(), parsed.max()
+                stats["min"] = chunk_min if stats["min"] is None else min(stats["min"], chunk_min)
+                stats["max"] = chunk_max if stats["max"] is None else max(stats["max"], chunk_max)
+            month_year = month_labels(parsed)
+            self.monthly_counts[col] = self.monthly_counts[col].add(month_year.value_counts(), fill_value=0).astype("int64")
+            for value_col in self.value_cols:
+                self.monthly_sums[col][value_col].update(numeric[value_col], month_year)
+
+    def merge(self, other):
+        if other.columns is None:
+            return
+        if self.columns is None:
+            # Adopt the other accumulator's schema before absorbing its state
+            self.columns = list(other.columns)
+            self.column_types = dict(other.column_types)
+            self.date_columns = list(other.date_columns)
+            self.numeric_cols = list(other.numeric_cols)
+            self.object_cols = list(other.object_cols)
+            self.value_cols = list(other.value_cols)
+            self._init_schema_state()
+        self.row_count += other.row_count
+        for col in self.numeric_cols:
+            self.numeric[col].merge(other.numeric[col])
+            self.medians[col].merge(other.medians[col])
+        self.comoments.merge(other.comoments)
+        for col in self.object_cols:
+            self.object_nulls[col] += other.object_nulls[col]
+            self.top_values[col].merge(other.top_values[col])
+            self.distinct[col].merge(other.distinct[col])
+            for value_col in self.value_cols:
+                self.category_sums[col][value_col].merge(other.category_sums[col][value_col])
+        for col in self.date_columns:
+            mine, theirs = self.dates[col], other.dates[col]
+            mine["nulls"] += theirs["nulls"]
+            for bound, pick in (("min", min), ("max", max)):
+                if theirs[bound] is not None:
+                    mine[bound] = theirs[bound] if mine[bound] is None else pick(mine[bound], theirs[bound])
+            self.monthly_counts[col] = self.monthly_counts[col].add(other.monthly_counts[col], fill_value=0).astype("int64")
+            for value_col in self.value_cols:
+                self.monthly_sums[col][value_col].merge(other.monthly_sums[col][value_col])
+
+    def _init_schema_state(self):
+        self.numeric = {col: MomentStats() for col in self.numeric_cols}
+        self.medians = {col: QuantileSketch() for col in self.numeric_cols}
+        self.comoments = CoMoments(self.numeric_cols)
+        self.top_values = {col: TopValuesSketch() for col in self.object_cols}
+        self.distinct = {col: DistinctSketch() for col in self.object_cols}
+        self.object_nulls = {col: 0 for col in self.object_cols}
+        self.category_sums = {col: {value_col: GroupedSums(max_keys=19) for value_col in self.value_cols}
+                              for col in self.object_cols}
+        self.dates = {col: {"min": None, "max": None, "nulls": 0} for col in self.date_columns}
+        self.monthly_counts = {col: pd.Series(dtype="int64") for col in self.date_columns}
+        self.monthly_sums = {col: {value_col: GroupedSums() for value_col in self.value_cols}
+                             for col in self.date_columns}
+
+    # Function to render the accumulated state in the same layout as analyze_data_for_question
+    def to_analysis(self):
+        data_stats = {"all_columns": self.columns or [], "row_count": self.row_count,
+                      "column_types": dict(self.column_types)}
+        approximate = []
+        rows = max(self.row_count, 1)
+
+        for col in self.date_columns:
+            data_stats[f"{col}_is_date"] = True
+
+        for col in self.numeric_cols:
+            stats = self.numeric[col]
+            data_stats[col] = {
+                "sum": stats.total,
+                "mean": stats.mean if stats.count else float("nan"),
+                "median": self.medians[col].quantile(0.5),
+                "max": stats.max if stats.count else float("nan"),
+                "min": stats.min if stats.count else float("nan"),
+                "std": stats.std(),
+                "null_count": stats.nulls,
+                "null_percentage": stats.nulls / rows * 100
+            }
+            approximate.append(f"{col}.median")
+
+        for col in self.object_cols:
+            sketch = self.top_values[col]
+            unique_values = len(sketch.counts) if sketch.exact else self.distinct[col].estimate()
+            data_stats[col] = {
+                "unique_values": int(unique_values),
+                "top_values": {str(k): int(v) for k, v in sketch.top(10).items()},
+                "null_count": self.object_nulls[col],
+                "null_percentage": self.object_nulls[col] / rows * 100
+            }
+            if not sketch.exact:
+                approximate.append(f"{col}.unique_values")
+                approximate.append(f"{col}.top_values")
+            if unique_values < 20:
+                data_stats[col]["value_percentages"] = {
+                    str(k): float(v) / rows * 100 for k, v in sketch.top(len(sketch.counts)).items()
+                }
+
+        has_dated_rows = False
+        for date_col in self.date_columns:
+            stats = self.dates[date_col]
+            if stats["min"] is None:
+                continue
+            data_stats[date_col] = {
+                "min_date": stats["min"].strftime('%Y-%m-%d'),
+                "max_date": stats["max"].strftime('%Y-%m-%d'),
+                "null_count": stats["nulls"],
+                "null_percentage": stats["nulls"] / rows * 100
+            }
+            monthly_counts = self.monthly_counts[date_col].sort_index()
+            data_stats[f"{date_col}_monthly_distribution"] = {str(k): int(v) for k, v in monthly_counts.items()}
+            for value_col in self.value_cols:
+                data_stats[f"monthly_{date_col}_{value_col}"] = self.monthly_sums[date_col][value_col].records(
+                    f'month_year_{date_col}', value_col)
+            has_dated_rows = True
+
+        if has_dated_rows:
+            for cat_col in self.object_cols:
+                for value_col in self.value_cols:
+                    grouped = self.category_sums[cat_col][value_col]
+                    if grouped.overflowed or grouped.sums is None:
+                        continue
+                    data_stats[f"{cat_col}_{value_col}_analysis"] = grouped.records(cat_col, value_col)
+
+        # Correlations come from running co-moment sums, so they are exact
+        if len(self.numeric_cols) > 1:
+            data_stats["correlation_matrix"] = self.comoments.correlation()
+
+        data_stats["streaming_notes"] = {"approximate_fields": approximate}
+        return data_stats
+
+    # Function to bring upload-time column profiles up to date with the accumulated state.
+    # Roles are kept from the original profiles (except category vs text, which follows the
+    # new cardinality); numeric distinct counts cannot be merged, so they are dropped.
+    def refresh_profiles(self, column_profiles, data):
+        rows = max(self.row_count, 1)
+        profiles = {}
+        for col in self.columns:
+            old = column_profiles[col]
+            profile = ColumnProfile(name=col, dtype=old.dtype if col in self.date_columns else str(data[col].dtype),
+                                    role=old.role)
+            if col in self.date_columns:
+                stats = self.dates[col]
+                profile.null_count = stats["nulls"]
+                if stats["min"] is not None:
+                    profile.min = stats["min"].strftime('%Y-%m-%d')
+                    profile.max = stats["max"].strftime('%Y-%m-%d')
+            elif col in self.numeric:
+                stats = self.numeric[col]
+                profile.null_count = stats.nulls
+                if stats.count:
+                    profile.min, profile.max = stats.min, stats.max
+                    profile.summary = {"sum": stats.total, "mean": stats.mean,
+                                       "median": self.medians[col].quantile(0.5), "std": stats.std()}
+            elif col in self.top_values:
+                sketch = self.top_values[col]
+                profile.null_count = self.object_nulls[col]
+                profile.unique_count = int(len(sketch.counts) if sketch.exact else self.distinct[col].estimate())
+                profile.top_values = {str(k): int(v) for k, v in sketch.top(10).items()}
+                if profile.unique_count < CATEGORY_MAX_UNIQUE:
+                    profile.role = "category"
+                    profile.value_percentages = {
+                        str(k): float(v) / rows * 100 for k, v in sketch.top(len(sketch.counts)).items()
+                    }
+                elif old.role == "category":
+                    profile.role = "text"
+            else:
+                profile = old
+            profile.null_percentage = float(profile.null_count / rows * 100)
+            profiles[col] = profile
+        return profiles
+
+# Function to read a CSV in chunks and build statistics without holding the whole file
+def stream_csv_statistics(source, chunk_size=DEFAULT_CHUNK_SIZE, on_chunk=None):
+    stats = StreamingStats()
+    preview = None
+    for chunk in pd.read_csv(source, chunksize=chunk_size):
+        if preview is None:
+            preview = chunk.head()
+        stats.update(chunk)
+        if on_chunk is not None:
+            on_chunk(stats.row_count)
+    return stats, preview
+
+# Function to shrink a freshly parsed upload: low-cardinality text becomes categorical, other text
+# becomes Arrow strings and integers are downcast to the smallest type that holds them. Floats stay
+# 64-bit, since float32 would change sums and means. Returns (data, report) where report has the
+# deep memory footprint before and after and the {column: [old dtype, new dtype]} changes.
+def optimize_dtypes(data):
+    before_bytes = int(data.memory_usage(deep=True).sum())
+    columns = {}
+    changes = {}
+    for col in data.columns:
+        series = data[col]
+        dtype = series.dtype
+        if pd.api.types.is_bool_dtype(dtype) or isinstance(dtype, pd.CategoricalDtype):
+            optimized = series
+        elif pd.api.types.is_integer_dtype(dtype):
+            optimized = pd.to_numeric(series, downcast="integer")
+        elif dtype == object or pd.api.types.is_string_dtype(dtype):
+            present = int(series.notna().sum())
+            if present and series.nunique() <= CATEGORY_MAX_RATIO * present:
+                optimized = series.astype("category")
+            elif ARROW_STRING_DTYPE is not None and dtype != ARROW_STRING_DTYPE:
+                optimized = series.astype(ARROW_STRING_DTYPE)
+            else:
+                optimized = series
+        else:
+            optimized = series
+        if optimized.dtype != dtype:
+            changes[col] = [str(dtype), str(optimized.dtype)]
+        columns[col] = optimized
+    optimized_data = pd.DataFrame(columns, index=data.index)
+    report = {
+        "before_bytes": before_bytes,
+        "after_bytes": int(optimized_data.memory_usage(deep=True).sum()),
+        "changes": changes,
+    }
+    return optimized_data, report
+
+# Function to append one column's new values, keeping categoricals categorical (with the union of
+# both category sets) and integers at the smallest type that holds the combined values
+def _concat_column(held, new):
+    if isinstance(held.dtype, pd.CategoricalDtype):
+        return pd.Series(pd.api.types.union_categoricals(
+            [held, new.astype(held.cat.categories.dtype).astype("category")], sort_categories=True
+        ))
+    combined = pd.concat([held, new], ignore_index=True)
+    if pd.api.types.is_integer_dtype(held.dtype) and combined.dtype != held.dtype and pd.api.types.is_integer_dtype(combined.dtype):
+        combined = pd.to_numeric(combined, downcast="integer")
+    elif ARROW_STRING_DTYPE is not None and held.dtype == ARROW_STRING_DTYPE and combined.dtype != held.dtype:
+        combined = combined.astype(ARROW_STRING_DTYPE)
+    return combined
+
+# Function to check appended rows against the held frame: same columns (in any order), with
+# numeric columns coerced to numbers. Raises ValueError when the schema does not match.
+def align_appended_rows(delta, data):
+    columns = data.columns.tolist()
+    missing = [col for col in columns if col not in delta.columns]
+    unexpected = [col for col in delta.columns if col not in columns]
+    if missing or unexpected:
+        raise ValueError(f"Appended rows must have the same columns (missing: {missing or 'none'}, "
+                         f"unexpected: {unexpected or 'none'}).")
+    delta = delta[columns]
+    for col in data.select_dtypes(include=['number']).columns:
+        if not pd.api.types.is_numeric_dtype(delta[col]):
+            delta[col] = pd.to_numeric(delta[col], errors='coerce')
+    return delta
+
+# Function to build mergeable statistics for a held upload, so later appends only cost the new rows
+def build_append_stats(data, derived_data, chunk_size=DEFAULT_CHUNK_SIZE):
+    date_columns = derived_data.attrs.get("date_columns", [])
+    stats = StreamingStats(date_columns=date_columns)
+    # Feed the already parsed dates so they are not parsed a second time
+    data = data.assign(**{col: derived_data[col] for col in date_columns})
+    for start in range(0, len(data), chunk_size):
+        stats.update(data.iloc[start:start + chunk_size])
+    return stats
+
+# Function to append validated rows to a held upload. Statistics, the date side-car and the
+# profiles are updated from the new rows only; the frames themselves are concatenated.
+# Returns (data, derived_data, column_profiles) and updates stats in place.
+def append_rows(data, derived_data, column_profiles, stats, delta):
+    delta = align_appended_rows(delta, data)
+    date_columns = derived_data.attrs.get("date_columns", [])
+    stats.update(delta)
+    delta_derived = build_derived_columns(delta, date_columns)
+
+    data = pd.DataFrame({col: _concat_column(data[col], delta[col]) for col in data.columns})
+    combined = {}
+    for col in derived_data.columns:
+        if isinstance(derived_data[col].dtype, pd.CategoricalDtype):
+            # Merge the month buckets as categoricals instead of falling back to strings
+            combined[col] = pd.api.types.union_categoricals(
+                [derived_data[col], delta_derived[col].astype("category")], sort_categories=True
+            )
+        else:
+            combined[col] = pd.concat([derived_data[col], delta_derived[col]], ignore_index=True)
+    derived = pd.DataFrame(combined, index=data.index)
+    derived.attrs["date_columns"] = list(date_columns)
+    return data, derived, stats.refresh_profiles(column_profiles, data)
+
+# Function to write a DataFrame as an uncompressed Arrow IPC file (memory-mappable on reload)
+def _write_arrow(frame, path, metadata=None):
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    if metadata:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+# Function to memory-map an Arrow IPC file; fixed-width columns are used without copying
+def _read_arrow(path):
+    with pa.memory_map(path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(split_blocks=True), table.schema.metadata or {}
+
+def _entry_size(entry_dir):
+    return sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+
+# Function to load a previously parsed upload (raw frame, date side-car and column profiles) by content hash
+def load_cached_upload(fingerprint, cache_dir=UPLOAD_CACHE_DIR):
+    entry_dir = os.path.join(cache_dir, fingerprint)
+    if not os.path.isdir(entry_dir):
+        return None
+    try:
+        data, _ = _read_arrow(os.path.join(entry_dir, "data.arrow"))
+        derived, metadata = _read_arrow(os.path.join(entry_dir, "derived.arrow"))
+        with open(os.path.join(entry_dir, "profiles.json"), encoding="utf-8") as f:
+            profiles = {col: ColumnProfile.from_dict(profile) for col, profile in json.load(f).items()}
+    except (OSError, ValueError, pa.ArrowException):
+        # A partial or corrupt entry is treated as a miss and rebuilt
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        return None
+    derived.index = data.index
+    derived.attrs["date_columns"] = json.loads(metadata.get(b"date_columns", b"[]"))
+    # Touch the entry so LRU eviction sees it as recently used
+    os.utime(entry_dir)
+    return data, derived, profiles
+
+# Function to persist a parsed upload and evict least recently used entries over the size limit
+def store_cached_upload(fingerprint, data, derived, profiles, cache_dir=UPLOAD_CACHE_DIR, max_bytes=UPLOAD_CACHE_MAX_BYTES):
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_dir = os.path.join(cache_dir, fingerprint)
+    # Write into a temporary directory and rename, so readers never see half-written entries
+    staging_dir = f"{entry_dir}.tmp-{os.getpid()}-{time.monotonic_ns()}"
+    os.makedirs(staging_dir)
+    try:
+        _write_arrow(data, os.path.join(staging_dir, "data.arrow"))
+        metadata = {b"date_columns": json.dumps(derived.attrs.get("date_columns", [])).encode("utf-8")}
+        _write_arrow(derived, os.path.join(staging_dir, "derived.arrow"), metadata)
+        with open(os.path.join(staging_dir, "profiles.json"), "w", encoding="utf-8") as f:
+            json.dump({col: profile.to_dict() for col, profile in profiles.items()}, f)
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(staging_dir, entry_dir)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    evict_upload_cache(cache_dir, max_bytes, keep=fingerprint)
+
+# Function to trim the upload cache to max_bytes, oldest access first
+def evict_upload_cache(cache_dir=UPLOAD_CACHE_DIR, max_bytes=UPLOAD_CACHE_MAX_BYTES, keep=None):
+    if not os.path.isdir(cache_dir):
+        return
+    entries = [entry for entry in os.scandir(cache_dir) if entry.is_dir() and ".tmp-" not in entry.name]
+    sizes = {entry.path: _entry_size(entry.path) for entry in entries}
+    total = sum(sizes.values())
+    for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+        if total <= max_bytes:
+            break
+        if entry.name == keep:
+            continue
+        shutil.rmtree(entry.path, ignore_errors=True)
+        total -= sizes[entry.path]
@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+from tracing import Trace, activate
+
+# Background workers shared by every session (precomputation after upload, "refine to exact")
+BACKGROUND_WORKERS = int(os.environ.get("BACKGROUND_WORKERS", "1"))
+# How long a finished job waits for a session to collect its result before it is dropped
+JOB_RESULT_SECONDS = float(os.environ.get("JOB_RESULT_MINUTES", "10")) * 60
+
+# Raised inside a job at its next stage once the job has been cancelled
+class JobCancelled(Exception):
+    pass
+
+# One unit of background work. The work reports progress through the tracing spans it already
+# opens: each span that starts becomes the job's current stage, and is also where a cancelled
+# job stops.
+class Job:
+    def __init__(self, key, label):
+        self.key = key
+        self.label = label
+        self.future = None
+        # Sessions waiting on the result; the job is cancelled once the last one lets go
+        self.holders = set()
+        self.cancel_event = threading.Event()
+        self.stage = None
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+
+    def _on_span(self, name, attrs):
+        if self.cancel_event.is_set():
+            raise JobCancelled(f"{self.label} was cancelled")
+        self.stage = f"{name} ({attrs['column']})" if "column" in attrs else name
+
+    def run(self, fn, args):
+        self.started = time.monotonic()
+        try:
+            if self.cancel_event.is_set():
+                raise JobCancelled(f"{self.label} was cancelled")
+            with activate(Trace(self.label, on_span=self._on_span)):
+                return fn(*args)
+        finally:
+            self.finished = time.monotonic()
+
+    def cancel(self):
+        self.cancel_event.set()
+        # Jobs still queued never start; running ones stop at their next stage
+        self.future.cancel()
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        try:
+            return self.future.result(timeout)
+        except CancelledError:
+            raise JobCancelled(f"{self.label} was cancelled") from None
+
+    # Function to describe where the job is, e.g. "monthly aggregations (order_date), 1.2s"
+    def describe(self):
+        if self.started is None:
+            return f"queued for {time.monotonic() - self.submitted:.1f}s"
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return f"{self.stage or 'starting'}, {elapsed:.1f}s"
+
+# Process-wide runner that deduplicates background work by key. Sessions submitting the same
+# key share one job (in flight or finished), release it when they no longer need it, and the
+# job is cancelled once nobody holds it. Finished jobs nobody collects are dropped after
+# result_seconds, which also covers sessions that closed without releasing.
+class JobRunner:
+    def __init__(self, max_workers=BACKGROUND_WORKERS, result_seconds=JOB_RESULT_SECONDS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="background")
+        self.result_seconds = result_seconds
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    # Function to start fn(*args) under key, or join the job already running or finished under it
+    def submit(self, key, holder, label, fn, *args):
+        self.evict_finished()
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None or job.cancelled():
+                job = Job(key, label)
+                job.future = self.executor.submit(job.run, fn, args)
+                self.jobs[key] = job
+            job.holders.add(holder)
+            return job
+
+    def get(self, key):
+        with self.lock:
+            return self.jobs.get(key)
+
+    # Function to take a finished job out of the runner once its result has been collected
+    def discard(self, job):
+        with self.lock:
+            if self.jobs.get(job.key) is job:
+                del self.jobs[job.key]
+
+    def release(self, key, holder):
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None:
+                return
+            job.holders.discard(holder)
+            if not job.holders:
+                del self.jobs[key]
+                if not job.done():
+                    job.cancel()
+
+    def evict_finished(self):
+        cutoff = time.monotonic() - self.result_seconds
+        with self.lock:
+            for key, job in list(self.jobs.items()):
+                if job.done() and (job.finished or job.submitted) < cutoff:
+                    del self.jobs[key]
@@ -0,0 +1,310 @@
+import bisect
+import hashlib
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from types import SimpleNamespace
+
+# On-disk response cache location and limits
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", os.path.join(".cache", "responses.sqlite3"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_HOURS", "24")) * 3600
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_MB", "64")) * 1024 * 1024
+
+# Limits for calls to the model, shared by every session in the process
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_QUEUE = int(os.environ.get("LLM_MAX_QUEUE", "32"))
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", "60"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+
+# Error type names and status codes worth retrying (rate limits, overload, transient server errors)
+RETRYABLE_ERROR_NAMES = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded",
+                         "InternalServerError", "GatewayTimeout", "Aborted"}
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Wraps a streaming generate_content call: yields text as it arrives and records
+# time-to-first-token, total time and the full text once the stream is exhausted.
+class ResponseStream:
+    def __init__(self, model, prompt):
+        self.model = model
+        self.prompt = prompt
+        self.parts = []
+        self.first_token_seconds = None
+        self.total_seconds = None
+
+    def __iter__(self):
+        start = time.perf_counter()
+        for chunk in self.model.generate_content(self.prompt, stream=True):
+            try:
+                text = chunk.text
+            except ValueError:
+                # Gemini raises on chunks without text parts (e.g. safety or finish markers)
+                continue
+            if not text:
+                continue
+            if self.first_token_seconds is None:
+                self.first_token_seconds = time.perf_counter() - start
+            self.parts.append(text)
+            yield text
+        self.total_seconds = time.perf_counter() - start
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+# Local stand-in for genai.GenerativeModel that yields canned chunks with configurable
+# delays. Used for development without an API key and for timing the streaming path.
+class FakeModel:
+    def __init__(self, chunks=None, first_delay=0.5, chunk_delay=0.05, model_name="fake-model", error_rate=0.0, seed=None):
+        self.chunks = chunks
+        self.first_delay = first_delay
+        self.chunk_delay = chunk_delay
+        self.model_name = model_name
+        # Fraction of calls that fail with a rate-limit error before producing any output
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    def _chunks_for(self, prompt):
+        if self.chunks is not None:
+            return list(self.chunks)
+        words = f"This is a local fake response to a {len(prompt)}-character prompt.".split(" ")
+        return [word + " " for word in words]
+
+    def _stream(self, prompt):
+        time.sleep(self.first_delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise FakeRateLimitError("fake model: quota exceeded")
+        for index, text in enumerate(self._chunks_for(prompt)):
+            if index:
+                time.sleep(self.chunk_delay)
+            yield SimpleNamespace(text=text)
+
+    def generate_content(self, prompt, stream=False, request_options=None):
+        if stream:
+            return self._stream(prompt)
+        return SimpleNamespace(text="".join(chunk.text for chunk in self._stream(prompt)))
+
+# Error raised by FakeModel to imitate a 429 from the Gemini API
+class FakeRateLimitError(Exception):
+    code = 429
+
+# Raised when too many requests are already waiting for a model slot
+class LLMOverloadedError(Exception):
+    pass
+
+# Function to decide whether a failed model call is worth retrying
+def is_retryable_error(error):
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if type(error).__name__ in RETRYABLE_ERROR_NAMES:
+        return True
+    code = getattr(error, "code", None)
+    code = code() if callable(code) else code
+    return getattr(code, "value", code) in RETRYABLE_STATUS_CODES
+
+# Thread-safe counters and a latency histogram for the model client
+class ClientMetrics:
+    LATENCY_BUCKETS = [0.5, 1, 2, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.rejected = 0
+        self.latency_counts = [0] * (len(self.LATENCY_BUCKETS) + 1)
+
+    def add(self, **deltas):
+        with self.lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def observe_latency(self, seconds):
+        with self.lock:
+            self.latency_counts[bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+
+    def snapshot(self):
+        with self.lock:
+            labels = [f"<={bound}s" for bound in self.LATENCY_BUCKETS] + [f">{self.LATENCY_BUCKETS[-1]}s"]
+            return {
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "retries": self.retries,
+                "rejected": self.rejected,
+                "latency_histogram": dict(zip(labels, self.latency_counts)),
+            }
+
+# Wraps a GenerativeModel (or FakeModel) with the same generate_content interface, adding:
+# a global concurrency limit with a bounded wait queue, per-request timeouts, retries with
+# exponential backoff and jitter, thread-pool execution for blocking calls, and metrics.
+class LLMClient:
+    def __init__(self, model, max_concurrency=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE,
+                 timeout=LLM_TIMEOUT_SECONDS, max_retries=LLM_MAX_RETRIES,
+                 backoff_base=1.0, backoff_max=20.0):
+        self.model = model
+        self.model_name = getattr(model, "model_name", "unknown")
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency + max_queue, thread_name_prefix="llm")
+        self.metrics = ClientMetrics()
+
+    def _backoff_seconds(self, attempt):
+        # Full jitter: a random wait up to the exponential cap spreads out synchronized retries
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _enqueue(self):
+        with self.metrics.lock:
+            if self.metrics.queued >= self.max_queue:
+                self.metrics.rejected += 1
+                raise LLMOverloadedError("The model is busy with other requests. Please try again shortly.")
+            self.metrics.queued += 1
+
+    def _acquire_slot(self):
+        # Waiting here is the queue; the semaphore caps concurrent calls across all sessions
+        try:
+            self.slots.acquire()
+        finally:
+            self.metrics.add(queued=-1)
+        self.metrics.add(in_flight=1)
+
+    def _release_slot(self, start, failed):
+        self.metrics.add(in_flight=-1, completed=0 if failed else 1, failed=1 if failed else 0)
+        self.metrics.observe_latency(time.perf_counter() - start)
+        self.slots.release()
+
+    def _call_with_retries(self, prompt):
+        self._acquire_slot()
+        start = time.perf_counter()
+        failed = True
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = self.model.generate_content(prompt, request_options={"timeout": self.timeout})
+                    failed = False
+                    return response
+                except Exception as e:
+                    if attempt == self.max_retries or not is_retryable_error(e):
+                        raise
+                    self.metrics.add(retries=1)
+                    time.sleep(self._backoff_seconds(attempt))
+        finally:
+            self._release_slot(start, failed)
+
+    # Generator: nothing runs until the first chunk is requested, so the request joins the queue
+    # here rather than when the stream is created; a stream that is never iterated holds nothing
+    def _stream_with_retries(self, prompt):
+        self._enqueue()
+        self._acquire_slot()
+        start = time.perf_counter()
+        failed = True
+        try:
+            for attempt in range(self.max_retries + 1):
+                started_output = False
+                try:
+                    for chunk in self.model.generate_content(prompt, stream=True, request_options={"timeout": self.timeout}):
+                        started_output = True
+                        yield chunk
+                    failed = False
+                    return
+                except Exception as e:
+                    # Once text has been shown, retrying would duplicate it, so only retry before that
+                    if started_output or attempt == self.max_retries or not is_retryable_error(e):
+                        raise
+                    self.metrics.add(retries=1)
+                    time.sleep(self._backoff_seconds(attempt))
+        finally:
+            self._release_slot(start, failed)
+
+    # Function to run a blocking call on the pool and return a Future
+    def submit(self, prompt):
+        self._enqueue()
+        return self.executor.submit(self._call_with_retries, prompt)
+
+    def generate_content(self, prompt, stream=False):
+        if stream:
+            return self._stream_with_retries(prompt)
+        # Upper bound on the wait: every attempt timing out plus the longest backoffs
+        deadline = (self.timeout + self.backoff_max) * (self.max_retries + 1)
+        return self.submit(prompt).result(timeout=deadline)
+
+# Function to normalize a prompt so incidental whitespace differences map to the same cache key
+def normalize_prompt(prompt):
+    return " ".join(str(prompt).split())
+
+# SQLite-backed cache of model responses keyed on model name plus normalized prompt.
+# Entries expire after a TTL and the least recently used are evicted past max_bytes.
+class ResponseCache:
+    def __init__(self, path=RESPONSE_CACHE_PATH, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, "
+                "created REAL, accessed REAL, size INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    def _connect(self):
+        # A short-lived connection per call keeps the cache safe to share across Streamlit threads
+        return closing(sqlite3.connect(self.path, timeout=10))
+
+    @staticmethod
+    def make_key(model_name, prompt):
+        payload = f"{model_name}\n{normalize_prompt(prompt)}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, model_name, prompt):
+        key = self.make_key(model_name, prompt)
+        now = time.time()
+        with self._connect() as conn, conn:
+            row = conn.execute(
+                "SELECT response FROM responses WHERE key = ? AND created >= ?",
+                (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, model_name, prompt, response):
+        key = self.make_key(model_name, prompt)
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._connect() as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created, accessed, size) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_name, response, now, now, size)
+            )
+            conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale_keys = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed ASC"):
+            if total <= self.max_bytes:
+                break
+            stale_keys.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
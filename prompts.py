@@ -0,0 +1,293 @@
+import json
+import os
+import re
+
+# Approximate token budget for the whole analysis prompt sent to Gemini
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "12000"))
+# Tokens set aside for a prompt template's fixed instructions
+PROMPT_TEMPLATE_TOKENS = 700
+# Most of the budget left after the question and instructions that column descriptions and
+# dictionary entries may each take; whatever they leave goes to the analysis sections
+COLUMN_INFO_SHARE = 0.25
+DICTIONARY_SHARE = 0.25
+
+# Sections that are always sent because they describe the dataset as a whole
+# (sampling_notes is only present when the figures are estimates from a sample)
+CORE_KEYS = ["all_columns", "row_count", "column_types", "sampling_notes"]
+
+# Question words that signal interest in a kind of analysis rather than a specific column
+TIME_TERMS = {"month", "monthly", "trend", "trends", "time", "year", "yearly", "over", "growth", "season", "seasonal", "date", "week", "period"}
+CORRELATION_TERMS = {"correlation", "correlate", "correlated", "relationship", "related", "relate", "affect", "impact", "drive", "driver"}
+BREAKDOWN_TERMS = {"by", "per", "category", "categories", "breakdown", "segment", "group", "top", "best", "worst", "compare", "split"}
+
+STOP_WORDS = {"the", "a", "an", "of", "in", "on", "for", "to", "and", "or", "is", "are", "what", "which", "how",
+              "me", "show", "give", "tell", "with", "was", "were", "do", "does", "my", "our", "all", "this", "that"}
+
+# Function to estimate token count from text length (about four characters per token)
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+# Function to serialize analysis data compactly (no indentation or padding)
+def compact_json(data):
+    return json.dumps(data, separators=(",", ":"), default=str)
+
+# Function to split text or identifiers into lowercase word tokens with naive plural stripping
+def tokenize(text):
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", str(text))
+    tokens = set()
+    for word in re.split(r"[^0-9a-zA-Z]+", text.lower()):
+        if not word or (len(word) < 2 and not word.isdigit()) or word in STOP_WORDS:
+            continue
+        tokens.add(word)
+        if len(word) > 3 and word.endswith("s"):
+            tokens.add(word[:-1])
+    return tokens
+
+def _trigrams(text):
+    text = re.sub(r"[^0-9a-z]+", "", str(text).lower())
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+# Function to score how relevant each column is to the question, using its name and dictionary entry
+def score_columns(question, columns, column_descriptions=None):
+    column_descriptions = column_descriptions or {}
+    question_tokens = tokenize(question)
+    question_trigrams = _trigrams(question)
+    scores = {}
+    for col in columns:
+        name_tokens = tokenize(col)
+        score = 3.0 * len(question_tokens & name_tokens)
+
+        # Dictionary descriptions add weaker evidence
+        entry = column_descriptions.get(col)
+        if isinstance(entry, dict):
+            entry = f"{entry.get('description', '')} {entry.get('data_type', '')}"
+        if entry:
+            score += 1.0 * len(question_tokens & tokenize(entry))
+
+        # Character trigram overlap catches partial names like "rev" vs "revenue"
+        col_trigrams = _trigrams(col)
+        if col_trigrams and question_trigrams:
+            score += 2.0 * len(col_trigrams & question_trigrams) / len(col_trigrams)
+        scores[col] = score
+    return scores
+
+# Function to split "{a}_{b}" into two known column names, trying every underscore as the
+# separator since column names may contain underscores themselves
+def _split_pair(text, first_columns, second_columns):
+    position = text.find("_")
+    while position != -1:
+        if text[:position] in first_columns and text[position + 1:] in second_columns:
+            return [text[:position], text[position + 1:]]
+        position = text.find("_", position + 1)
+    return []
+
+# Function to find which columns an analysis key is about. Keys follow the layouts the analysis
+# builds: "{col}", "{col}_is_date", "{date}_monthly_distribution", "monthly_{date}_{value}" and
+# "{cat}_{value}_analysis"; they are parsed against the column set, never scanned per column.
+def _key_columns(key, columns):
+    if key in columns:
+        return [key]
+    for suffix in ("_is_date", "_monthly_distribution"):
+        if key.endswith(suffix) and key[:-len(suffix)] in columns:
+            return [key[:-len(suffix)]]
+    if key.startswith("monthly_"):
+        related = _split_pair(key[len("monthly_"):], columns, columns)
+        if related:
+            return related
+    if key.endswith("_analysis"):
+        return _split_pair(key[:-len("_analysis")], columns, columns)
+    return []
+
+# Function to rank every analysis section by relevance to the question
+def rank_analysis_keys(question, analysis, column_descriptions=None, column_scores=None):
+    columns = analysis.get("all_columns", [])
+    if column_scores is None:
+        column_scores = score_columns(question, columns, column_descriptions)
+    column_set = set(columns)
+    question_tokens = tokenize(question)
+    wants_time = bool(question_tokens & TIME_TERMS)
+    wants_correlation = bool(question_tokens & CORRELATION_TERMS)
+    wants_breakdown = bool(question_tokens & BREAKDOWN_TERMS)
+
+    ranked = []
+    for position, key in enumerate(analysis):
+        if key in CORE_KEYS:
+            continue
+        related = _key_columns(key, column_set)
+        score = sum(column_scores.get(col, 0.0) for col in related)
+        if key == "correlation_matrix":
+            # The matrix covers every numeric column, so rank it with the best matching column
+            if wants_correlation:
+                score = max(column_scores.values(), default=0.0) + 10.0
+        elif key.startswith("monthly_") or key.endswith("_monthly_distribution"):
+            score += 3.0 if wants_time else 0.0
+        elif key.endswith("_analysis"):
+            score += 2.0 if wants_breakdown else 0.0
+        elif key in column_set or key.endswith("_is_date"):
+            # Per-column summaries are small and broadly useful
+            score += 1.0
+        ranked.append((score, position, key))
+
+    # Highest score first; ties keep the analysis order so output is deterministic
+    ranked.sort(key=lambda item: (-item[0], item[1]))
+    return [(key, score) for score, _, key in ranked]
+
+# Function to keep the highest-scoring lines that fit in token_budget. lines is a list of
+# (key, text) in display order and scores maps keys to relevance (missing keys score 0).
+# Returns the kept texts, still in display order, and how many lines were left out.
+def select_lines(lines, scores, token_budget):
+    ranked = sorted(range(len(lines)), key=lambda position: -scores.get(lines[position][0], 0.0))
+    kept, used_tokens = set(), 0
+    for position in ranked:
+        line_tokens = estimate_tokens(lines[position][1])
+        if used_tokens + line_tokens <= token_budget:
+            kept.add(position)
+            used_tokens += line_tokens
+    return [text for position, (_, text) in enumerate(lines) if position in kept], len(lines) - len(kept)
+
+# Inverted index over data dictionary entries, built once per dictionary, so scoring a question
+# against a large dictionary only touches the entries that share a word with it. Field names
+# weigh more than descriptions, as in score_columns.
+class DictionaryIndex:
+    def __init__(self, column_descriptions):
+        self.entries = column_descriptions
+        self.positions = {field: position for position, field in enumerate(column_descriptions)}
+        self.postings = {}
+        for field, entry in column_descriptions.items():
+            weights = dict.fromkeys(tokenize(field), 3.0)
+            if isinstance(entry, dict):
+                entry = f"{entry.get('description', '')} {entry.get('data_type', '')}"
+            for token in tokenize(entry or ""):
+                weights[token] = weights.get(token, 0.0) + 1.0
+            for token, weight in weights.items():
+                self.postings.setdefault(token, []).append((field, weight))
+
+    # Function to score the entries that share at least one word with the question
+    def score(self, question):
+        scores = {}
+        for token in tokenize(question):
+            for field, weight in self.postings.get(token, ()):
+                scores[field] = scores.get(field, 0.0) + weight
+        return scores
+
+# Function to format a dictionary entry like process_data_dictionary does
+def format_dictionary_entry(field, entry):
+    entry = entry if isinstance(entry, dict) else {"description": entry or ""}
+    data_type, description = entry.get("data_type", ""), entry.get("description", "")
+    line = f"- {field}"
+    if data_type:
+        line += f": {data_type}"
+    if description:
+        line += f". {description}" if data_type else f": {description}"
+    if entry.get("table"):
+        line += f" (table {entry['table']})"
+    return line
+
+# Function to pick the dictionary entries worth sending with a question: those mapped to a
+# column, ranked by that column's relevance, and those whose own words match the question.
+# Entries are kept in dictionary order within token_budget; the rest are counted, not sent.
+def build_dictionary_context(question, index, column_scores, column_mapping, token_budget):
+    if index is None or not index.entries:
+        return "No data dictionary provided."
+    scores = index.score(question)
+    for col, (field, _) in column_mapping.items():
+        if field in index.entries:
+            # Mapped entries are kept even when the question does not mention their column
+            scores[field] = scores.get(field, 0.0) + column_scores.get(col, 0.0) + 0.5
+    fields = sorted((field for field, score in scores.items() if score > 0), key=index.positions.get)
+    lines = [(field, format_dictionary_entry(field, index.entries[field])) for field in fields]
+    kept, omitted = select_lines(lines, scores, token_budget - 20)
+    omitted += len(index.entries) - len(fields)
+    if omitted:
+        kept.append(f"- {omitted} more entries not related to this question are omitted")
+    return "\n".join(kept)
+
+# Function to shrink the column listing (all_columns and column_types) of a wide upload to the
+# columns most relevant to the question, within token_budget
+def _trim_column_listing(payload, column_scores, token_budget):
+    columns = payload.get("all_columns", [])
+    column_types = payload.get("column_types", {})
+    lines = [(col, compact_json([col, column_types.get(col)])) for col in columns]
+    kept, omitted = select_lines(lines, column_scores, token_budget)
+    kept = set(kept)
+    kept_columns = [col for col, text in lines if text in kept]
+    payload["all_columns"] = kept_columns
+    if "column_types" in payload:
+        payload["column_types"] = {col: column_types[col] for col in kept_columns if col in column_types}
+    payload["columns_omitted"] = omitted
+
+# Function to cut a correlation matrix too large for token_budget down to the columns most
+# relevant to the question: columns named in the question first, then by column score. Keeps
+# as many columns as fit; returns None when not even a pair does.
+def _shrink_correlation_matrix(matrix, question, column_scores, token_budget):
+    question_text = question.lower()
+    columns = sorted(matrix, key=lambda col: (str(col).lower() not in question_text, -column_scores.get(col, 0.0)))
+    def sub_matrix(count):
+        kept = columns[:count]
+        return {col: {other: matrix[col].get(other) for other in kept} for col in kept}
+    # The matrix grows with the square of its width, so search for the widest one that fits
+    low, high = 1, len(columns)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(compact_json({"correlation_matrix": sub_matrix(middle)})) <= token_budget:
+            low = middle
+        else:
+            high = middle - 1
+    return sub_matrix(low) if low >= 2 else None
+
+# Function to pick the most relevant analysis sections that fit in the token budget. The
+# dataset-wide sections are always sent, but on wide uploads the column listing is cut to the
+# most relevant columns so the payload never exceeds the budget. A correlation matrix that does
+# not fit is narrowed to the most relevant columns instead of being dropped.
+# Returns the compact JSON payload and a small report used for logging.
+def build_analysis_payload(question, analysis, column_descriptions=None, token_budget=PROMPT_TOKEN_BUDGET,
+                           column_scores=None):
+    if column_scores is None:
+        column_scores = score_columns(question, analysis.get("all_columns", []), column_descriptions)
+    # Leave room for the list of omitted section names
+    omitted_budget = min(400, token_budget // 10)
+    section_budget = token_budget - omitted_budget
+    payload = {key: analysis[key] for key in CORE_KEYS if key in analysis}
+    full_tokens = estimate_tokens(compact_json(payload))
+    if full_tokens > section_budget // 2 and "all_columns" in payload:
+        _trim_column_listing(payload, column_scores, section_budget // 2)
+    used_tokens = estimate_tokens(compact_json(payload))
+    omitted = []
+
+    for key, score in rank_analysis_keys(question, analysis, column_descriptions, column_scores):
+        section_tokens = estimate_tokens(compact_json({key: analysis[key]}))
+        full_tokens += section_tokens
+        if used_tokens + section_tokens <= section_budget:
+            payload[key] = analysis[key]
+            used_tokens += section_tokens
+            continue
+        if key == "correlation_matrix" and isinstance(analysis[key], dict):
+            # At most half the sections' budget, so the columns it covers can still be summarized;
+            # 20 tokens are left for the count of columns left out
+            matrix = _shrink_correlation_matrix(
+                analysis[key], question, column_scores, min(section_budget - used_tokens, section_budget // 2) - 20
+            )
+            if matrix is not None:
+                payload[key] = matrix
+                payload["correlation_columns_omitted"] = len(analysis[key]) - len(matrix)
+                used_tokens += estimate_tokens(compact_json({key: matrix})) + 20
+                continue
+        omitted.append(key)
+
+    if omitted:
+        # Tell the model what exists but was left out, so it can say what is missing
+        names, _ = select_lines([(key, compact_json(key)) for key in omitted[:50]], {}, omitted_budget - 10)
+        payload["omitted_sections"] = [json.loads(name) for name in names]
+        if len(omitted) > len(names):
+            payload["omitted_sections"].append(f"... and {len(omitted) - len(names)} more")
+
+    payload_json = compact_json(payload)
+    report = {
+        # Sum of the compact section sizes: an indented dump of a wide analysis would take longer
+        # to serialize than the analysis took to compute
+        "full_tokens": full_tokens,
+        "sent_tokens": estimate_tokens(payload_json),
+        "sections_sent": len(payload) - (1 if omitted else 0) - (1 if "correlation_columns_omitted" in payload else 0),
+        "sections_omitted": len(omitted),
+    }
+    return payload_json, report
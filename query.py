@@ -0,0 +1,122 @@
+import os
+import re
+import sqlite3
+import time
+
+import pandas as pd
+
+from prompts import compact_json, estimate_tokens, select_lines
+from store import STORE_TABLE
+
+# Limits for model-written queries run against the uploaded data
+QUERY_MAX_ROWS = int(os.environ.get("QUERY_MAX_ROWS", "200"))
+QUERY_TIMEOUT_SECONDS = float(os.environ.get("QUERY_TIMEOUT_SECONDS", "10"))
+QUERY_RESULT_TOKEN_BUDGET = int(os.environ.get("QUERY_RESULT_TOKEN_BUDGET", "3000"))
+
+# Statement kinds a query may perform; anything else (writes, PRAGMA, ATTACH, ...) is denied
+ALLOWED_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+BLOCKED_FUNCTIONS = {"load_extension", "randomblob", "zeroblob", "readfile", "writefile"}
+
+# Raised when a query is rejected, fails, or runs past its limits
+class QueryError(Exception):
+    pass
+
+# Function to pull a single SQL statement out of a model reply (code fences and trailing ";" removed)
+def extract_sql(text):
+    fenced = re.search(r"```(?:sql|sqlite)?\s*(.*?)```", text, re.DOTALL | re.IGNORECASE)
+    sql = (fenced.group(1) if fenced else text).strip().rstrip(";").strip()
+    if not re.match(r"(select|with)\b", sql, re.IGNORECASE):
+        raise QueryError("The model did not return a SELECT query.")
+    if ";" in re.sub(r"'(?:[^']|'')*'", "", sql):
+        raise QueryError("Only a single SELECT statement is allowed.")
+    return sql
+
+# Function to allow read-only access to the data table and nothing else
+def _authorizer(action, arg1, arg2, db_name, trigger):
+    if action not in ALLOWED_ACTIONS:
+        return sqlite3.SQLITE_DENY
+    if action == sqlite3.SQLITE_FUNCTION and str(arg2).lower() in BLOCKED_FUNCTIONS:
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
+# Result of one query: the (possibly truncated) rows plus how long it took
+class QueryResult:
+    def __init__(self, sql, frame, truncated, seconds):
+        self.sql = sql
+        self.frame = frame
+        self.truncated = truncated
+        self.seconds = seconds
+
+    # Function to serialize the result for the answer prompt, dropping rows past the token budget
+    def to_prompt_json(self, token_budget=QUERY_RESULT_TOKEN_BUDGET):
+        records = self.frame.astype(object).where(self.frame.notna(), None).to_dict("records")
+        payload = {"columns": self.frame.columns.tolist(), "rows": records, "truncated": self.truncated}
+        payload_json = compact_json(payload)
+        while records and estimate_tokens(payload_json) > token_budget:
+            records = records[:len(records) // 2]
+            payload = {"columns": self.frame.columns.tolist(), "rows": records, "truncated": True}
+            payload_json = compact_json(payload)
+        return payload_json
+
+# Runs model-written SELECT queries against an upload's embedded store in a sandbox: the
+# store file is opened read-only, an authorizer denies everything except reads, a progress
+# handler aborts queries past the time limit, and only max_rows rows are fetched. The store
+# connection is shared across sessions, so queries on one store run one at a time.
+class QueryEngine:
+    def __init__(self, store):
+        self.store = store
+
+    def execute(self, sql, max_rows=QUERY_MAX_ROWS, timeout=QUERY_TIMEOUT_SECONDS):
+        conn = self.store.conn
+        with self.store.lock:
+            start = time.perf_counter()
+            deadline = start + timeout
+            conn.set_authorizer(_authorizer)
+            # Returning a true value from the progress handler interrupts the running query
+            conn.set_progress_handler(lambda: time.perf_counter() > deadline, 10_000)
+            try:
+                cursor = conn.execute(sql)
+                rows = cursor.fetchmany(max_rows + 1)
+                columns = [description[0] for description in cursor.description or []]
+            except sqlite3.DatabaseError as e:
+                if time.perf_counter() > deadline:
+                    raise QueryError(f"The query took longer than {timeout:g} seconds and was stopped.") from e
+                raise QueryError(f"The query failed: {e}") from e
+            finally:
+                conn.set_progress_handler(None, 0)
+                conn.set_authorizer(None)
+            seconds = time.perf_counter() - start
+        truncated = len(rows) > max_rows
+        return QueryResult(sql, pd.DataFrame(rows[:max_rows], columns=columns), truncated, seconds)
+
+    # Function to describe the table for the query prompt: one line per column with its SQL
+    # type, role and a few example values taken from the upload-time column profiles. With a
+    # token_budget, the columns most relevant to the question (by column_scores) are kept.
+    def describe_schema(self, column_profiles=None, column_scores=None, token_budget=None):
+        store = self.store
+        lines = []
+        for col in store.columns:
+            line = f'- "{col}" {store.sql_types.get(col, "")}'.rstrip()
+            profile = (column_profiles or {}).get(col)
+            if col in store.date_columns:
+                line += " (date stored as 'YYYY-MM-DD HH:MM:SS' text, indexed)"
+            elif profile is not None:
+                line += f" (role: {profile.role}"
+                if profile.role == "value" and profile.min is not None:
+                    line += f", range {profile.min} to {profile.max}"
+                elif profile.top_values:
+                    examples = ", ".join(repr(str(value)) for value in list(profile.top_values)[:5])
+                    line += f", e.g. {examples}"
+                if profile.role == "category":
+                    line += ", indexed"
+                line += ")"
+            lines.append((col, line))
+        for col in store.date_columns:
+            lines.append((col, f'- "month_year_{col}" TEXT (month of "{col}" as \'YYYY-MM\', indexed)'))
+        if token_budget is None:
+            kept, omitted = [line for _, line in lines], 0
+        else:
+            kept, omitted = select_lines(lines, column_scores or {}, token_budget - 30)
+        if omitted:
+            kept.append(f"- {omitted} more columns not related to this question are omitted")
+        return "\n".join([f'Table "{STORE_TABLE}":'] + kept)
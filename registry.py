@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+
+# How long a dataset may go without any session touching it before it is dropped
+DATASET_IDLE_SECONDS = float(os.environ.get("DATASET_IDLE_MINUTES", "30")) * 60
+
+# One uploaded dataset shared by every session that uploaded the same content
+class DatasetEntry:
+    def __init__(self, fingerprint, data, derived_data, column_profiles):
+        self.fingerprint = fingerprint
+        self.data = data
+        self.derived_data = derived_data
+        self.column_profiles = column_profiles
+        # session id -> last time that session used this dataset
+        self.holders = {}
+        self.last_used = time.monotonic()
+
+    # Function to hand a session its own shallow view: columns are shared, but structural
+    # changes (adding or dropping columns) on the view never reach the shared frame
+    def view(self):
+        data = self.data.copy(deep=False)
+        derived_data = self.derived_data.copy(deep=False)
+        derived_data.attrs = dict(self.derived_data.attrs)
+        return data, derived_data, self.column_profiles
+
+# Process-wide registry that deduplicates uploaded datasets by content hash.
+# Sessions acquire a dataset (loading it only if no other session holds it), touch it on
+# every rerun, and release it when they upload something else or append to it. A dataset is
+# dropped as soon as its last holder releases it, so a replaced or appended-to frame does not
+# linger next to its successor. Datasets nobody has touched for idle_seconds are evicted,
+# which covers sessions that closed without releasing.
+class DatasetRegistry:
+    def __init__(self, idle_seconds=DATASET_IDLE_SECONDS):
+        self.idle_seconds = idle_seconds
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load_locks = {}
+
+    def acquire(self, fingerprint, session_id, loader):
+        self.evict_idle()
+        # Serialize loads per fingerprint so concurrent uploads of one file parse it once
+        with self.lock:
+            load_lock = self.load_locks.setdefault(fingerprint, threading.Lock())
+        with load_lock:
+            with self.lock:
+                entry = self.entries.get(fingerprint)
+            if entry is None:
+                data, derived_data, column_profiles = loader()
+                entry = DatasetEntry(fingerprint, data, derived_data, column_profiles)
+                with self.lock:
+                    self.entries[fingerprint] = entry
+        with self.lock:
+            entry.holders[session_id] = time.monotonic()
+            entry.last_used = time.monotonic()
+            self.load_locks.pop(fingerprint, None)
+        return entry.view()
+
+    def touch(self, fingerprint, session_id):
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is None:
+                return False
+            entry.holders[session_id] = entry.last_used = time.monotonic()
+            return True
+
+    def release(self, fingerprint, session_id):
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is not None:
+                entry.holders.pop(session_id, None)
+                entry.last_used = time.monotonic()
+                if not entry.holders:
+                    del self.entries[fingerprint]
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_seconds
+        with self.lock:
+            for fingerprint, entry in list(self.entries.items()):
+                # Forget sessions that stopped using the dataset without releasing it
+                entry.holders = {session: seen for session, seen in entry.holders.items() if seen >= cutoff}
+                if not entry.holders and entry.last_used < cutoff:
+                    del self.entries[fingerprint]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "datasets": len(self.entries),
+                "sessions": sum(len(entry.holders) for entry in self.entries.values()),
+                "memory_mb": round(sum(
+                    int(entry.data.memory_usage(deep=False).sum()) for entry in self.entries.values()
+                ) / 1e6, 1),
+            }
@@ -0,0 +1,289 @@
+import math
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from analysis import (CATEGORY_MAX_UNIQUE, add_profile_sections, analyze_data_for_question, classify_columns,
+                      convert_to_native_types, pick_value_columns)
+from tracing import span
+
+# Approximate mode: how long the sampled analysis should take, and the bounds on the sample size
+SAMPLE_TARGET_SECONDS = float(os.environ.get("SAMPLE_TARGET_SECONDS", "2"))
+SAMPLE_MIN_ROWS = int(os.environ.get("SAMPLE_MIN_ROWS", "50000"))
+# Row counts timed on the first run, for both the sampled and the exact analysis, to learn how
+# fast they go on this dataset: the difference between the two gives the per-row rate, what
+# is left of the smaller one is the fixed cost every run pays whatever its size
+SAMPLE_PILOT_ROWS = (20_000, 100_000)
+# Every stratum keeps at least this many sampled rows (or all of its rows), so small months
+# and categories still get usable estimates
+SAMPLE_MIN_PER_STRATUM = 30
+# Most frequent values of the stratifying category that get their own strata; the rest share one
+SAMPLE_TOP_CATEGORIES = 10
+
+# z for two-sided 95% confidence intervals
+Z_95 = 1.959964
+
+# Strata for one upload: the month of the first date column crossed with the most frequent
+# values of one category column. Rows are sorted by stratum once, so drawing a sample only
+# touches the sampled rows. Built once per upload; remembers how fast analysis ran on it.
+class SamplingPlan:
+    def __init__(self, transaction_data, derived_data, column_profiles, top_categories=SAMPLE_TOP_CATEGORIES):
+        self.population_rows = len(transaction_data)
+        date_columns = derived_data.attrs.get("date_columns", [])
+        codes = np.zeros(self.population_rows, dtype=np.int64)
+        self.stratify_by = []
+
+        if date_columns:
+            month_col = f"month_year_{date_columns[0]}"
+            months = derived_data[month_col]
+            # Codes are -1 for rows without a date, so shift them to start at 0
+            codes = months.cat.codes.to_numpy().astype(np.int64) + 1
+            self.stratify_by.append(month_col)
+
+        # The category column with the most distinct values still small enough to be a category
+        _, object_cols = classify_columns(transaction_data, date_columns)
+        candidates = [col for col in object_cols
+                      if column_profiles[col].unique_count and column_profiles[col].unique_count < CATEGORY_MAX_UNIQUE]
+        if candidates:
+            category_col = max(candidates, key=lambda col: column_profiles[col].unique_count)
+            top_values = list(column_profiles[category_col].top_values)[:top_categories]
+            # Values outside the top ones (and missing values) get code 0
+            category_codes = pd.Categorical(transaction_data[category_col], categories=top_values).codes
+            codes = codes * (len(top_values) + 1) + (category_codes.astype(np.int64) + 1)
+            self.stratify_by.append(category_col)
+
+        # Renumber to the strata that occur, then sort rows by stratum
+        _, codes, counts = np.unique(codes, return_inverse=True, return_counts=True)
+        index_dtype = np.int32 if self.population_rows < 2 ** 31 else np.int64
+        self.order = np.argsort(codes, kind="stable").astype(index_dtype)
+        self.population = counts
+        self.starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        # Sampled rows analysed per second beyond a fixed cost per run, learned from the pilot
+        # and every run after it; the same for the exact analysis from its pilot, and how long
+        # the exact analysis took once it has run on every row
+        self.rows_per_second = None
+        self.overhead_seconds = 0.0
+        self.exact_rows_per_second = None
+        self.exact_overhead_seconds = 0.0
+        self.exact_seconds = None
+
+    # Function to draw a stratified sample of about sample_size rows: proportional allocation with
+    # a floor per stratum. Returns sorted row positions, each row's stratum, and rows sampled per stratum.
+    def draw(self, sample_size, seed=0):
+        rng = np.random.default_rng(seed)
+        population = self.population
+        allocation = np.round(sample_size * population / self.population_rows).astype(np.int64)
+        allocation = np.minimum(population, np.maximum(allocation, SAMPLE_MIN_PER_STRATUM))
+
+        positions, strata = [], []
+        for stratum, (start, size, take) in enumerate(zip(self.starts, population, allocation)):
+            offsets = rng.choice(size, take, replace=False) if take < size else np.arange(size)
+            positions.append(self.order[start + offsets])
+            strata.append(np.full(take, stratum, dtype=np.int32))
+        positions, strata = np.concatenate(positions), np.concatenate(strata)
+        by_position = np.argsort(positions, kind="stable")
+        return positions[by_position], strata[by_position], allocation
+
+    # Function to size the sample so the analysis takes about target_seconds, timing pilots of the
+    # sampled (run) and exact (run_exact, on the first rows) analysis the first time. Returns the
+    # population size when the exact analysis is expected to be no slower than the sample or to
+    # fit in the target anyway, since sampling then only costs accuracy.
+    def choose_sample_size(self, run, run_exact, target_seconds=SAMPLE_TARGET_SECONDS, min_rows=SAMPLE_MIN_ROWS):
+        if self.population_rows <= min_rows:
+            return self.population_rows
+        if self.rows_per_second is None:
+            self.rows_per_second, self.overhead_seconds = self.pilot(run)
+            self.exact_rows_per_second, self.exact_overhead_seconds = self.pilot(run_exact)
+        sample_size = int(self.rows_per_second * max(target_seconds - self.overhead_seconds, 0.0))
+        sample_size = min(self.population_rows, max(sample_size, min_rows))
+        if self.expected_exact_seconds() <= max(target_seconds, self.expected_seconds(sample_size)):
+            return self.population_rows
+        return sample_size
+
+    # Function to time an analysis on two row counts and split its cost into rows per second
+    # and a fixed overhead per run
+    def pilot(self, run):
+        timings = []
+        for rows in SAMPLE_PILOT_ROWS:
+            rows = min(rows, self.population_rows)
+            start = time.perf_counter()
+            run(rows)
+            timings.append((rows, time.perf_counter() - start))
+        (small_rows, small_seconds), (large_rows, large_seconds) = timings
+        if large_rows > small_rows and large_seconds > small_seconds:
+            rows_per_second = (large_rows - small_rows) / (large_seconds - small_seconds)
+        else:
+            rows_per_second = large_rows / max(large_seconds, 1e-6)
+        return rows_per_second, max(small_seconds - small_rows / rows_per_second, 0.0)
+
+    def expected_seconds(self, rows):
+        return self.overhead_seconds + rows / self.rows_per_second
+
+    # Function to estimate the exact analysis time: measured once it has run, otherwise its
+    # pilot's rate over every row
+    def expected_exact_seconds(self):
+        if self.exact_seconds is not None:
+            return self.exact_seconds
+        return self.exact_overhead_seconds + self.population_rows / self.exact_rows_per_second
+
+    def observe(self, rows, seconds):
+        rate = rows / max(seconds - self.overhead_seconds, 1e-6)
+        # Smooth the rate so one slow run does not halve the next sample
+        self.rows_per_second = rate if self.rows_per_second is None else 0.5 * (self.rows_per_second + rate)
+
+    def observe_exact(self, seconds):
+        self.exact_seconds = seconds
+
+# Function to round an interval bound to a few significant digits; more would only be noise
+def _bound(value, digits=5):
+    return float(f"{value:.{digits}g}") if math.isfinite(value) else value
+
+# Function to estimate per-group sums, averages and non-null counts of value_cols from a
+# stratified sample, with 95% confidence intervals. Sums and counts use the stratified
+# expansion estimator; averages are ratio estimates with linearized variance.
+# Returns {value_col: [records]} in the layout of analysis.aggregate_by_key, plus
+# sum_/avg_/count_<col>_ci95 fields holding [low, high].
+def estimate_by_key(sample, key, key_name, value_cols, strata, population, allocation):
+    if not value_cols:
+        return {}
+    values = sample[value_cols]
+    present = values.notna().astype(np.float64)
+    filled = values.fillna(0.0).astype(np.float64)
+    parts = pd.concat({"y": filled, "yy": filled * filled, "x": present}, axis=1)
+    grouped = parts.groupby([key.to_numpy(), strata], observed=True, sort=True).sum()
+
+    stratum = grouped.index.get_level_values(1).to_numpy()
+    big_n = population[stratum].astype(np.float64)[:, None]
+    small_n = allocation[stratum].astype(np.float64)[:, None]
+    weight = big_n / small_n
+    # Per-stratum variance factor N^2 (1 - n/N) / n, with the sample variance's n - 1 folded in
+    spread = np.where(small_n > 1, big_n * big_n * (1 - small_n / big_n) / small_n / np.maximum(small_n - 1, 1), 0.0)
+
+    sy, syy, sx = grouped["y"].to_numpy(), grouped["yy"].to_numpy(), grouped["x"].to_numpy()
+    groups = grouped.index.get_level_values(0)
+
+    def per_group(array):
+        return pd.DataFrame(array, columns=value_cols).groupby(groups, sort=True).sum()
+
+    sums = per_group(weight * sy)
+    counts = per_group(weight * sx)
+    sum_var = per_group(spread * (syy - sy * sy / small_n))
+    count_var = per_group(spread * (sx - sx * sx / small_n))
+    ratio = (sums / counts.where(counts > 0)).reindex(groups).to_numpy()
+    residual_sum = sy - ratio * sx
+    residual_squares = syy - 2 * ratio * sy + ratio * ratio * sx
+    avg_var = per_group(np.nan_to_num(spread * (residual_squares - residual_sum * residual_sum / small_n))) \
+        / (counts * counts).where(counts > 0)
+
+    key_values = sums.index.tolist()
+    results = {}
+    for value_col in value_cols:
+        records = []
+        for position, key_value in enumerate(key_values):
+            total = float(sums[value_col].iat[position])
+            count = float(counts[value_col].iat[position])
+            mean = total / count if count > 0 else math.nan
+            sum_half = Z_95 * math.sqrt(max(float(sum_var[value_col].iat[position]), 0.0))
+            count_half = Z_95 * math.sqrt(max(float(count_var[value_col].iat[position]), 0.0))
+            avg_half = Z_95 * math.sqrt(max(float(avg_var[value_col].iat[position]), 0.0)) if count > 0 else math.nan
+            records.append({
+                key_name: key_value,
+                f'sum_{value_col}': total,
+                f'avg_{value_col}': mean,
+                f'count_{value_col}': int(round(count)),
+                f'sum_{value_col}_ci95': [_bound(total - sum_half), _bound(total + sum_half)],
+                f'avg_{value_col}_ci95': [_bound(mean - avg_half), _bound(mean + avg_half)],
+                f'count_{value_col}_ci95': [max(0, int(math.floor(count - count_half))), int(math.ceil(count + count_half))],
+            })
+        results[value_col] = records
+    return results
+
+# Function to build the analysis sections from a stratified sample of sample_size rows.
+# Row counts, column summaries and monthly distributions come from the upload-time profiles
+# and month buckets, so they stay exact; monthly and category breakdowns are estimates with
+# confidence intervals, and correlations are computed on the sample.
+def analyze_sample(question, transaction_data, derived_data, column_profiles, plan, sample_size, seed=0):
+    date_columns = derived_data.attrs.get("date_columns", [])
+    with span("draw stratified sample", rows=sample_size):
+        positions, strata, allocation = plan.draw(sample_size, seed)
+        sample = transaction_data.take(positions)
+        sample_derived = derived_data.take(positions)
+
+    data_stats = {}
+    with span("column summaries"):
+        numeric_cols, object_cols = classify_columns(transaction_data, date_columns)
+        date_stats = add_profile_sections(data_stats, transaction_data.columns.tolist(), len(transaction_data),
+                                          numeric_cols, object_cols, date_columns, column_profiles)
+    value_cols = pick_value_columns(numeric_cols)
+
+    for date_col, stats in date_stats.items():
+        with span("monthly estimates", column=date_col, value_columns=len(value_cols)):
+            data_stats[date_col] = stats
+            month_year = derived_data[f'month_year_{date_col}']
+            # Counting rows per month only reads the bucket codes, so it stays exact
+            monthly_counts = month_year.value_counts().sort_index().to_dict()
+            data_stats[f"{date_col}_monthly_distribution"] = {str(k): int(v) for k, v in monthly_counts.items() if v > 0}
+
+            sample_months = sample_derived[f'month_year_{date_col}']
+            known = sample_months.notna().to_numpy()
+            monthly_results = estimate_by_key(sample[known], sample_months[known], f'month_year_{date_col}',
+                                              value_cols, strata[known], plan.population, allocation)
+            for value_col, monthly_data in monthly_results.items():
+                data_stats[f"monthly_{date_col}_{value_col}"] = monthly_data
+
+    if date_stats:
+        categorical_cols = [col for col in object_cols if column_profiles[col].unique_count < CATEGORY_MAX_UNIQUE]
+        with span("category estimates", columns=len(categorical_cols), value_columns=len(value_cols)):
+            for cat_col in categorical_cols:
+                known = sample[cat_col].notna().to_numpy()
+                category_results = estimate_by_key(sample[known], sample[cat_col][known], cat_col,
+                                                   value_cols, strata[known], plan.population, allocation)
+                for value_col, category_data in category_results.items():
+                    data_stats[f"{cat_col}_{value_col}_analysis"] = category_data
+
+    if len(numeric_cols) > 1:
+        with span("correlation (sample)", columns=len(numeric_cols)):
+            corr_matrix = sample[numeric_cols].corr().round(2)
+            data_stats["correlation_matrix"] = {
+                col1: {col2: float(corr_matrix.loc[col1, col2]) for col2 in corr_matrix.columns}
+                for col1 in corr_matrix.columns
+            }
+
+    data_stats["sampling_notes"] = {
+        "sampled_rows": len(positions),
+        "population_rows": len(transaction_data),
+        "stratified_by": plan.stratify_by,
+        "estimated_fields": "sum_/avg_/count_ values in monthly_* and *_analysis sections, and correlation_matrix",
+        "confidence_intervals": "95% intervals in the matching *_ci95 fields as [low, high]",
+        "exact_fields": "row_count, column summaries and *_monthly_distribution",
+    }
+    with span("convert to native types"):
+        return convert_to_native_types(data_stats)
+
+# Function to run the approximate analysis sized to the latency target. Uploads whose exact
+# analysis is expected to fit the target, or to beat the sample, fall back to exact_analysis()
+# and are returned unchanged.
+# Returns (analysis, sampled) where sampled says whether the figures are estimates.
+def analyze_approximately(question, transaction_data, derived_data, column_profiles, plan, exact_analysis,
+                          target_seconds=SAMPLE_TARGET_SECONDS):
+    def run(rows):
+        return analyze_sample(question, transaction_data, derived_data, column_profiles, plan, rows)
+
+    # The exact pilot runs on the first rows; only its cost matters, not its figures
+    def run_exact(rows):
+        return analyze_data_for_question(question, transaction_data.iloc[:rows], None,
+                                         derived_data.iloc[:rows], column_profiles)
+
+    with span("size sample", target_seconds=target_seconds):
+        sample_size = plan.choose_sample_size(run, run_exact, target_seconds)
+    if sample_size >= plan.population_rows:
+        start = time.perf_counter()
+        analysis = exact_analysis()
+        plan.observe_exact(time.perf_counter() - start)
+        return analysis, False
+    start = time.perf_counter()
+    analysis = run(sample_size)
+    plan.observe(sample_size, time.perf_counter() - start)
+    return analysis, True
@@ -0,0 +1,228 @@
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from analysis import (CATEGORY_MAX_UNIQUE, add_profile_sections, classify_columns,
+                      convert_to_native_types, pick_value_columns)
+from tracing import span
+
+# Embedded SQLite stores, one file per upload content hash
+STORE_DIR = os.environ.get("STORE_DIR", os.path.join(".cache", "stores"))
+STORE_MAX_BYTES = int(os.environ.get("STORE_MAX_MB", "4096")) * 1024 * 1024
+
+# Table the upload is loaded into (also the table model-written queries run against)
+STORE_TABLE = "transactions"
+
+# Function to quote an identifier for SQLite
+def quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+# An upload loaded into a local SQLite file: the raw columns, dates as sortable
+# 'YYYY-MM-DD HH:MM:SS' text, a 'YYYY-MM' month column per date column, and indexes on
+# date, month and category columns so filtered and grouped queries on them use an index.
+# The file is opened read-only; analysis sections are computed as SQL aggregations.
+class AnalyticalStore:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        # One connection is shared across sessions, so statements on it run one at a time
+        self.lock = threading.Lock()
+        meta = dict(self.conn.execute("SELECT key, value FROM store_meta"))
+        self.columns = json.loads(meta["columns"])
+        self.date_columns = json.loads(meta["date_columns"])
+        self.numeric_cols = json.loads(meta["numeric_cols"])
+        self.object_cols = json.loads(meta["object_cols"])
+        self.row_count = int(meta["row_count"])
+        self.sql_types = {name: sql_type for _, name, sql_type, *_ in
+                          self.conn.execute(f"PRAGMA table_info({quote(STORE_TABLE)})")}
+
+    # Function to load an upload into a new store file. Writes a temporary file and renames it,
+    # so readers never open a half-built store.
+    @classmethod
+    def build(cls, path, data, derived_data, column_profiles):
+        date_columns = derived_data.attrs.get("date_columns", [])
+        numeric_cols, object_cols = classify_columns(data, date_columns)
+        table = data.copy(deep=False)
+        for col in date_columns:
+            table[col] = derived_data[col]
+            table[f"month_year_{col}"] = derived_data[f"month_year_{col}"].astype(object)
+
+        staging_path = f"{path}.tmp-{os.getpid()}-{time.monotonic_ns()}"
+        try:
+            conn = sqlite3.connect(staging_path)
+            try:
+                # Bulk load without a journal; the file is only renamed into place once complete
+                conn.execute("PRAGMA journal_mode = OFF")
+                conn.execute("PRAGMA synchronous = OFF")
+                table.to_sql(STORE_TABLE, conn, index=False, chunksize=100_000)
+
+                indexed = list(date_columns) + [f"month_year_{col}" for col in date_columns]
+                indexed += [col for col in object_cols
+                            if column_profiles[col].unique_count is not None
+                            and column_profiles[col].unique_count < CATEGORY_MAX_UNIQUE]
+                for position, col in enumerate(indexed):
+                    conn.execute(f"CREATE INDEX {quote(f'idx_{position}')} ON {quote(STORE_TABLE)} ({quote(col)})")
+                # Planner statistics so filtered queries pick the right index
+                conn.execute("ANALYZE")
+
+                meta = {
+                    "columns": json.dumps(data.columns.tolist()),
+                    "date_columns": json.dumps(list(date_columns)),
+                    "numeric_cols": json.dumps(numeric_cols),
+                    "object_cols": json.dumps(object_cols),
+                    "row_count": str(len(data)),
+                }
+                conn.execute("CREATE TABLE store_meta (key TEXT PRIMARY KEY, value TEXT)")
+                conn.executemany("INSERT INTO store_meta VALUES (?, ?)", meta.items())
+                conn.commit()
+            finally:
+                conn.close()
+            os.replace(staging_path, path)
+        finally:
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
+        return cls(path)
+
+    def fetch(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    # Function to count missing values in every column in one scan
+    def null_counts(self):
+        expressions = ", ".join(f"SUM({quote(col)} IS NULL)" for col in self.columns)
+        row = self.fetch(f"SELECT {expressions} FROM {quote(STORE_TABLE)}")[0]
+        return {col: int(count or 0) for col, count in zip(self.columns, row)}
+
+    # Function to aggregate every value column by one key column in a single grouped query.
+    # Returns {value_col: [records]} in the same layout as analysis.aggregate_by_key.
+    def aggregate_by_key(self, key_col, key_name, value_cols):
+        if not value_cols:
+            return {}
+        expressions = ", ".join(
+            f"COALESCE(SUM({quote(col)}), 0), AVG({quote(col)}), COUNT({quote(col)})" for col in value_cols
+        )
+        rows = self.fetch(
+            f"SELECT {quote(key_col)}, {expressions} FROM {quote(STORE_TABLE)} "
+            f"WHERE {quote(key_col)} IS NOT NULL GROUP BY 1 ORDER BY 1"
+        )
+        results = {}
+        for position, value_col in enumerate(value_cols):
+            record_keys = (key_name, f'sum_{value_col}', f'avg_{value_col}', f'count_{value_col}')
+            offset = 1 + 3 * position
+            results[value_col] = [
+                dict(zip(record_keys, (row[0], row[offset], math.nan if row[offset + 1] is None else row[offset + 1],
+                                       row[offset + 2])))
+                for row in rows
+            ]
+        return results
+
+    # Function to compute pairwise-complete Pearson correlations for numeric columns in one scan.
+    # Values are shifted by their profile means first, which keeps the sums well conditioned.
+    # Pairs of columns without missing values share plain sums; other pairs only sum the rows
+    # where both values are present.
+    def correlation_matrix(self, numeric_cols, column_profiles):
+        shifted = {col: f"({quote(col)} - {float(column_profiles[col].summary['mean'] or 0.0)!r})"
+                   for col in numeric_cols}
+        pairs = [(a, b) for i, a in enumerate(numeric_cols) for b in numeric_cols[i:]]
+        # Identical expressions are evaluated once, since SQLite does not share them itself
+        expressions = {}
+
+        def position(expression):
+            return expressions.setdefault(expression, len(expressions))
+
+        pair_positions = []
+        for a, b in pairs:
+            x, y = shifted[a], shifted[b]
+            if column_profiles[a].null_count == 0 and column_profiles[b].null_count == 0:
+                terms = ["COUNT(*)", f"TOTAL({x})", f"TOTAL({y})", f"TOTAL({x} * {x})",
+                         f"TOTAL({y} * {y})", f"TOTAL({x} * {y})"]
+            else:
+                both = f"{quote(a)} IS NOT NULL AND {quote(b)} IS NOT NULL"
+                terms = [f"SUM({both})"] + [f"TOTAL(CASE WHEN {both} THEN {term} END)"
+                                            for term in (x, y, f"{x} * {x}", f"{y} * {y}", f"{x} * {y}")]
+            pair_positions.append([position(term) for term in terms])
+        row = self.fetch(f"SELECT {', '.join(expressions)} FROM {quote(STORE_TABLE)}")[0]
+
+        corr_data = {col: {} for col in numeric_cols}
+        for (a, b), positions in zip(pairs, pair_positions):
+            n, sx, sy, sxx, syy, sxy = (row[i] for i in positions)
+            n = n or 0
+            value = math.nan
+            if n > 1:
+                var_x, var_y = sxx - sx * sx / n, syy - sy * sy / n
+                if var_x > 0 and var_y > 0:
+                    value = (sxy - sx * sy / n) / math.sqrt(var_x * var_y)
+                    value = round(max(-1.0, min(1.0, value)), 2)
+            corr_data[a][b] = corr_data[b][a] = value
+        # Keep the row and column order of DataFrame.corr
+        return {a: {b: corr_data[a][b] for b in numeric_cols} for a in numeric_cols}
+
+# Function to build the same analysis as analyze_data_for_question from a store: per-column
+# summaries come from the upload-time profiles, everything that scans rows runs as SQL.
+def analyze_store(question, store, column_profiles):
+    data_stats = {}
+    numeric_cols, object_cols = store.numeric_cols, store.object_cols
+    with span("null counts (SQL)"):
+        null_counts = store.null_counts()
+    with span("column summaries"):
+        date_stats = add_profile_sections(data_stats, store.columns, store.row_count, numeric_cols, object_cols,
+                                          store.date_columns, column_profiles, null_counts=null_counts)
+    value_cols = pick_value_columns(numeric_cols)
+
+    for date_col, stats in date_stats.items():
+        with span("monthly aggregations (SQL)", column=date_col, value_columns=len(value_cols)):
+            data_stats[date_col] = stats
+            month_col = f"month_year_{date_col}"
+            monthly_counts = store.fetch(
+                f"SELECT {quote(month_col)}, COUNT(*) FROM {quote(STORE_TABLE)} "
+                f"WHERE {quote(month_col)} IS NOT NULL GROUP BY 1 ORDER BY 1"
+            )
+            data_stats[f"{date_col}_monthly_distribution"] = {str(month): int(count) for month, count in monthly_counts}
+            for value_col, monthly_data in store.aggregate_by_key(month_col, month_col, value_cols).items():
+                data_stats[f"monthly_{date_col}_{value_col}"] = monthly_data
+
+    if date_stats:
+        categorical_cols = [col for col in object_cols if column_profiles[col].unique_count < CATEGORY_MAX_UNIQUE]
+        with span("category aggregations (SQL)", columns=len(categorical_cols), value_columns=len(value_cols)):
+            for cat_col in categorical_cols:
+                for value_col, category_data in store.aggregate_by_key(cat_col, cat_col, value_cols).items():
+                    data_stats[f"{cat_col}_{value_col}_analysis"] = category_data
+
+    if len(numeric_cols) > 1:
+        with span("correlation (SQL)", columns=len(numeric_cols)):
+            data_stats["correlation_matrix"] = store.correlation_matrix(numeric_cols, column_profiles)
+
+    return convert_to_native_types(data_stats)
+
+# Function to open the store for an upload, building it on first use
+def open_store(fingerprint, data, derived_data, column_profiles, store_dir=STORE_DIR, max_bytes=STORE_MAX_BYTES):
+    os.makedirs(store_dir, exist_ok=True)
+    path = os.path.join(store_dir, f"{fingerprint}.sqlite3")
+    if os.path.exists(path):
+        try:
+            store = AnalyticalStore(path)
+            # Touch the file so LRU eviction sees it as recently used
+            os.utime(path)
+            return store
+        except (sqlite3.DatabaseError, KeyError, ValueError):
+            # A corrupt or outdated store is rebuilt
+            os.remove(path)
+    store = AnalyticalStore.build(path, data, derived_data, column_profiles)
+    evict_stores(store_dir, max_bytes, keep=path)
+    return store
+
+# Function to trim the store directory to max_bytes, oldest access first
+def evict_stores(store_dir=STORE_DIR, max_bytes=STORE_MAX_BYTES, keep=None):
+    entries = [entry for entry in os.scandir(store_dir)
+               if entry.is_file() and entry.name.endswith(".sqlite3")]
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+        if total <= max_bytes:
+            break
+        if entry.path == keep:
+            continue
+        total -= entry.stat().st_size
+        os.remove(entry.path)
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+# Date spellings mixed into "dirty" date columns, plus values that are not dates at all
+DIRTY_DATE_FORMATS = ["%m/%d/%Y", "%Y/%m/%d", "%d %b %Y", "%Y-%m-%d %H:%M:%S"]
+DIRTY_DATE_JUNK = ["", "unknown", "N/A", "0000-00-00"]
+
+# Function to name generated columns so the analysis treats them as values, categories and dates
+def synthetic_column_names(numeric=4, categorical=3, dates=1):
+    # Every other numeric column carries a value term ("amount"), the rest are plain measures
+    numeric_names = [f"sales_amount_{i}" if i % 2 == 0 else f"metric_{i}" for i in range(numeric)]
+    categorical_names = [f"segment_{i}" for i in range(categorical)]
+    date_names = [f"order_date_{i}" for i in range(dates)]
+    return numeric_names, categorical_names, date_names
+
+# Function to generate a transaction-like frame for benchmarks.
+#   cardinality: distinct values per categorical column
+#   null_rate: fraction of missing values in every column
+#   dirty_dates: fraction of date values written in other formats or as junk strings
+def make_transaction_data(rows=10_000, numeric=4, categorical=3, dates=1, cardinality=8,
+                          null_rate=0.0, dirty_dates=0.0, seed=0):
+    rng = np.random.default_rng(seed)
+    numeric_names, categorical_names, date_names = synthetic_column_names(numeric, categorical, dates)
+
+    columns = {}
+    for name in date_names:
+        days = rng.integers(0, 730, rows)
+        parsed = pd.Timestamp("2023-01-01") + pd.to_timedelta(days, unit="D")
+        values = np.asarray(parsed.strftime("%Y-%m-%d"), dtype=object)
+        if dirty_dates:
+            dirty = np.flatnonzero(rng.random(rows) < dirty_dates)
+            choices = rng.integers(0, len(DIRTY_DATE_FORMATS) + len(DIRTY_DATE_JUNK), len(dirty))
+            for position, choice in zip(dirty.tolist(), choices.tolist()):
+                if choice < len(DIRTY_DATE_FORMATS):
+                    values[position] = parsed[position].strftime(DIRTY_DATE_FORMATS[choice])
+                else:
+                    values[position] = DIRTY_DATE_JUNK[choice - len(DIRTY_DATE_FORMATS)]
+        columns[name] = values
+
+    labels = np.array([f"value_{j}" for j in range(cardinality)], dtype=object)
+    for name in categorical_names:
+        # Skewed frequencies, like real categories
+        weights = rng.dirichlet(np.ones(cardinality))
+        columns[name] = labels[rng.choice(cardinality, rows, p=weights)]
+
+    for i, name in enumerate(numeric_names):
+        if i % 2 == 0:
+            columns[name] = rng.gamma(2.0, 50.0, rows).round(2)
+        else:
+            columns[name] = rng.normal(100.0, 25.0, rows)
+
+    data = pd.DataFrame(columns)
+    if null_rate:
+        for name in data.columns:
+            data.loc[rng.random(rows) < null_rate, name] = None
+    return data
+
+# Function to generate a data dictionary for the given columns. Extra fields pad the dictionary
+# past the upload's columns; fuzzy_rate respells a share of names (case and separators) so the
+# fuzzy matcher has work to do; tables > 1 spreads fields over several tables.
+def make_data_dictionary(columns, extra_fields=0, tables=1, fuzzy_rate=0.2, seed=0):
+    rng = np.random.default_rng(seed)
+    names = list(columns) + [f"extra_field_{i}" for i in range(extra_fields)]
+    respelled = rng.random(len(names)) < fuzzy_rate
+    fields = [name.replace("_", " ").title() if respell else name for name, respell in zip(names, respelled)]
+
+    dictionary = pd.DataFrame({
+        "field_name": fields,
+        "data_type": ["float" if "amount" in name or "metric" in name else "date" if "date" in name else "string"
+                      for name in names],
+        "description": [f"Synthetic description of {name.replace('_', ' ')} used for benchmarking." for name in names],
+    })
+    if tables > 1:
+        dictionary.insert(0, "table_name", [f"table_{i % tables}" for i in range(len(names))])
+    return dictionary
@@ -0,0 +1,179 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+# Trace collecting spans in the current context; None means tracing is off
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+# One timed stage. Wall and CPU time are in seconds; memory_delta is the change in
+# Python-allocated bytes over the span, recorded only while tracemalloc is running.
+class Span:
+    def __init__(self, name, attrs, parent=None):
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.children = []
+        self.thread_id = threading.get_ident()
+        self.start = 0.0
+        self.wall = None
+        self.cpu = None
+        self.memory_delta = None
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "start": self.start,
+            "wall_seconds": self.wall,
+            "cpu_seconds": self.cpu,
+            "memory_delta_bytes": self.memory_delta,
+            "attrs": self.attrs,
+            "children": [child.to_dict() for child in self.children],
+        }
+
+# Context manager that times one span and nests it under the span that was open when it started
+class _SpanTimer:
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        trace = self.trace
+        if trace.on_span is not None:
+            trace.on_span(self.name, self.attrs)
+        parent = trace.open_span.get()
+        span = Span(self.name, self.attrs, parent)
+        (parent.children if parent is not None else trace.roots).append(span)
+        self.span = span
+        self.token = trace.open_span.set(span)
+        self.memory_start = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        self.cpu_start = time.thread_time()
+        span.start = time.perf_counter() - trace.origin
+        self.wall_start = time.perf_counter()
+        return span
+
+    def __exit__(self, exc_type, exc, tb):
+        span = self.span
+        span.wall = time.perf_counter() - self.wall_start
+        span.cpu = time.thread_time() - self.cpu_start
+        if self.memory_start is not None and tracemalloc.is_tracing():
+            span.memory_delta = tracemalloc.get_traced_memory()[0] - self.memory_start
+        if exc_type is not None:
+            span.attrs = {**span.attrs, "error": exc_type.__name__}
+        self.trace.open_span.reset(self.token)
+        return False
+
+# Shared no-op span used when no trace is active, so instrumented code costs one lookup
+class _NullSpan:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+# A tree of spans for one request (a chat turn or an upload), exportable as JSON or in the
+# Chrome trace event format (load it in chrome://tracing or https://ui.perfetto.dev).
+# on_span, if given, is called with the name and attributes of every span as it opens;
+# an exception it raises propagates out of the span instead of running its body.
+class Trace:
+    def __init__(self, name, track_memory=False, on_span=None):
+        self.name = name
+        self.track_memory = track_memory
+        self.on_span = on_span
+        self.created = time.time()
+        self.origin = time.perf_counter()
+        self.roots = []
+        self.open_span = contextvars.ContextVar(f"open_span_{id(self)}", default=None)
+        self.started_tracemalloc = False
+
+    def span(self, name, **attrs):
+        return _SpanTimer(self, name, attrs)
+
+    # Function to walk the span tree depth-first as (depth, span) pairs
+    def walk(self):
+        stack = [(0, span) for span in reversed(self.roots)]
+        while stack:
+            depth, span = stack.pop()
+            yield depth, span
+            stack.extend((depth + 1, child) for child in reversed(span.children))
+
+    # Function to flatten the spans into rows for a table, children indented under their parent
+    def rows(self):
+        rows = []
+        for depth, span in self.walk():
+            rows.append({
+                "stage": "\u2003" * depth + span.name,
+                "wall_ms": round((span.wall or 0.0) * 1000, 1),
+                "cpu_ms": round((span.cpu or 0.0) * 1000, 1),
+                "memory_delta_kb": None if span.memory_delta is None else round(span.memory_delta / 1024, 1),
+            })
+        return rows
+
+    def total_seconds(self):
+        return sum(span.wall or 0.0 for span in self.roots)
+
+    def to_dict(self):
+        return {"name": self.name, "created": self.created, "spans": [span.to_dict() for span in self.roots]}
+
+    # Function to render complete ("X") events; timestamps are microseconds since the trace started
+    def chrome_events(self, pid=None):
+        pid = os.getpid() if pid is None else pid
+        events = []
+        for _, span in self.walk():
+            args = dict(span.attrs)
+            args["cpu_ms"] = round((span.cpu or 0.0) * 1000, 3)
+            if span.memory_delta is not None:
+                args["memory_delta_bytes"] = span.memory_delta
+            events.append({
+                "name": span.name, "cat": self.name, "ph": "X", "pid": pid, "tid": span.thread_id,
+                "ts": round(span.start * 1e6, 1), "dur": round((span.wall or 0.0) * 1e6, 1), "args": args,
+            })
+        return events
+
+# Function to make trace the active one for the block; spans opened inside are recorded on it.
+# With track_memory, tracemalloc runs for the block (unless something else already started it).
+class activate:
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        if self.trace.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.trace.started_tracemalloc = True
+        self.token = _current_trace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_trace.reset(self.token)
+        if self.trace.started_tracemalloc:
+            tracemalloc.stop()
+            self.trace.started_tracemalloc = False
+        return False
+
+# Function to open a span on the active trace, or a shared no-op when tracing is off
+def span(name, **attrs):
+    trace = _current_trace.get()
+    if trace is None:
+        return _NULL_SPAN
+    return trace.span(name, **attrs)
+
+# Function to export traces as JSON
+def traces_to_json(traces):
+    return json.dumps([trace.to_dict() for trace in traces], default=str, indent=2)
+
+# Function to export traces in the Chrome trace format, each trace offset by when it started
+def traces_to_chrome(traces):
+    events = []
+    if traces:
+        first = min(trace.created for trace in traces)
+        for trace in traces:
+            offset = (trace.created - first) * 1e6
+            for event in trace.chrome_events():
+                event["ts"] = round(event["ts"] + offset, 1)
+                events.append(event)
+    return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, default=str)